@@ -0,0 +1,63 @@
+"""Compare two benchmark result files
+
+Prints throughput and latency changes per operation, and exits with code 1
+if any p95 latency regressed by more than the given threshold:
+
+    python -m benchmarks.compare results/base.json results/head.json
+"""
+
+import argparse
+import json
+import sys
+
+METRICS = ('throughput', 'p50_ms', 'p95_ms', 'p99_ms')
+
+
+def change(base: float, head: float) -> float:
+    if not base:
+        return 0.0
+    return (head - base) / base * 100
+
+
+def compare(base: dict, head: dict) -> list[tuple[str, str, float, float]]:
+    rows = []
+    sections = {'total': (base.get('total'), head.get('total'))}
+    for operation, stats in head.get('operations', {}).items():
+        sections[operation] = (base.get('operations', {}).get(operation), stats)
+    for section, (base_stats, head_stats) in sections.items():
+        if not base_stats or not head_stats:
+            continue
+        for metric in METRICS:
+            rows.append(
+                (section, metric, base_stats[metric], head_stats[metric]))
+    return rows
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument(
+        '--threshold', type=float, default=10,
+        help='Allowed p95 latency regression in percent')
+    args = parser.parse_args(argv)
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+
+    print(f'{base.get("revision")} -> {head.get("revision")}')
+    print(f'{"operation":<16}{"metric":<12}{"base":>12}{"head":>12}{"change":>10}')
+    regressed = False
+    for section, metric, base_value, head_value in compare(base, head):
+        delta = change(base_value, head_value)
+        print(f'{section:<16}{metric:<12}{base_value:>12}{head_value:>12}'
+              f'{delta:>+9.1f}%')
+        if metric == 'p95_ms' and delta > args.threshold:
+            regressed = True
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
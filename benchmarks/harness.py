@@ -0,0 +1,191 @@
+"""In-process benchmark harness
+
+Boots the FastAPI app in the current process against a disposable
+database and drives it through an ASGI client, without a network hop.
+The database is wiped on startup (TESTING mode), never point it at a
+database holding data you care about.
+"""
+
+import os
+import subprocess
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+
+DEFAULT_DATABASE_URI = 'sqlite+aiosqlite:///bench.db'
+
+
+def configure(database_uri: str | None = None, **env) -> None:
+    """Set app settings, must be called before the app is imported"""
+    os.environ['TESTING'] = 'True'
+    os.environ['DATABASE_URI'] = database_uri or DEFAULT_DATABASE_URI
+    # Benchmark clients share one address and hammer few users
+    os.environ['TRANSACTION_RATE'] = '0'
+    os.environ['AUTH_RATE'] = '0'
+    for key, value in env.items():
+        os.environ[key] = str(value)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+@dataclass
+class Recorder:
+    """Latencies and status codes recorded per operation"""
+
+    latencies: dict[str, list[float]] = field(
+        default_factory=lambda: defaultdict(list))
+    errors: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    started: float = field(default_factory=time.perf_counter)
+    finished: float | None = None
+
+    def record(self, operation: str, latency: float, ok: bool = True) -> None:
+        self.latencies[operation].append(latency)
+        if not ok:
+            self.errors[operation] += 1
+
+    def stop(self) -> None:
+        self.finished = time.perf_counter()
+
+    def summary(self) -> dict:
+        duration = (self.finished or time.perf_counter()) - self.started
+        operations = {}
+        everything = []
+        for operation, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            everything.extend(latencies)
+            operations[operation] = summarize(
+                latencies, duration, self.errors[operation])
+        return {
+            'duration': round(duration, 3),
+            'total': summarize(
+                sorted(everything), duration, sum(self.errors.values())),
+            'operations': operations,
+        }
+
+
+def summarize(latencies: list[float], duration: float, errors: int) -> dict:
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / duration, 2) if duration else 0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(benchmark: str, **params) -> dict:
+    """Describe a benchmark run, so results can be compared across runs"""
+    from client_transactions_api.config import settings
+
+    return {
+        'benchmark': benchmark,
+        'revision': git_revision(),
+        'date': datetime.utcnow().isoformat(),
+        'database': settings.DATABASE_URLS[0].split(':', 1)[0],
+        'params': params,
+    }
+
+
+class Harness:
+    """Running app with an ASGI client and authenticated users"""
+
+    def __init__(self):
+        import httpx
+
+        from client_transactions_api.main import app
+
+        self.app = app
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app),
+            base_url='http://benchmark')
+        self.users: list[dict] = []
+        self.admin: dict | None = None
+
+    async def __aenter__(self) -> 'Harness':
+        await self.app.router.startup()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.client.aclose()
+        await self.app.router.shutdown()
+        from client_transactions_api import db
+        await db.dispose()
+
+    @property
+    def api(self) -> str:
+        from client_transactions_api.config import settings
+        return settings.API_PATH
+
+    async def login(self, username: str, password: str) -> dict:
+        """Return auth headers for user"""
+        response = await self.client.post(
+            f'{self.api}/auth/token',
+            data={'username': username, 'password': password})
+        response.raise_for_status()
+        token = response.json()['access_token']
+        return {'Authorization': f'Bearer {token}'}
+
+    async def create_users(
+        self,
+        count: int,
+        password: str = 'password',
+        funds: float = 0
+    ) -> list[dict]:
+        """Register and log in users, open their balances with funds"""
+        from client_transactions_api.config import settings
+
+        for index in range(count):
+            username = f'bench{index}'
+            response = await self.client.post(
+                f'{self.api}/auth/register',
+                json={'username': username, 'password': password})
+            response.raise_for_status()
+            headers = await self.login(username, password)
+            response = await self.client.get(
+                f'{self.api}/balances/my', headers=headers)
+            response.raise_for_status()
+            if funds:
+                await self.client.post(
+                    f'{self.api}/balances',
+                    json={'user_id': response.json()['user_id'],
+                          'value': funds},
+                    headers=headers)
+            self.users.append({
+                'username': username,
+                'password': password,
+                'id': response.json()['user_id'],
+                'headers': headers,
+            })
+
+        self.admin = {'headers': await self.login(
+            settings.FIRST_SUPERUSER,
+            settings.FIRST_SUPERUSER_PASSWORD.get_secret_value())}
+        return self.users
+
+    async def timed(self, recorder: Recorder, operation: str, request):
+        """Await request coroutine and record its latency"""
+        start = time.perf_counter()
+        try:
+            response = await request
+            ok = response.status_code < 400
+        except Exception:
+            response, ok = None, False
+        recorder.record(operation, time.perf_counter() - start, ok)
+        return response
@@ -0,0 +1,140 @@
+"""Users list serialization benchmark
+
+Measures `GET /api/users` at a large page size, and the per-row cost of
+serializing the page with the pre-built serializers compared to FastAPI's
+response_model validation and `jsonable_encoder`:
+
+    python -m benchmarks.serialization --rows 1000 --requests 200
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from benchmarks import harness
+
+
+async def add_users(count: int) -> None:
+    """Insert users directly, registration is bound by password hashing"""
+    from client_transactions_api import db, models
+    from client_transactions_api.services.auth import auth_service
+
+    hashed_password = auth_service.hash_password('password')
+    async with db.Session() as db_session:
+        db_session.add_all([
+            models.User(username=f'row{index}', password=hashed_password)
+            for index in range(count)])
+        await db_session.commit()
+
+
+async def load_page(rows: int):
+    """Page of user rows as returned by paginate()"""
+    from fastapi_pagination import set_page
+    from fastapi_pagination.ext.async_sqlalchemy import paginate
+    from sqlalchemy import select
+
+    from client_transactions_api import db, models
+    from client_transactions_api.api.users import UsersPage
+
+    params = UsersPage.__params_type__(limit=rows, offset=0)
+    async with db.Session() as db_session:
+        query = select(models.User).order_by(models.User.id)
+        with set_page(UsersPage):
+            return await paginate(db_session, query, params), params
+
+
+async def time_per_row(fn, rows: int, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    median = harness.percentile(timings, 50)
+    return {
+        'p50_ms': round(median * 1000, 3),
+        'per_row_us': round(median / rows * 1e6, 3),
+    }
+
+
+async def serialization(rows: int, repeat: int) -> dict:
+    """Serialize one page of users both ways, without the HTTP stack"""
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_response_field
+
+    from client_transactions_api import schemas, serializers
+    from client_transactions_api.api.users import UsersPage
+
+    page, params = await load_page(rows)
+    page_type = UsersPage[schemas.User]
+    field = create_response_field(name='users', type_=page_type)
+
+    async def response_model() -> bytes:
+        # What FastAPI does for an endpoint returning a page of ORM rows
+        validated = page_type.create(page.items, page.total, params)
+        content = await serialize_response(
+            field=field, response_content=validated)
+        return JSONResponse(jsonable_encoder(content)).body
+
+    async def prebuilt() -> bytes:
+        return serializers.dumps(serializers.page(page, serializers.user))
+
+    assert json.loads(await response_model()) == json.loads(await prebuilt())
+    return {
+        'rows': len(page.items),
+        'response_model': await time_per_row(response_model, rows, repeat),
+        'prebuilt': await time_per_row(prebuilt, rows, repeat),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    async with harness.Harness() as bench:
+        await add_users(args.rows)
+        await bench.create_users(0)
+
+        recorder = harness.Recorder()
+        for _ in range(args.requests):
+            await bench.timed(recorder, 'users_list', bench.client.get(
+                f'{bench.api}/users',
+                params={'limit': args.rows, 'sort_by': 'id', 'desc': False},
+                headers=bench.admin['headers']))
+        recorder.stop()
+
+        cost = await serialization(args.rows, args.repeat)
+
+    return {
+        **harness.metadata(
+            'serialization',
+            rows=args.rows,
+            requests=args.requests,
+            repeat=args.repeat),
+        **recorder.summary(),
+        'serialization': cost,
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-uri', default=None)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--output', default=None, help='Save results as JSON')
+    args = parser.parse_args(argv)
+
+    harness.configure(args.database_uri)
+    results = asyncio.run(run(args))
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""Server profile throughput benchmark
+
+Serves the app with `python -m client_transactions_api serve` once per
+server profile and drives it over real HTTP keep-alive connections with
+users list, balance read and health check requests:
+
+    python -m benchmarks.server --duration 10 --concurrency 32
+    python -m benchmarks.server --profile production \\
+        --profile production-uncompressed=production,COMPRESSION=False
+
+The database is prepared once and shared by all profiles. Reports
+throughput, latency percentiles and response bytes per profile.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from benchmarks import harness
+from benchmarks.serialization import add_users
+
+# Profile name: SERVER_PROFILE followed by settings overrides
+PROFILES = {
+    'development': 'development',
+    'development-asyncio-h11': 'development,SERVER_LOOP=asyncio,SERVER_HTTP=h11',
+    'production': 'production',
+    'production-uncompressed': 'production,COMPRESSION=False',
+}
+
+WORKLOAD = {
+    'users_list': 10,
+    'balance_read': 80,
+    'health': 10,
+}
+
+
+def parse_profile(value: str) -> tuple[str, dict]:
+    """Parse NAME or NAME=PROFILE,SETTING=VALUE,..."""
+    name, _, spec = value.partition('=')
+    spec = spec or PROFILES.get(name, name)
+    profile, *overrides = spec.split(',')
+    env = {'SERVER_PROFILE': profile}
+    for override in overrides:
+        key, _, setting = override.partition('=')
+        env[key] = setting
+    return name, env
+
+
+async def prepare(rows: int) -> dict:
+    """Create schema and users, return auth headers"""
+    async with harness.Harness() as bench:
+        await add_users(rows)
+        await bench.create_users(1)
+        return {'user': bench.users[0]['headers'], 'admin': bench.admin['headers']}
+
+
+async def wait_ready(url: str, timeout: float = 30) -> None:
+    import httpx
+
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.perf_counter() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.05)
+    raise TimeoutError(f'No 200 response from {url} in {timeout}s')
+
+
+async def load(url: str, headers: dict, args: argparse.Namespace) -> dict:
+    import httpx
+
+    from client_transactions_api.config import settings
+
+    api = settings.API_PATH
+    operations, weights = zip(*WORKLOAD.items())
+    paths = {
+        'users_list': (f'{api}/users', {'limit': args.page_size}, headers['admin']),
+        'balance_read': (f'{api}/balances/my', None, headers['user']),
+        'health': (f'{api}/', None, None),
+    }
+    recorder = harness.Recorder()
+    downloaded = 0
+    limits = httpx.Limits(
+        max_connections=args.concurrency,
+        max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(
+            base_url=url, limits=limits, timeout=30,
+            headers={'Accept-Encoding': 'gzip, br'}) as client:
+
+        async def worker(deadline: float) -> None:
+            nonlocal downloaded
+            while time.perf_counter() < deadline:
+                operation = random.choices(operations, weights)[0]
+                path, params, auth = paths[operation]
+                response = await bench_request(
+                    recorder, operation,
+                    client.get(path, params=params, headers=auth))
+                if response is not None:
+                    downloaded += response.num_bytes_downloaded
+
+        recorder.started = time.perf_counter()
+        deadline = recorder.started + args.duration
+        await asyncio.gather(*[
+            worker(deadline) for _ in range(args.concurrency)])
+        recorder.stop()
+
+    return {**recorder.summary(), 'bytes_downloaded': downloaded}
+
+
+async def bench_request(recorder: harness.Recorder, operation: str, request):
+    start = time.perf_counter()
+    try:
+        response = await request
+        ok = response.status_code < 400
+    except Exception:
+        response, ok = None, False
+    recorder.record(operation, time.perf_counter() - start, ok)
+    return response
+
+
+async def run_profile(
+    name: str,
+    env: dict,
+    headers: dict,
+    args: argparse.Namespace
+) -> dict:
+    from client_transactions_api.config import settings
+
+    url = f'http://127.0.0.1:{args.port}'
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'client_transactions_api', 'serve',
+         '--host', '127.0.0.1', '--port', str(args.port)],
+        env={**os.environ, **env, 'TESTING': 'False', 'ACCESS_LOG': 'False'},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        await wait_ready(f'{url}{settings.API_PATH}/')
+        return {'settings': env, **await load(url, headers, args)}
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def run(args: argparse.Namespace) -> dict:
+    headers = await prepare(args.rows)
+    profiles = dict(
+        parse_profile(profile) for profile in args.profile or PROFILES)
+
+    results = {}
+    for name, env in profiles.items():
+        results[name] = await run_profile(name, env, headers, args)
+
+    return {
+        **harness.metadata(
+            'server',
+            duration=args.duration,
+            concurrency=args.concurrency,
+            rows=args.rows,
+            page_size=args.page_size,
+            workload=WORKLOAD),
+        'profiles': results,
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-uri', default=None)
+    parser.add_argument(
+        '--profile', action='append', metavar='NAME[=PROFILE,SETTING=VALUE]',
+        help=f'Profile to run, can be repeated, defaults to {list(PROFILES)}')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Save results as JSON')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    harness.configure(args.database_uri)
+    results = asyncio.run(run(args))
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""Startup time benchmark
+
+Measures the import time of the serving app and the time it takes a fresh
+uvicorn process to answer its first request with 200. Exits with code 1 if
+a measurement exceeds the given budget, so it can gate CI runs:
+
+    python -m benchmarks.startup --max-import 1.5 --max-first-response 3
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+IMPORT_SNIPPET = (
+    'import time; start = time.perf_counter(); '
+    'import client_transactions_api.main; '
+    'print(time.perf_counter() - start)')
+
+
+def measure_import() -> float:
+    """Import time of the app module in a fresh interpreter"""
+    output = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_SNIPPET], stderr=subprocess.DEVNULL)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def measure_first_response(
+    port: int,
+    path: str = '/api/',
+    timeout: float = 30
+) -> float:
+    """Time from spawning uvicorn to the first 200 response"""
+    url = f'http://127.0.0.1:{port}{path}'
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'client_transactions_api.main:app',
+         '--port', str(port), '--log-level', 'warning'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise TimeoutError(f'No 200 response from {url} in {timeout}s')
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-import', type=float, default=None)
+    parser.add_argument('--max-first-response', type=float, default=None)
+    parser.add_argument('--output', default=None, help='Save results as JSON')
+    args = parser.parse_args(argv)
+
+    imports = [measure_import() for _ in range(args.runs)]
+    first_responses = [
+        measure_first_response(args.port) for _ in range(args.runs)]
+
+    results = {
+        'benchmark': 'startup',
+        'runs': args.runs,
+        'import_seconds': statistics.median(imports),
+        'first_response_seconds': statistics.median(first_responses),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = False
+    if args.max_import and results['import_seconds'] > args.max_import:
+        print(f'Import time over budget of {args.max_import}s')
+        failed = True
+    if args.max_first_response and \
+            results['first_response_seconds'] > args.max_first_response:
+        print(f'First response time over budget of {args.max_first_response}s')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
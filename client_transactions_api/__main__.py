@@ -0,0 +1,4 @@
+from client_transactions_api.cli import main
+
+if __name__ == '__main__':
+    main()
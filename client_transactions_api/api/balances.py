@@ -1,14 +1,32 @@
 import logging
+from datetime import datetime, timezone
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from client_transactions_api import db, models, schemas
+from client_transactions_api import db, models, schemas, serializers
+from client_transactions_api.config import settings
+from client_transactions_api.serializers import FastJSONResponse
+from client_transactions_api.services.cache import BalanceCache
+from client_transactions_api.services.export import FORMATS, BalanceExport
+from client_transactions_api.services.holds import (capture_hold, hold_out,
+                                                    place_hold, void_hold)
+from client_transactions_api.services.idempotency import (IdempotencyStore,
+                                                          check_fingerprint,
+                                                          fingerprint)
+from client_transactions_api.services.locks import user_locks
 from client_transactions_api.services.offline import (
-    InsufficientFundsException, OfflineException, OfflineTransactions,
-    OfflineUserUnavailable)
+    InsufficientFundsException, OfflineCapacityExceeded, OfflineException,
+    OfflineTransactions, OfflineUserUnavailable, UserData)
+from client_transactions_api.services.snapshots import balance_at
+from client_transactions_api.services.stream import balance_broker, encode
+from client_transactions_api.services.transactions import (batcher, coalescer,
+                                                           transfer)
 
-from .deps import PermissionUser
+from .deps import (IdempotencyKeyHeader, PermissionActiveUser, PermissionAdmin,
+                   PermissionUser, check_currency, get_currency,
+                   get_user_database)
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -16,70 +34,651 @@ logger = logging.getLogger(__name__)
 
 @router.post(
     path='',
-    response_model=schemas.BalanceOut | schemas.OfflineBalanceOut,
-    status_code=status.HTTP_201_CREATED)
+    response_model=schemas.BalanceOut,
+    status_code=status.HTTP_201_CREATED,
+    responses={
+        status.HTTP_202_ACCEPTED: {
+            'model': schemas.OfflineBalanceAccepted,
+            'description': 'Service partially down, transaction accepted offline'}})
 async def balance_post(
     schema: schemas.BalanceIn,
-    user: models.User = Depends(PermissionUser),
-    db_session: AsyncSession = Depends(db.get_database)
+    user: schemas.TokenUser = Depends(PermissionActiveUser),
+    db_session: AsyncSession = Depends(get_user_database),
+    idempotency_key: str | None = IdempotencyKeyHeader,
 ) -> models.Balance:
-    """Add new transaction to balance with POST request"""
+    """Add new transaction to balance with POST request
 
-    if type(user) is OfflineException:
-        user_id = schema.user_id
-        logger.info('OfflineException presented')
+    Transactions go to the user's balance in the `currency` of the
+    request, which is opened by its first transaction.
+
+    Requests with an `Idempotency-Key` header are applied only once,
+    repeated requests get the stored result of the first one.
+
+    While the database is down transactions are accepted offline with
+    202 and a tracking id, see `GET /balances/offline/{tracking_id}`.
+    """
+
+    check_currency(schema.currency)
+    if schema.user_id is not None and schema.user_id != user.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail='Transactions can only be made on your own balance')
+    request_fingerprint = fingerprint(schema.dict())
+
+    # Transactions always go to the authenticated user's balance
+    if idempotency_key:
+        stored = IdempotencyStore.get(
+            user.id, idempotency_key, request_fingerprint)
+        if stored:
+            return stored.response()
+
+    result = await _online_transaction(
+        db_session, user.id, schema.value, schema.currency,
+        idempotency_key, request_fingerprint)
+    if type(result) is not OfflineException:
+        return result
+
+    logger.info('OfflineException presented')
+    return await _offline_transaction(
+        user.id, schema.value, schema.currency,
+        idempotency_key, request_fingerprint)
+
+
+async def _online_transaction(
+    db_session: AsyncSession,
+    user_id: int,
+    sum: float,
+    currency: str,
+    idempotency_key: str | None,
+    request_fingerprint: str
+) -> schemas.BalanceOut | Response | OfflineException:
+    if not idempotency_key:
+        # Transactions of all users are written in group commits
+        if settings.BATCH_WRITES:
+            balance = await batcher.transaction(
+                user_id=user_id, sum=sum, currency=currency)
+        # Concurrent transactions of the user are combined into one update
+        else:
+            balance = await coalescer.transaction(
+                db_session, user_id=user_id, sum=sum, currency=currency)
+        if type(balance) is OfflineException:
+            return balance
+        return FastJSONResponse(
+            serializers.balance(balance),
+            status_code=status.HTTP_201_CREATED)
+
+    stored = await models.IdempotencyKey.lookup(
+        db_session, user_id, idempotency_key)
+    if type(stored) is OfflineException:
+        return stored
+    if stored is not None:
+        check_fingerprint(
+            idempotency_key, stored.fingerprint, request_fingerprint)
+        if stored.response is None:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"A request with Idempotency-Key '{idempotency_key}' is already being processed")
+        return IdempotencyStore.add(
+            user_id, idempotency_key, stored.fingerprint,
+            status_code=stored.status_code,
+            body=stored.response,
+            persisted=True).response()
+
+    # Idempotent transactions are not coalesced, since their key
+    # reservation is committed together with their own transaction
+    async with user_locks.lock(user_id):
+        # Check if there are any Offline transactions to run
+        # Before running online transactions
+        offline = OfflineTransactions.instance()
+        gathered = await offline.gather(db_session, user_id)
+        if type(gathered) is OfflineException:
+            return gathered
+
+        # Add User's balance to Offline Transactions pool
+        balance = await models.Balance.get_or_create(
+            db_session, user_id=user_id, currency=currency)
+        if type(balance) is OfflineException:
+            return balance
+        offline.add_balance(
+            user_id, currency, balance.value, balance.held)
 
-        # Carry out transaction
-        offline_balance = OfflineTransactions.instance().transaction(user_id, schema.value)
+        reserved = await models.IdempotencyKey.reserve(
+            db_session, user_id, idempotency_key, request_fingerprint,
+            ttl=settings.IDEMPOTENCY_TTL)
+        if type(reserved) is OfflineException:
+            return reserved
+        balance = await models.Balance.transaction(
+            db_session, user_id=user_id, currency=currency, sum=sum,
+            commit=False)
+        if type(balance) is OfflineException:
+            return balance
+
+        # The response is committed together with the balance change, a
+        # retry never finds the key reserved without its response
+        body = serializers.dumps(serializers.balance(balance)).decode()
+        reserved = await reserved.update(
+            db_session, status_code=status.HTTP_201_CREATED, response=body)
+        if type(reserved) is OfflineException:
+            return reserved
+        BalanceCache.write(balance)
+        offline.add_balance(
+            user_id, currency, balance.value, balance.held)
+
+    IdempotencyStore.add(
+        user_id, idempotency_key, request_fingerprint,
+        status_code=status.HTTP_201_CREATED,
+        body=body,
+        persisted=True)
+    return Response(
+        content=body,
+        status_code=status.HTTP_201_CREATED,
+        media_type='application/json')
+
+
+async def _offline_transaction(
+    user_id: int,
+    sum: float,
+    currency: str,
+    idempotency_key: str | None,
+    request_fingerprint: str
+) -> Response:
+    # Carry out transaction, after any in-flight online transaction
+    # of the user has updated the offline balance
+    async with user_locks.lock(user_id):
+        offline_balance = OfflineTransactions.instance().transaction(
+            user_id, sum, currency)
         if type(offline_balance) == OfflineUserUnavailable:
             raise HTTPException(
                 status_code=status.HTTP_206_PARTIAL_CONTENT,
                 detail='Service down. User not available for offline processing')
+        if type(offline_balance) == OfflineCapacityExceeded:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Service down. Too many offline transactions pending')
         if type(offline_balance) == InsufficientFundsException:
             offline_msg = schemas.OfflineBalanceOut(
-                user_id=schema.user_id,
+                user_id=user_id,
                 value=offline_balance.sum,
+                currency=currency,
                 balance=offline_balance.balance,
                 message=offline_balance.message
             ).dict()
             raise HTTPException(
                 status_code=status.HTTP_402_PAYMENT_REQUIRED,
                 detail=offline_msg)
+        tracked = OfflineTransactions.track(user_id, sum, currency)
+        balance_broker.publish(
+            user_id, 'offline', _stale_balance(
+                user_id, currency,
+                OfflineTransactions.get_user_data(user_id)))
+
+    body = schemas.OfflineBalanceAccepted(
+        user_id=user_id,
+        value=sum,
+        currency=currency,
+        balance=offline_balance,
+        tracking_id=tracked.tracking_id).json()
+    if idempotency_key:
+        IdempotencyStore.add(
+            user_id, idempotency_key, request_fingerprint,
+            status_code=status.HTTP_202_ACCEPTED,
+            body=body)
+    return Response(
+        content=body,
+        status_code=status.HTTP_202_ACCEPTED,
+        media_type='application/json')
+
+
+@router.post(
+    path='/transfer',
+    response_model=schemas.TransferOut,
+    status_code=status.HTTP_201_CREATED)
+async def balance_transfer(
+    schema: schemas.TransferIn,
+    user: schemas.TokenUser = Depends(PermissionActiveUser),
+    db_session: AsyncSession = Depends(get_user_database),
+) -> Response:
+    """Transfer funds from user's balance to another user's balance
+
+    The sum moves between the users' balances in the transfer's
+    `currency`. Both balances and both ledger entries are written in one
+    DB transaction when both users are on the same shard. A recipient of
+    another shard is credited on their shard once the user is debited.
+    Transfers are not accepted while the database is down.
+    """
+
+    check_currency(schema.currency)
+    if schema.recipient_id == user.id:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail='Can not transfer funds to yourself')
+
+    if db.shard_for(schema.recipient_id) is db.shard_for(user.id):
+        recipient = await models.User.get(db_session, id=schema.recipient_id)
+    else:
+        async with db.session(db.shard_for(schema.recipient_id)) \
+                as recipient_session:
+            recipient = await models.User.get(
+                recipient_session, id=schema.recipient_id)
+    if type(recipient) is not OfflineException:
+        result = await transfer(
+            db_session, user.id, schema.recipient_id, schema.value,
+            schema.currency)
+    else:
+        result = recipient
+    if type(result) is OfflineException:
+        logger.info('OfflineException presented')
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Service down. Transfers are not available offline')
+
+    return FastJSONResponse(
+        result.dict(), status_code=status.HTTP_201_CREATED)
+
+
+@router.post(
+    path='/holds',
+    response_model=schemas.HoldOut,
+    status_code=status.HTTP_201_CREATED)
+async def hold_post(
+    schema: schemas.HoldIn,
+    user: schemas.TokenUser = Depends(PermissionActiveUser),
+    db_session: AsyncSession = Depends(get_user_database),
+) -> Response:
+    """Reserve funds of user's balance for a later debit
+
+    The sum stays part of the balance but is not available for debits,
+    transfers or other holds until the hold is captured, voided, or
+    expires after `ttl` seconds. Funds are checked and held by a single
+    conditional update of the balance. Holds are not accepted while the
+    database is down.
+    """
+
+    check_currency(schema.currency)
+    result = await place_hold(
+        db_session, user.id, schema.value, schema.currency,
+        ttl=schema.ttl or settings.HOLD_TTL)
+    if type(result) is OfflineException:
+        logger.info('OfflineException presented')
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Service down. Holds are not available offline')
+    return FastJSONResponse(
+        result.dict(), status_code=status.HTTP_201_CREATED)
+
+
+@router.get(
+    path='/holds/{hold_id}',
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.HoldOut)
+async def hold_get(
+    hold_id: int,
+    user: schemas.TokenUser = Depends(PermissionUser),
+    db_session: AsyncSession = Depends(get_user_database),
+) -> schemas.HoldOut:
+    """Retrieve user's hold"""
+
+    hold = await models.Hold.get(db_session, raise_404=False, id=hold_id)
+    if type(hold) is OfflineException:
+        logger.info('OfflineException presented')
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Service down. Holds are not available offline')
+    if hold is None or hold.user_id != user.id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f'Hold {hold_id} not found')
+    return hold_out(hold)
+
+
+@router.post(
+    path='/holds/{hold_id}/capture',
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.HoldOut)
+async def hold_capture(
+    hold_id: int,
+    schema: schemas.HoldCaptureIn | None = None,
+    user: schemas.TokenUser = Depends(PermissionActiveUser),
+    db_session: AsyncSession = Depends(get_user_database),
+) -> schemas.HoldOut:
+    """Debit user's open hold, all of it unless a smaller `value` is given
+
+    The rest of the hold is released. The debit, the release and its
+    ledger entry are written in one DB transaction. Expired, captured
+    and voided holds get 409.
+    """
 
-        offline_msg = schemas.OfflineBalanceOut(
-            **schema.dict(), balance=offline_balance).dict()
+    result = await capture_hold(
+        db_session, user.id, hold_id, schema.value if schema else None)
+    if type(result) is OfflineException:
+        logger.info('OfflineException presented')
         raise HTTPException(
-            status_code=status.HTTP_201_CREATED,
-            detail=offline_msg)
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Service down. Holds are not available offline')
+    return result
 
-    # Check if there are any Offline transactions to run
-    # Before running online transactions
-    offline = OfflineTransactions.instance()
-    await offline.gather(db_session, user.id)
 
-    # Add User's balance to Offline Transactions pool
-    balance = await models.Balance.get_or_create(db_session, user_id=user.id)
-    offline.add_balance(user.id, balance.value)
+@router.post(
+    path='/holds/{hold_id}/void',
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.HoldOut)
+async def hold_void(
+    hold_id: int,
+    user: schemas.TokenUser = Depends(PermissionActiveUser),
+    db_session: AsyncSession = Depends(get_user_database),
+) -> schemas.HoldOut:
+    """Release all of user's open hold
 
-    return await models.Balance.transaction(db_session, user_id=user.id, sum=schema.value)
+    Captured and voided holds get 409.
+    """
+
+    result = await void_hold(db_session, user.id, hold_id)
+    if type(result) is OfflineException:
+        logger.info('OfflineException presented')
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Service down. Holds are not available offline')
+    return result
 
 
 @router.get(
     path='/my',
     status_code=status.HTTP_200_OK,
-    response_model=schemas.BalanceOut)
+    response_model=schemas.BalanceOut,
+    responses={
+        status.HTTP_203_NON_AUTHORITATIVE_INFORMATION: {
+            'model': schemas.StaleBalanceOut,
+            'description': 'Service partially down, balance served from offline cache'}})
 async def balance_get(
-    user: models.User = Depends(PermissionUser),
-    db_session: AsyncSession = Depends(db.get_database),
+    currency: str = Depends(get_currency),
+    user: schemas.TokenUser = Depends(PermissionUser),
+    db_session: AsyncSession = Depends(get_user_database),
 ) -> models.Balance:
-    """Retrieve user's Balance with GET request"""
+    """Retrieve user's Balance in a currency with GET request
+
+    While the database is down the last known balance, including
+    transactions accepted offline, is returned with 203 and flagged stale.
+    """
 
-    if type(user) is OfflineException:
+    # Cached balances are updated by every write of this worker, users
+    # with offline transactions pending sync always go to the DB
+    if not OfflineTransactions.is_pending(user.id):
+        cached = BalanceCache.get(user.id, currency)
+        if cached is not None:
+            return FastJSONResponse(cached)
+
+    # Sync offline transactions first, so that the offline balance is not
+    # overwritten with a DB value that does not include them yet
+    async with user_locks.lock(user.id):
+        offline = OfflineTransactions.instance()
+        balance = await offline.gather(db_session, user.id)
+        if type(balance) is not OfflineException:
+            balance = await models.Balance.get_or_create(
+                db_session, user_id=user.id, currency=currency)
+        if type(balance) is not OfflineException:
+            offline.add_balance(
+                user.id, currency, balance.value, balance.held)
+            BalanceCache.set(balance)
+            return FastJSONResponse(serializers.balance(balance))
+
+    logger.info('OfflineException presented')
+    user_data = OfflineTransactions.get_user_data(user.id)
+    if type(user_data) is OfflineUserUnavailable or currency not in user_data:
         raise HTTPException(
             status_code=status.HTTP_206_PARTIAL_CONTENT,
             detail='Service down. User not available for offline processing')
+    body = _stale_balance(user.id, currency, user_data)
+    return FastJSONResponse(
+        body,
+        status_code=status.HTTP_203_NON_AUTHORITATIVE_INFORMATION,
+        headers={'Age': str(int(body['age']))})
+
+
+@router.get(
+    path='/my/all',
+    status_code=status.HTTP_200_OK,
+    response_model=list[schemas.BalanceOut],
+    responses={
+        status.HTTP_203_NON_AUTHORITATIVE_INFORMATION: {
+            'model': list[schemas.StaleBalanceOut],
+            'description': 'Service partially down, balances served from offline cache'}})
+async def balance_get_all(
+    user: schemas.TokenUser = Depends(PermissionUser),
+    db_session: AsyncSession = Depends(get_user_database),
+) -> list[models.Balance]:
+    """Retrieve user's Balances in all currencies with GET request
+
+    While the database is down the last known balances seen by the
+    worker are returned with 203 and flagged stale.
+    """
+
+    async with user_locks.lock(user.id):
+        offline = OfflineTransactions.instance()
+        balances = await offline.gather(db_session, user.id)
+        if type(balances) is not OfflineException:
+            balances = await models.Balance.get_all(db_session, user.id)
+        if type(balances) is not OfflineException:
+            for balance in balances:
+                offline.add_balance(
+                    user.id, balance.currency, balance.value, balance.held)
+                BalanceCache.set(balance)
+            return FastJSONResponse(serializers.balance.many(balances))
+
+    logger.info('OfflineException presented')
+    user_data = OfflineTransactions.get_user_data(user.id)
+    if type(user_data) is OfflineUserUnavailable:
+        raise HTTPException(
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            detail='Service down. User not available for offline processing')
+    return FastJSONResponse(
+        [_stale_balance(user.id, currency, user_data)
+         for currency in sorted(user_data.currencies)],
+        status_code=status.HTTP_203_NON_AUTHORITATIVE_INFORMATION)
+
+
+def _stale_balance(user_id: int, currency: str, user_data: UserData) -> dict:
+    """Last known balance of a user, including offline transactions"""
+    synced_at = user_data.synced_at(currency)
+    age = (datetime.utcnow() - synced_at).total_seconds()
+    return schemas.StaleBalanceOut(
+        user_id=user_id,
+        value=user_data.balance(currency),
+        currency=currency,
+        synced_at=synced_at,
+        age=round(age, 3),
+        pending=user_data.pending(currency),
+        held=user_data.held(currency)).dict()
+
 
-    balance = await models.Balance.get_or_create(db_session, user_id=user.id)
-    OfflineTransactions.instance().add_balance(user.id, balance.value)
+@router.get(
+    path='/my/at',
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.BalanceAtOut)
+async def balance_get_at(
+    ts: datetime = Query(
+        ..., description='Point in time, UTC unless it has an offset'),
+    currency: str = Depends(get_currency),
+    user: schemas.TokenUser = Depends(PermissionUser),
+    db_session: AsyncSession = Depends(get_user_database),
+) -> dict:
+    """Retrieve user's Balance in a currency at a point in time
+
+    Computed from the nearest daily snapshot and the ledger entries
+    since then, available from the first snapshot on.
+    """
+
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    if ts > datetime.utcnow():
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail='Balance can not be retrieved for a future time')
 
+    balance = await balance_at(db_session, user.id, ts, currency)
+    if type(balance) is OfflineException:
+        logger.info('OfflineException presented')
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Service down. Balance history is not available offline')
     return balance
+
+
+@router.get(
+    path='/my/stream',
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_200_OK: {
+            'content': {'text/event-stream': {}},
+            'description': 'Server-sent events of the balance'}})
+async def balance_stream(
+    currency: str = Depends(get_currency),
+    user: schemas.TokenUser = Depends(PermissionUser),
+) -> StreamingResponse:
+    """Stream changes of user's Balance in a currency as server-sent events
+
+    The current balance is sent first, then a `balance` event with
+    `BalanceOut` data after every change, or an `offline` event with
+    `StaleBalanceOut` data after a transaction accepted offline. Idle
+    streams get a heartbeat comment. Clients that fall behind are
+    disconnected and should reconnect.
+    """
+
+    # Subscribe first, changes made while the balance is read are queued
+    subscription = balance_broker.subscribe(user.id, currency)
+    if subscription is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Too many balance streams, try again later',
+            headers={'Retry-After': '5'})
+    try:
+        first = await _stream_snapshot(user.id, currency)
+    except BaseException:
+        balance_broker.unsubscribe(subscription)
+        raise
+
+    return StreamingResponse(
+        balance_broker.events(
+            subscription, first, heartbeat=settings.STREAM_HEARTBEAT),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def _stream_snapshot(user_id: int, currency: str) -> bytes | None:
+    """First event of a balance stream, without holding a DB session"""
+
+    if not OfflineTransactions.is_pending(user_id):
+        cached = BalanceCache.get(user_id, currency)
+        if cached is not None:
+            return encode('balance', cached)
+        async with db.shard_for(user_id).Session() as db_session:
+            balance = await models.Balance.get_or_create(
+                db_session, user_id=user_id, currency=currency)
+        if type(balance) is not OfflineException:
+            OfflineTransactions.add_balance(
+                user_id, currency, balance.value, balance.held)
+            BalanceCache.set(balance)
+            return encode('balance', serializers.balance(balance))
+
+    user_data = OfflineTransactions.get_user_data(user_id)
+    if type(user_data) is OfflineUserUnavailable or currency not in user_data:
+        return None
+    return encode('offline', _stale_balance(user_id, currency, user_data))
+
+
+@router.get(
+    path='/cache',
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.BalanceCacheStats)
+async def balance_cache_stats(
+    user: schemas.TokenUser = Depends(PermissionAdmin),
+) -> dict:
+    """Retrieve balance read cache metrics of the worker"""
+
+    return BalanceCache.stats()
+
+
+@router.get(
+    path='/streams',
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.BalanceStreamStats)
+async def balance_stream_stats(
+    user: schemas.TokenUser = Depends(PermissionAdmin),
+) -> dict:
+    """Retrieve balance stream metrics of the worker"""
+
+    return balance_broker.stats()
+
+
+@router.get(
+    path='/export',
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_200_OK: {
+            'content': {media_type: {} for media_type in FORMATS.values()},
+            'description': 'All balances of all shards, in user id and currency order'}})
+async def balance_export(
+    format: str = Query('csv', regex=f"^({'|'.join(FORMATS)})$"),
+    ledger: bool = Query(
+        False, description="Add each balance's ledger entry count and sum"),
+    snapshot: bool = Query(
+        True, description='Read all rows as of the start of the export'),
+    rate: float | None = Query(
+        None, ge=0, description='Max rows per second, 0 for no limit, '
+        'defaults to the EXPORT_RATE setting'),
+    user: schemas.TokenUser = Depends(PermissionAdmin),
+) -> StreamingResponse:
+    """Export all balances as CSV or NDJSON for reconciliation
+
+    Rows are streamed from a server-side cursor, the response is never
+    held in memory. Exports are paced to `rate` rows per second so that
+    they can run alongside live traffic.
+    """
+
+    export = BalanceExport(
+        [shard.engine for shard in db.shards],
+        format=format,
+        ledger=ledger,
+        snapshot=snapshot,
+        batch_size=settings.EXPORT_BATCH_SIZE,
+        rows_per_second=settings.EXPORT_RATE if rate is None else rate)
+    if type(await export.open()) is OfflineException:
+        logger.info('OfflineException presented')
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Service down. Export is not available offline')
+
+    filename = f"balances-{export.exported_at:%Y%m%dT%H%M%S}.{format}"
+    return StreamingResponse(
+        export.stream(),
+        media_type=export.media_type,
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'X-Exported-At': export.exported_at.isoformat()})
+
+
+@router.get(
+    path='/offline/{tracking_id}',
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.OfflineTransactionStatus)
+async def offline_transaction_get(
+    tracking_id: str,
+    user: schemas.TokenUser = Depends(PermissionUser),
+) -> schemas.OfflineTransactionStatus:
+    """Retrieve reconciliation status of a transaction accepted offline"""
+
+    transaction = OfflineTransactions.get_tracked(tracking_id)
+    if transaction is None or transaction.user_id != user.id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f'Offline transaction {tracking_id} not found')
+
+    return schemas.OfflineTransactionStatus(
+        tracking_id=transaction.tracking_id,
+        user_id=transaction.user_id,
+        value=transaction.sum,
+        currency=transaction.currency,
+        status=transaction.status,
+        accepted_at=transaction.accepted_at,
+        reconciled_at=transaction.reconciled_at)
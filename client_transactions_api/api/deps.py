@@ -1,11 +1,12 @@
 import logging
 
-from fastapi import Depends, HTTPException, Query, status
+from fastapi import Depends, Header, HTTPException, Query, Request, status
 from jose import JWTError, jwt
 from pydantic import ValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from client_transactions_api import db, models, schemas
+from client_transactions_api.config import settings
 from client_transactions_api.services.auth import auth_service
 from client_transactions_api.services.offline import OfflineException
 
@@ -27,12 +28,51 @@ FilterQuery = Query(
     title='Filter by column'
 )
 
+CurrencyQuery = Query(
+    default=None,
+    min_length=3,
+    max_length=3,
+    description='ISO 4217 code of the balance, defaults to the '
+    'DEFAULT_CURRENCY setting',
+)
+
+IdempotencyKeyHeader = Header(
+    default=None,
+    alias='Idempotency-Key',
+    max_length=64,
+    description='Unique client generated key, '
+    'requests repeated with the same key are applied only once',
+)
+
+
+def check_currency(currency: str) -> str:
+    """Check that balances can be held in a currency"""
+
+    if currency not in settings.CURRENCY_CODES:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Currency '{currency}' is not supported, use one of "
+            f"{', '.join(settings.CURRENCY_CODES)}")
+    return currency
+
+
+async def get_currency(currency: str | None = CurrencyQuery) -> str:
+    """Currency of the query, the default one if not given"""
+
+    return check_currency(
+        currency.upper() if currency else settings.DEFAULT_CURRENCY)
+
 
 async def get_auth_user(
-    db_session: AsyncSession = Depends(db.get_database),
+    request: Request,
     token: str = Depends(auth_service.oauth2_scheme)
-) -> models.User | OfflineException:
-    """Get user object based on provided credentials"""
+) -> schemas.TokenUser:
+    """Get user identity based on provided credentials
+
+    Identity and permissions come from the token claims, so that users
+    are authorized without a DB lookup, online and offline. Claims decoded
+    by the rate limiter are taken from the request state.
+    """
 
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -40,37 +80,67 @@ async def get_auth_user(
         headers={'WWW-Authenticate': 'Bearer'})
 
     try:
-        payload = jwt.decode(
-            token, auth_service.SECRET_KEY,
-            algorithms=[auth_service.CRYPT_ALGORITHM])
+        decoded, payload = getattr(
+            request.state, 'token_claims', (None, None))
+        if decoded != token:
+            payload = jwt.decode(
+                token, auth_service.SECRET_KEY,
+                algorithms=[auth_service.CRYPT_ALGORITHM])
         username = payload.get('sub')
         if username is None:
             raise credentials_exception
+        if 'uid' in payload:
+            return schemas.TokenUser(
+                username=username,
+                id=payload['uid'],
+                is_active=payload.get('active', False),
+                is_admin=payload.get('admin', False))
         token_data = schemas.TokenData(username=username)
     except (JWTError, ValidationError):
         raise credentials_exception
 
-    user = await auth_service.get_user(
-        db_session=db_session,
-        username=token_data.username)
+    # Tokens issued before user id claims were added
+    async with db.shard_for_username(token_data.username).Session() \
+            as db_session:
+        user = await auth_service.get_user(
+            db_session=db_session,
+            username=token_data.username)
     if type(user) is OfflineException:
         logger.info('OfflineException return')
-        return user
+        raise HTTPException(
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            detail='Service down. User not available for offline processing')
     if user is None:
         raise HTTPException(
             status_code=404, detail=f"User '{token_data.username}' not found")
-    return user
+    return schemas.TokenUser(
+        username=user.username,
+        id=user.id,
+        is_active=user.is_active,
+        is_admin=user.is_admin)
+
+
+async def get_user_database(
+    current_user: schemas.TokenUser = Depends(get_auth_user)
+) -> AsyncSession:
+    """Session of the authenticated user's shard"""
+
+    async with db.session(db.shard_for(current_user.id)) as db_session:
+        yield db_session
+
+
+async def get_username_database(username: str) -> AsyncSession:
+    """Session of the shard of the user in the path"""
+
+    async with db.session(db.shard_for_username(username)) as db_session:
+        yield db_session
 
 
 async def PermissionUser(
-    current_user: models.User | OfflineException = Depends(get_auth_user)
-) -> models.User | OfflineException:
+    current_user: schemas.TokenUser = Depends(get_auth_user)
+) -> schemas.TokenUser:
     """Check if user is active"""
 
-    if type(current_user) is OfflineException:
-        logger.info('OfflineException return')
-        return current_user
-
     if current_user.is_active is False:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -78,15 +148,29 @@ async def PermissionUser(
     return current_user
 
 
+async def PermissionActiveUser(
+    current_user: schemas.TokenUser = Depends(PermissionUser)
+) -> schemas.TokenUser:
+    """Check that user is still active, for requests moving money
+
+    Token claims hold until the token expires, so the user is looked up
+    again: a user deactivated since they logged in is refused. While the
+    database is down the claims are all there is.
+    """
+
+    is_active = await auth_service.is_active(current_user.id)
+    if is_active is False:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail='Inactive user')
+    return current_user
+
+
 async def PermissionAdmin(
-    current_user: models.User | OfflineException = Depends(get_auth_user),
-) -> models.User | OfflineException:
+    current_user: schemas.TokenUser = Depends(get_auth_user),
+) -> schemas.TokenUser:
     """Check for superuser permissions"""
 
-    if type(current_user) is OfflineException:
-        logger.info('OfflineException return')
-        return current_user
-
     if not current_user.is_admin:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -1,9 +1,15 @@
 from datetime import datetime
 
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Depends, Request, status
 
 from client_transactions_api import __version__ as version
+from client_transactions_api import schemas
 from client_transactions_api.config import settings
+from client_transactions_api.services.limits import (admission, auth_limiter,
+                                                     transaction_limiter)
+from client_transactions_api.services.outbox import dispatcher
+
+from .deps import PermissionAdmin
 
 router = APIRouter()
 
@@ -20,3 +26,31 @@ async def health_check(request: Request):
         'time': datetime.utcnow().isoformat()
     }
     return response
+
+
+@router.get(
+    path='/limits',
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.LimitsStats)
+async def limits_stats(
+    user: schemas.TokenUser = Depends(PermissionAdmin),
+) -> dict:
+    """Retrieve rate limit and admission control metrics of the worker"""
+
+    return {
+        'admission': admission.stats(),
+        'transactions': transaction_limiter.stats(),
+        'auth': auth_limiter.stats(),
+    }
+
+
+@router.get(
+    path='/outbox',
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.OutboxStats)
+async def outbox_stats(
+    user: schemas.TokenUser = Depends(PermissionAdmin),
+) -> dict:
+    """Retrieve balance event delivery metrics of the worker"""
+
+    return dispatcher.stats()
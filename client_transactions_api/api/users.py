@@ -1,20 +1,27 @@
-from typing import Optional
+from typing import Any, Optional
 
-from fastapi import APIRouter, Depends, status
-from fastapi_pagination import LimitOffsetPage, add_pagination
+from fastapi import APIRouter, Depends, Query, status
+from fastapi_pagination import LimitOffsetPage, add_pagination, set_page
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from client_transactions_api import db, models, schemas
+from client_transactions_api import db, models, schemas, serializers
+from client_transactions_api.config import settings
+from client_transactions_api.serializers import FastJSONResponse
+from client_transactions_api.services.auth import password_hasher
+from client_transactions_api.services.offline import OfflineException
 
 from .deps import (FilterQuery, PermissionAdmin, PermissionUser,
-                   SortByDescQuery, SortByQuery)
+                   SortByDescQuery, SortByQuery, get_username_database)
 
 router = APIRouter()
 
+UsersPage = LimitOffsetPage.with_custom_options(
+    limit=Query(50, ge=1, le=1000, description='Page size limit'))
+
 
 @router.get(path='/me', response_model=schemas.User)
 async def user_info(
-    user: models.User = Depends(PermissionUser)
+    user: schemas.TokenUser = Depends(PermissionUser)
 ):
     """Get user info"""
 
@@ -27,8 +34,8 @@ async def user_info(
     response_model=schemas.User)
 async def user_get(
     username: str,
-    user: models.User = Depends(PermissionAdmin),
-    db_session: AsyncSession = Depends(db.get_database),
+    user: schemas.TokenUser = Depends(PermissionAdmin),
+    db_session: AsyncSession = Depends(get_username_database),
 ) -> models.User:
     """Retrieve user with GET request"""
 
@@ -41,8 +48,8 @@ async def user_get(
     status_code=status.HTTP_204_NO_CONTENT)
 async def user_delete(
     username: str,
-    user: models.User = Depends(PermissionAdmin),
-    db_session: AsyncSession = Depends(db.get_database),
+    user: schemas.TokenUser = Depends(PermissionAdmin),
+    db_session: AsyncSession = Depends(get_username_database),
 ) -> models.User:
     """Delete user with DELETE request"""
 
@@ -57,8 +64,8 @@ async def user_delete(
 async def user_patch(
     username: str,
     schema: schemas.UserUpdate,
-    user: models.User = Depends(PermissionAdmin),
-    db_session: AsyncSession = Depends(db.get_database),
+    user: schemas.TokenUser = Depends(PermissionAdmin),
+    db_session: AsyncSession = Depends(get_username_database),
 ) -> models.User:
     """Modify user with PATCH request"""
 
@@ -69,23 +76,63 @@ async def user_patch(
 @router.get(
     path='',
     status_code=status.HTTP_200_OK,
-    response_model=LimitOffsetPage[schemas.User])
+    response_model=UsersPage[schemas.User])
 async def users_list(
-    user: models.User = Depends(PermissionAdmin),
-    db_session: AsyncSession = Depends(db.get_database),
+    user: schemas.TokenUser = Depends(PermissionAdmin),
     sort_by: Optional[str] = SortByQuery,
     desc: Optional[bool] = SortByDescQuery,
     is_active: Optional[bool] = FilterQuery,
     is_admin: Optional[bool] = FilterQuery,
 ):
-    """List users with GET request"""
-
-    return await models.User.paginate(
-        db_session,
-        desc=desc,
-        sort_by=sort_by,
-        is_active=is_active,
-        is_admin=is_admin,
-    )
+    """List users with GET request
+
+    Users of all shards are merged in sort order.
+    """
+
+    # Rows are serialized directly, instead of being validated
+    # into schemas.User for the page and again for the response
+    async with db.sessions() as db_sessions:
+        with set_page(UsersPage[Any]):
+            page = await models.User.paginate_shards(
+                db_sessions,
+                desc=desc,
+                sort_by=sort_by,
+                is_active=is_active,
+                is_admin=is_admin,
+            )
+    if type(page) is OfflineException:
+        return page
+    return FastJSONResponse(serializers.page(page, serializers.user))
+
+
+@router.post(
+    path='/bulk',
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.UsersImportOut)
+async def users_import(
+    schema: schemas.UsersImportIn,
+    user: schemas.TokenUser = Depends(PermissionAdmin),
+):
+    """Register users in bulk with POST request
+
+    Passwords are hashed in a process pool across all cores. Every user
+    gets an outcome, users that could not be created do not fail the
+    request. Use `python -m client_transactions_api import-users` for
+    imports larger than one request.
+    """
+
+    # Cold path, kept out of the serving import
+    from client_transactions_api.services.provisioning import \
+        import_users_by_shard
+
+    results = await import_users_by_shard(
+        schema.users, password_hasher,
+        chunk_size=settings.USERS_IMPORT_CHUNK)
+    created = sum(result['status'] == 'created' for result in results)
+    return FastJSONResponse({
+        'created': created,
+        'rejected': len(results) - created,
+        'results': results,
+    })
 
 add_pagination(router)
@@ -0,0 +1,286 @@
+"""Cold path commands, kept out of the API workers' startup
+
+    python -m client_transactions_api migrate
+    python -m client_transactions_api create-superuser
+    python -m client_transactions_api openapi --output openapi.json
+    python -m client_transactions_api serve
+    python -m client_transactions_api import-users users.csv
+    python -m client_transactions_api export-balances --output balances.csv
+    python -m client_transactions_api maintain-ledger
+    python -m client_transactions_api snapshot-balances --since 2022-11-01
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+
+
+async def migrate(args: argparse.Namespace) -> None:
+    """Apply pending database migrations to every shard"""
+
+    from client_transactions_api import db, migrations
+
+    for shard in db.shards:
+        await migrations.run_migrations(shard.engine)
+        await migrations.configure_shard(
+            shard.engine, shard.index, len(db.shards))
+
+
+async def create_superuser(args: argparse.Namespace) -> None:
+    """Create first superuser from settings if it does not exist"""
+
+    from client_transactions_api.config import settings
+    from client_transactions_api.utils import create_superuser
+
+    username = args.username or settings.FIRST_SUPERUSER
+    password = args.password or \
+        settings.FIRST_SUPERUSER_PASSWORD.get_secret_value()
+    if not username:
+        logging.warning('No superuser username provided, skipping')
+        return
+    await create_superuser(username=username, password=password)
+
+
+async def openapi(args: argparse.Namespace) -> None:
+    """Export OpenAPI schema, i.e. to serve docs without the API workers"""
+
+    from client_transactions_api.main import app
+
+    schema = json.dumps(app.openapi(), separators=(',', ':'))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(schema)
+        logging.info(f'Saved OpenAPI schema to {args.output}')
+    else:
+        sys.stdout.write(schema)
+
+
+def read_users(path: str) -> list:
+    """Read users from a CSV file with a header, or a JSON lines file"""
+
+    import csv
+
+    from client_transactions_api import schemas
+
+    with open(path, newline='') as f:
+        if path.endswith(('.jsonl', '.ndjson')):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+    return [schemas.UserLogin(username=row['username'],
+                              password=row['password']) for row in rows]
+
+
+async def import_users(args: argparse.Namespace) -> None:
+    """Register users in bulk from a file"""
+
+    from client_transactions_api.config import settings
+    from client_transactions_api.services import provisioning
+    from client_transactions_api.services.hashing import PasswordHasher
+
+    users = read_users(args.file)
+    logging.info(f'Importing {len(users)} users from {args.file}')
+    hasher = PasswordHasher(workers=args.workers or settings.HASH_WORKERS)
+    try:
+        results = await provisioning.import_users_by_shard(
+            users, hasher,
+            chunk_size=args.chunk_size or settings.USERS_IMPORT_CHUNK)
+    finally:
+        hasher.shutdown()
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for result in results:
+            output.write(json.dumps(result) + '\n')
+    finally:
+        if args.output:
+            output.close()
+
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    logging.info(f'Imported users: {statuses}')
+
+
+async def export_balances(args: argparse.Namespace) -> None:
+    """Export all balances for reconciliation"""
+
+    from client_transactions_api import db
+    from client_transactions_api.config import settings
+    from client_transactions_api.services.export import BalanceExport
+    from client_transactions_api.services.offline import OfflineException
+
+    export = BalanceExport(
+        [shard.engine for shard in db.shards],
+        format=args.format,
+        ledger=args.ledger,
+        snapshot=not args.no_snapshot,
+        batch_size=settings.EXPORT_BATCH_SIZE,
+        rows_per_second=settings.EXPORT_RATE if args.rate is None
+        else args.rate)
+    if type(await export.open()) is OfflineException:
+        logging.error('Database is not available')
+        sys.exit(1)
+
+    output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        async for chunk in export.stream():
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+    logging.info(f'Exported {export.rows} balances as of '
+                 f'{export.exported_at.isoformat()}')
+
+
+async def maintain_ledger(args: argparse.Namespace) -> None:
+    """Create ledger partitions ahead and archive expired ones"""
+
+    from client_transactions_api import db
+    from client_transactions_api.config import settings
+    from client_transactions_api.services.ledger import LedgerMaintenance
+    from client_transactions_api.services.offline import OfflineException
+
+    maintenance = LedgerMaintenance(
+        months_ahead=settings.LEDGER_PARTITIONS_AHEAD if args.ahead is None
+        else args.ahead,
+        retention_months=settings.LEDGER_RETENTION_MONTHS
+        if args.retention is None else args.retention,
+        archive=args.archive or settings.LEDGER_ARCHIVE)
+    for shard in db.shards:
+        results = await maintenance.for_shard(shard).maintain()
+        if type(results) is OfflineException:
+            logging.error(f'Database of shard {shard.index} is not available')
+            sys.exit(1)
+        logging.info(f'Ledger maintenance of shard {shard.index}: {results}')
+
+
+async def snapshot_balances(args: argparse.Namespace) -> None:
+    """Take daily balance snapshots that are due"""
+
+    from datetime import datetime
+
+    from client_transactions_api import db
+    from client_transactions_api.config import settings
+    from client_transactions_api.services.offline import OfflineException
+    from client_transactions_api.services.snapshots import BalanceSnapshotJob
+
+    job = BalanceSnapshotJob(delay=settings.SNAPSHOT_DELAY)
+    for shard in db.shards:
+        taken = await job.for_shard(shard).snapshot(
+            start=datetime.fromisoformat(args.since) if args.since else None)
+        if type(taken) is OfflineException:
+            logging.error(f'Database of shard {shard.index} is not available')
+            sys.exit(1)
+        logging.info(
+            f'Took {len(taken)} balance snapshots of shard {shard.index}')
+
+
+def serve(args: argparse.Namespace) -> None:
+    """Serve the API with the server profile from settings"""
+
+    from client_transactions_api import server
+
+    server.run(host=args.host, port=args.port)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='client_transactions_api')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_migrate = commands.add_parser('migrate', help=migrate.__doc__)
+    parser_migrate.set_defaults(func=migrate)
+
+    parser_superuser = commands.add_parser(
+        'create-superuser', help=create_superuser.__doc__)
+    parser_superuser.add_argument('--username', default=None)
+    parser_superuser.add_argument('--password', default=None)
+    parser_superuser.set_defaults(func=create_superuser)
+
+    parser_openapi = commands.add_parser('openapi', help=openapi.__doc__)
+    parser_openapi.add_argument(
+        '--output', default=None, help='File to save, stdout if not set')
+    parser_openapi.set_defaults(func=openapi)
+
+    parser_import = commands.add_parser(
+        'import-users', help=import_users.__doc__)
+    parser_import.add_argument(
+        'file', help='CSV with username and password columns, or .jsonl')
+    parser_import.add_argument(
+        '--output', default=None,
+        help='File to save outcome of every user as JSON lines, '
+        'stdout if not set')
+    parser_import.add_argument(
+        '--workers', type=int, default=None,
+        help='Password hashing processes, defaults to HASH_WORKERS')
+    parser_import.add_argument(
+        '--chunk-size', type=int, default=None,
+        help='Users per insert, defaults to USERS_IMPORT_CHUNK')
+    parser_import.set_defaults(func=import_users)
+
+    parser_export = commands.add_parser(
+        'export-balances', help=export_balances.__doc__)
+    parser_export.add_argument(
+        '--format', choices=('csv', 'ndjson'), default='csv')
+    parser_export.add_argument(
+        '--ledger', action='store_true',
+        help="Add each user's ledger entry count and sum")
+    parser_export.add_argument(
+        '--no-snapshot', action='store_true',
+        help='Do not read all rows from one snapshot')
+    parser_export.add_argument(
+        '--rate', type=float, default=None,
+        help='Max rows per second, 0 for no limit, defaults to EXPORT_RATE')
+    parser_export.add_argument(
+        '--output', default=None, help='File to save, stdout if not set')
+    parser_export.set_defaults(func=export_balances)
+
+    parser_ledger = commands.add_parser(
+        'maintain-ledger', help=maintain_ledger.__doc__)
+    parser_ledger.add_argument(
+        '--ahead', type=int, default=None,
+        help='Months of partitions to create ahead, '
+        'defaults to LEDGER_PARTITIONS_AHEAD')
+    parser_ledger.add_argument(
+        '--retention', type=int, default=None,
+        help='Months of entries to keep, 0 keeps all, '
+        'defaults to LEDGER_RETENTION_MONTHS')
+    parser_ledger.add_argument(
+        '--archive', choices=('detach', 'drop'), default=None,
+        help='What to do with expired partitions, defaults to LEDGER_ARCHIVE')
+    parser_ledger.set_defaults(func=maintain_ledger)
+
+    parser_snapshot = commands.add_parser(
+        'snapshot-balances', help=snapshot_balances.__doc__)
+    parser_snapshot.add_argument(
+        '--since', default=None,
+        help='Date of the first snapshot when none was taken yet, '
+        'defaults to the last midnight')
+    parser_snapshot.set_defaults(func=snapshot_balances)
+
+    parser_serve = commands.add_parser('serve', help=serve.__doc__)
+    parser_serve.add_argument('--host', default=None)
+    parser_serve.add_argument('--port', type=int, default=None)
+    parser_serve.set_defaults(func=serve)
+
+    return parser
+
+
+async def run(args: argparse.Namespace) -> None:
+    from client_transactions_api import db
+
+    try:
+        await args.func(args)
+    finally:
+        await db.dispose()
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    # The server runs its own event loop
+    if not asyncio.iscoroutinefunction(args.func):
+        return args.func(args)
+    asyncio.run(run(args))
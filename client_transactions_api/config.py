@@ -35,6 +35,10 @@ class DBSettings(SettingsBase):
         env='FIRST_SUPERUSER', default='admin')
     FIRST_SUPERUSER_PASSWORD: SecretStr = Field(
         env='FIRST_SUPERUSER_PASSWORD', default='password')
+    # Migrations are meant to be run once per deployment with
+    # `python -m client_transactions_api.migrations`, not by every worker
+    MIGRATE_ON_STARTUP: bool = Field(
+        env='MIGRATE_ON_STARTUP', default=False)
 
 
 class PostgresMixin(DBSettings):
@@ -48,9 +52,17 @@ class PostgresMixin(DBSettings):
         env='POSTGRES_SERVER', default='localhost')
     POSTGRES_PORT: int = Field(env='POSTGRES_PORT', default=5432)
     POSTGRES_DB: str = Field(env='POSTGRES_DB', default='postgres')
+    # Full database URL, overrides POSTGRES_* settings if set,
+    # i.e. sqlite+aiosqlite:///bench.db for local benchmarks
+    DATABASE_URI: Optional[str] = Field(env='DATABASE_URI', default=None)
+    # Comma separated Postgres URLs of the databases users are sharded
+    # across, overrides the database URL if set
+    DATABASE_SHARDS: Optional[str] = Field(env='DATABASE_SHARDS', default=None)
 
     @property
     def DATABASE_URL(self) -> str:
+        if self.DATABASE_URI:
+            return self.DATABASE_URI
         url = f'postgresql+asyncpg://' \
             f'{self.POSTGRES_USER}:' \
             f'{self.POSTGRES_PASSWORD.get_secret_value()}' \
@@ -58,6 +70,14 @@ class PostgresMixin(DBSettings):
             f'{self.POSTGRES_PORT}/{self.POSTGRES_DB}'
         return url
 
+    @property
+    def DATABASE_URLS(self) -> list[str]:
+        """URLs of the shards, the database URL alone if not sharded"""
+        if self.DATABASE_SHARDS:
+            return [url.strip() for url in self.DATABASE_SHARDS.split(',')
+                    if url.strip()]
+        return [self.DATABASE_URL]
+
 
 class AuthServiceMixin(SettingsBase):
     """Auth Service Settings Mixin"""
@@ -67,6 +87,10 @@ class AuthServiceMixin(SettingsBase):
     # Set tokens to one week expiration
     TOKEN_EXPIRE_MINUTES: int = Field(
         env='TOKEN_EXPIRE_MINUTES', default=60*24*7)
+    # Processes hashing passwords of bulk imports, defaults to CPU count
+    HASH_WORKERS: Optional[int] = Field(env='HASH_WORKERS', default=None)
+    # Users inserted per DB transaction by bulk imports
+    USERS_IMPORT_CHUNK: int = Field(env='USERS_IMPORT_CHUNK', default=1000)
 
 
 class OfflinePoolService(SettingsBase):
@@ -76,10 +100,223 @@ class OfflinePoolService(SettingsBase):
         env='POOL_INTERVAL', default=5)
 
 
+class IdempotencyMixin(SettingsBase):
+    """Idempotency-Key store Settings Mixin"""
+
+    # Keep request results for one day
+    IDEMPOTENCY_TTL: int = Field(
+        env='IDEMPOTENCY_TTL', default=60*60*24)
+    # Max number of results kept in each worker's memory
+    IDEMPOTENCY_CACHE_SIZE: int = Field(
+        env='IDEMPOTENCY_CACHE_SIZE', default=10000)
+    IDEMPOTENCY_SWEEP_INTERVAL: int = Field(
+        env='IDEMPOTENCY_SWEEP_INTERVAL', default=60)
+
+
+class TransactionsMixin(SettingsBase):
+    """Balance transactions Settings Mixin"""
+
+    # Group commit: write transactions arriving within the window
+    # together in one DB transaction, trading latency for throughput
+    BATCH_WRITES: bool = Field(env='BATCH_WRITES', default=False)
+    BATCH_WINDOW_MS: float = Field(env='BATCH_WINDOW_MS', default=2)
+    BATCH_MAX_SIZE: int = Field(env='BATCH_MAX_SIZE', default=256)
+
+    # Seconds between polls for credits of transfers across shards that
+    # were not delivered right away, and first retry delay of a failed
+    # delivery, 0 disables the job
+    TRANSFER_CREDIT_INTERVAL: float = Field(
+        env='TRANSFER_CREDIT_INTERVAL', default=1)
+    TRANSFER_CREDIT_BATCH_SIZE: int = Field(
+        env='TRANSFER_CREDIT_BATCH_SIZE', default=100)
+    TRANSFER_CREDIT_MAX_DELAY: float = Field(
+        env='TRANSFER_CREDIT_MAX_DELAY', default=60)
+
+
+class BalanceCacheMixin(SettingsBase):
+    """Balance read cache Settings Mixin"""
+
+    # Seconds a balance written by another worker may be served stale,
+    # 0 disables the cache
+    BALANCE_CACHE_TTL: float = Field(env='BALANCE_CACHE_TTL', default=5)
+    # Max number of users whose balances are kept in each worker's memory
+    BALANCE_CACHE_SIZE: int = Field(env='BALANCE_CACHE_SIZE', default=10000)
+    # Invalidate balances cached by other workers with Postgres NOTIFY
+    BALANCE_CACHE_NOTIFY: bool = Field(
+        env='BALANCE_CACHE_NOTIFY', default=False)
+
+
+class DocsMixin(SettingsBase):
+    """OpenAPI docs Settings Mixin"""
+
+    # Serve /openapi.json, /docs and /redocs
+    DOCS: bool = Field(env='DOCS', default=True)
+    # Schema prebuilt with `python -m client_transactions_api openapi`,
+    # generated on startup if not set
+    OPENAPI_FILE: Optional[str] = Field(env='OPENAPI_FILE', default=None)
+    DOCS_MAX_AGE: int = Field(env='DOCS_MAX_AGE', default=300)
+
+
+class ServerMixin(SettingsBase):
+    """Server profile Settings Mixin
+
+    Options left unset take the value of the profile, see server.py
+    """
+
+    API_HOST: str = Field(env='API_HOST', default='0.0.0.0')
+    API_PORT: int = Field(env='API_PORT', default=8000)
+    # development or production
+    SERVER_PROFILE: str = Field(env='SERVER_PROFILE', default='development')
+    WORKERS: Optional[int] = Field(env='WORKERS', default=None)
+    SERVER_LOOP: Optional[str] = Field(env='SERVER_LOOP', default=None)
+    SERVER_HTTP: Optional[str] = Field(env='SERVER_HTTP', default=None)
+    KEEP_ALIVE: Optional[int] = Field(env='KEEP_ALIVE', default=None)
+    BACKLOG: Optional[int] = Field(env='BACKLOG', default=None)
+    COMPRESSION: Optional[bool] = Field(env='COMPRESSION', default=None)
+    COMPRESSION_MIN_SIZE: Optional[int] = Field(
+        env='COMPRESSION_MIN_SIZE', default=None)
+    ACCESS_LOG: Optional[bool] = Field(env='ACCESS_LOG', default=None)
+
+
+class LimitsMixin(SettingsBase):
+    """Rate limiting and admission control Settings Mixin"""
+
+    # Token buckets, requests per second after a burst, 0 disables
+    TRANSACTION_RATE: float = Field(env='TRANSACTION_RATE', default=0)
+    TRANSACTION_BURST: int = Field(env='TRANSACTION_BURST', default=40)
+    AUTH_RATE: float = Field(env='AUTH_RATE', default=1)
+    AUTH_BURST: int = Field(env='AUTH_BURST', default=10)
+    # Proxies trusted to set X-Forwarded-For, comma separated or `*`,
+    # client addresses are their peer address if unset
+    FORWARDED_ALLOW_IPS: Optional[str] = Field(
+        env='FORWARDED_ALLOW_IPS', default=None)
+    # Max number of buckets kept in each worker's memory, per limiter
+    RATE_LIMIT_KEYS: int = Field(env='RATE_LIMIT_KEYS', default=100000)
+    # Requests processed at once by each worker, 0 disables,
+    # defaults to the DB pool size plus overflow
+    MAX_CONCURRENCY: Optional[int] = Field(
+        env='MAX_CONCURRENCY', default=None)
+    # Requests waiting for a slot at once, defaults to MAX_CONCURRENCY
+    ADMISSION_QUEUE: Optional[int] = Field(env='ADMISSION_QUEUE', default=None)
+    # Seconds a request waits for a slot before it is shed with 503
+    ADMISSION_TIMEOUT: float = Field(env='ADMISSION_TIMEOUT', default=1)
+
+
+class ExportMixin(SettingsBase):
+    """Balance export Settings Mixin"""
+
+    # Rows fetched from the server-side cursor at a time
+    EXPORT_BATCH_SIZE: int = Field(env='EXPORT_BATCH_SIZE', default=1000)
+    # Default max rows per second of an export, 0 disables
+    EXPORT_RATE: float = Field(env='EXPORT_RATE', default=10000)
+
+
+class OutboxMixin(SettingsBase):
+    """Balance change event outbox Settings Mixin"""
+
+    # Write events with balance changes and run the dispatcher
+    OUTBOX: bool = Field(env='OUTBOX', default=False)
+    # Sinks every event is delivered to
+    OUTBOX_WEBHOOK_URL: Optional[str] = Field(
+        env='OUTBOX_WEBHOOK_URL', default=None)
+    OUTBOX_WEBHOOK_TIMEOUT: float = Field(
+        env='OUTBOX_WEBHOOK_TIMEOUT', default=5)
+    OUTBOX_FILE: Optional[str] = Field(env='OUTBOX_FILE', default=None)
+    # Events delivered at a time
+    OUTBOX_BATCH_SIZE: int = Field(env='OUTBOX_BATCH_SIZE', default=100)
+    # Seconds between polls of an empty outbox,
+    # and first retry delay of a failed delivery
+    OUTBOX_INTERVAL: float = Field(env='OUTBOX_INTERVAL', default=1)
+    OUTBOX_MAX_DELAY: float = Field(env='OUTBOX_MAX_DELAY', default=60)
+
+
+class StreamMixin(SettingsBase):
+    """Balance server-sent events Settings Mixin"""
+
+    # Events queued per stream before a slow client is dropped
+    STREAM_QUEUE_SIZE: int = Field(env='STREAM_QUEUE_SIZE', default=16)
+    # Open streams per worker, more get 503
+    STREAM_MAX_SUBSCRIBERS: int = Field(
+        env='STREAM_MAX_SUBSCRIBERS', default=10000)
+    # Seconds between heartbeats of an idle stream
+    STREAM_HEARTBEAT: float = Field(env='STREAM_HEARTBEAT', default=15)
+
+
+class LedgerMixin(SettingsBase):
+    """Ledger partition maintenance Settings Mixin"""
+
+    # Seconds between maintenance runs, 0 disables the job
+    LEDGER_MAINTENANCE_INTERVAL: int = Field(
+        env='LEDGER_MAINTENANCE_INTERVAL', default=60*60)
+    # Monthly partitions created ahead of the current month
+    LEDGER_PARTITIONS_AHEAD: int = Field(
+        env='LEDGER_PARTITIONS_AHEAD', default=3)
+    # Months of entries kept besides the current one, 0 keeps all.
+    # Older months are compacted into per-user summaries
+    LEDGER_RETENTION_MONTHS: int = Field(
+        env='LEDGER_RETENTION_MONTHS', default=0)
+    # detach: keep expired partitions as tables of their own, drop: delete
+    LEDGER_ARCHIVE: str = Field(
+        env='LEDGER_ARCHIVE', default='detach', regex='^(detach|drop)$')
+
+
+class SnapshotMixin(SettingsBase):
+    """Balance snapshot Settings Mixin"""
+
+    # Seconds between checks for due snapshots, 0 disables the job
+    SNAPSHOT_INTERVAL: int = Field(env='SNAPSHOT_INTERVAL', default=5*60)
+    # Seconds after midnight before its snapshot is taken
+    SNAPSHOT_DELAY: int = Field(env='SNAPSHOT_DELAY', default=60)
+
+
+class CurrencyMixin(SettingsBase):
+    """Balance currencies Settings Mixin"""
+
+    # Comma separated ISO 4217 codes users can hold balances in
+    CURRENCIES: str = Field(env='CURRENCIES', default='USD')
+    # Currency of requests that do not name one
+    DEFAULT_CURRENCY: str = Field(
+        env='DEFAULT_CURRENCY', default='USD', regex='^[A-Z]{3}$')
+
+    @property
+    def CURRENCY_CODES(self) -> list[str]:
+        """Accepted currencies, the default one included"""
+        codes = [code.strip().upper() for code in self.CURRENCIES.split(',')
+                 if code.strip()]
+        if self.DEFAULT_CURRENCY not in codes:
+            codes.insert(0, self.DEFAULT_CURRENCY)
+        return codes
+
+
+class HoldMixin(SettingsBase):
+    """Balance holds Settings Mixin"""
+
+    # Seconds a hold reserves funds for unless the request sets its own
+    HOLD_TTL: int = Field(env='HOLD_TTL', default=7*24*60*60)
+    HOLD_MAX_TTL: int = Field(env='HOLD_MAX_TTL', default=30*24*60*60)
+    # Seconds between sweeps releasing expired holds, 0 disables the sweeper
+    HOLD_SWEEP_INTERVAL: int = Field(env='HOLD_SWEEP_INTERVAL', default=60)
+    HOLD_SWEEP_BATCH_SIZE: int = Field(
+        env='HOLD_SWEEP_BATCH_SIZE', default=500)
+
+
 class Settings(
         PostgresMixin,
         AuthServiceMixin,
-        OfflinePoolService
+        OfflinePoolService,
+        IdempotencyMixin,
+        TransactionsMixin,
+        BalanceCacheMixin,
+        DocsMixin,
+        ServerMixin,
+        LimitsMixin,
+        ExportMixin,
+        OutboxMixin,
+        StreamMixin,
+        LedgerMixin,
+        SnapshotMixin,
+        CurrencyMixin,
+        HoldMixin
 ):
     """Combined Settings with previous settings as mixins"""
     pass
@@ -1,37 +1,103 @@
+import zlib
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import AsyncIterator
+
 from fastapi import HTTPException
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import (AsyncEngine, AsyncSession,
+                                    create_async_engine)
 from sqlalchemy.orm import sessionmaker
 
 from .config import settings
 
-engine = create_async_engine(
-    settings.DATABASE_URL,
-    echo=settings.DEBUG,
-    echo_pool=settings.DEBUG,
-    pool_pre_ping=True,
-    pool_size=10,
-    max_overflow=10
-)
+pool_options = {}
+if settings.DATABASE_URLS[0].startswith('postgresql'):
+    pool_options = {'pool_size': 10, 'max_overflow': 10}
 
-Session = sessionmaker(
-    bind=engine,
-    expire_on_commit=False,
-    class_=AsyncSession
-)
 
+class Shard:
+    """Database holding the users routed to it, with all their data
 
-# FastAPI Dependency
-async def get_database() -> AsyncSession:
-    async with Session() as session:
+    Every shard has the whole schema. A user, their balance, ledger and
+    other rows live on the shard of `user_id % number of shards`, which
+    shards make sure of by generating user ids of their own residue only
+    (see `migrations.configure_shard`). Users are registered on the shard
+    of a hash of their username, so that they can also be found by name.
+    """
+
+    def __init__(self, index: int, url: str):
+        self.index = index
+        self.url = url
+        self.engine: AsyncEngine = create_async_engine(
+            url,
+            echo=settings.DEBUG,
+            echo_pool=settings.DEBUG,
+            pool_pre_ping=True,
+            **pool_options
+        )
+        self.Session = sessionmaker(
+            bind=self.engine,
+            expire_on_commit=False,
+            class_=AsyncSession
+        )
+
+    def __repr__(self) -> str:
+        return f'Shard({self.index})'
+
+
+shards = [Shard(index, url) for index, url in enumerate(settings.DATABASE_URLS)]
+
+if len(shards) > 1 and any(
+        shard.engine.dialect.name != 'postgresql' for shard in shards):
+    raise ValueError('Sharding requires Postgres databases')
+
+# First shard, the only one unless DATABASE_SHARDS is set
+engine = shards[0].engine
+Session = shards[0].Session
+
+
+def shard_for(user_id: int) -> Shard:
+    """Shard of a user"""
+    return shards[user_id % len(shards)]
+
+
+def shard_for_username(username: str) -> Shard:
+    """Shard a user is registered on"""
+    return shards[zlib.crc32(username.encode()) % len(shards)]
+
+
+@asynccontextmanager
+async def session(shard: Shard | None = None) -> AsyncIterator[AsyncSession]:
+    """Session of a shard, committed unless an error is raised"""
+    async with (shard or shards[0]).Session() as db_session:
         try:
-            yield session
-            await session.commit()
+            yield db_session
+            await db_session.commit()
         except SQLAlchemyError as sql_ex:
-            await session.rollback()
+            await db_session.rollback()
             raise sql_ex
         except HTTPException as http_ex:
-            await session.rollback()
+            await db_session.rollback()
             raise http_ex
         finally:
-            await session.close()
+            await db_session.close()
+
+
+@asynccontextmanager
+async def sessions() -> AsyncIterator[list[AsyncSession]]:
+    """Sessions of all shards, in shard order"""
+    async with AsyncExitStack() as stack:
+        yield [await stack.enter_async_context(session(shard))
+               for shard in shards]
+
+
+async def dispose() -> None:
+    for shard in shards:
+        await shard.engine.dispose()
+
+
+# FastAPI Dependency
+async def get_database() -> AsyncSession:
+    """Session of the first shard, for requests not tied to a user"""
+    async with session() as db_session:
+        yield db_session
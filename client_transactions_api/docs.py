@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+from fastapi import APIRouter, FastAPI, Request, Response
+from fastapi.openapi.docs import (get_redoc_html, get_swagger_ui_html,
+                                  get_swagger_ui_oauth2_redirect_html)
+
+logger = logging.getLogger(__name__)
+
+OPENAPI_URL = '/openapi.json'
+OAUTH2_REDIRECT_URL = '/docs/oauth2-redirect'
+
+router = APIRouter(include_in_schema=False)
+
+
+class StaticDocument:
+    """Document rendered once and served from memory
+
+    Responses carry an ETag, so that clients revalidate with a 304
+    instead of downloading the document again, and are gzipped for
+    clients that accept it.
+    """
+
+    def __init__(self, content: bytes, media_type: str, max_age: int = 300):
+        self.content = content
+        self.gzipped = gzip.compress(content, compresslevel=9)
+        self.media_type = media_type
+        digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+        self.etag = f'"{digest}"'
+        self.headers = {
+            'ETag': self.etag,
+            'Cache-Control': f'public, max-age={max_age}',
+            'Vary': 'Accept-Encoding',
+        }
+
+    def not_modified(self, request: Request) -> bool:
+        if_none_match = request.headers.get('if-none-match')
+        if not if_none_match:
+            return False
+        etags = [tag.strip().removeprefix('W/')
+                 for tag in if_none_match.split(',')]
+        return '*' in etags or self.etag in etags
+
+    def response(self, request: Request) -> Response:
+        if self.not_modified(request):
+            return Response(status_code=304, headers=self.headers)
+        if 'gzip' in request.headers.get('accept-encoding', ''):
+            return Response(
+                content=self.gzipped,
+                media_type=self.media_type,
+                headers={**self.headers, 'Content-Encoding': 'gzip'})
+        return Response(
+            content=self.content,
+            media_type=self.media_type,
+            headers=self.headers)
+
+
+class Docs:
+    """OpenAPI schema and docs pages of the app"""
+
+    openapi: StaticDocument | None = None
+    swagger: StaticDocument | None = None
+    redoc: StaticDocument | None = None
+    oauth2_redirect: StaticDocument | None = None
+
+
+def dumps(schema: dict) -> bytes:
+    return json.dumps(schema, separators=(',', ':')).encode()
+
+
+def load_schema(app: FastAPI, path: str | None = None) -> dict:
+    """Load schema prebuilt with `python -m client_transactions_api openapi`
+
+    Falls back to generating the schema if there is no prebuilt schema
+    for the running version of the app.
+    """
+
+    if path and os.path.exists(path):
+        with open(path) as f:
+            schema = json.load(f)
+        if schema.get('info', {}).get('version') == app.version:
+            logger.info(f'Loaded OpenAPI schema from {path}')
+            return schema
+        logger.warning(
+            f'OpenAPI schema {path} is not of version {app.version}, '
+            'generating schema')
+    return app.openapi()
+
+
+def setup(app: FastAPI, path: str | None = None, max_age: int = 300) -> None:
+    """Render OpenAPI schema and docs pages"""
+
+    Docs.openapi = StaticDocument(
+        dumps(load_schema(app, path)), 'application/json', max_age)
+    Docs.swagger = StaticDocument(
+        get_swagger_ui_html(
+            openapi_url=OPENAPI_URL,
+            title=f'{app.title} - Swagger UI',
+            oauth2_redirect_url=OAUTH2_REDIRECT_URL).body,
+        'text/html', max_age)
+    Docs.redoc = StaticDocument(
+        get_redoc_html(
+            openapi_url=OPENAPI_URL,
+            title=f'{app.title} - ReDoc').body,
+        'text/html', max_age)
+    Docs.oauth2_redirect = StaticDocument(
+        get_swagger_ui_oauth2_redirect_html().body, 'text/html', max_age)
+
+
+@router.get(OPENAPI_URL)
+async def openapi(request: Request) -> Response:
+    return Docs.openapi.response(request)
+
+
+@router.get('/docs')
+async def swagger_ui(request: Request) -> Response:
+    return Docs.swagger.response(request)
+
+
+@router.get(OAUTH2_REDIRECT_URL)
+async def swagger_ui_redirect(request: Request) -> Response:
+    return Docs.oauth2_redirect.response(request)
+
+
+@router.get('/redocs')
+async def redoc(request: Request) -> Response:
+    return Docs.redoc.response(request)
@@ -5,20 +5,28 @@ import os
 from fastapi import FastAPI
 
 from client_transactions_api import __version__ as version
-from client_transactions_api import api, db, middleware, models
+from client_transactions_api import api, db, middleware, models, server
 from client_transactions_api.config import settings
+from client_transactions_api.serializers import FastJSONResponse
+from client_transactions_api.services import limits
+from client_transactions_api.services.auth import password_hasher
+from client_transactions_api.services.cache import (BalanceCache,
+                                                    BalanceCacheInvalidator)
+from client_transactions_api.services.holds import hold_sweeper
+from client_transactions_api.services.idempotency import (
+    IdempotencyKeySweeper, IdempotencyStore)
+from client_transactions_api.services.ledger import ledger_maintenance
 from client_transactions_api.services.offline import OfflineTransactionPool
-from client_transactions_api.utils import create_superuser
+from client_transactions_api.services.outbox import dispatcher
+from client_transactions_api.services.snapshots import snapshot_job
+from client_transactions_api.services.transactions import credit_delivery
 
 FILE_DIR = os.path.dirname(os.path.abspath(__file__))
-with open(f'{FILE_DIR}/README.md') as f:
-    description = f.read()
 
 logger = logging.getLogger()
 
 app = FastAPI(
     title='A fault tolerant, asynchronous funds transaction API',
-    description=description,
     contact={
         'name': 'mbrav',
         'url': 'https://github.com/mbrav',
@@ -28,23 +36,74 @@ app = FastAPI(
         'name': 'GNU 3.0',
         'url': 'https://www.gnu.org/licenses/gpl-3.0.en.html',
     },
-    docs_url='/docs',
     version=version,
-    redoc_url='/redocs',
+    default_response_class=FastJSONResponse,
+    # Served from memory by the docs router, rendered once on startup
+    openapi_url=None,
+    docs_url=None,
+    redoc_url=None,
 )
 
 
+def openapi() -> dict:
+    """Generate OpenAPI schema, reading README description only once needed"""
+    if app.openapi_schema is None:
+        with open(f'{FILE_DIR}/README.md') as f:
+            app.description = f.read()
+    return FastAPI.openapi(app)
+
+
+app.openapi = openapi
+
 app.include_router(api.api_router, prefix=settings.API_PATH)
 
+if settings.DOCS:
+    from client_transactions_api import docs
+    app.include_router(docs.router)
+
 app.add_middleware(middleware.ProcessTimeMiddleware)
 
+if limits.admission.enabled:
+    # Health checks and limit metrics stay available under load,
+    # balance streams are open for long and mostly idle
+    app.add_middleware(
+        middleware.AdmissionMiddleware,
+        admission=limits.admission,
+        exempt=(f'{settings.API_PATH}/', f'{settings.API_PATH}/limits',
+                f'{settings.API_PATH}/balances/my/stream'))
+
+# Transactions hold pool connections, login and registration hash
+# passwords with argon2
+app.add_middleware(
+    middleware.RateLimitMiddleware,
+    rules={
+        ('POST', f'{settings.API_PATH}/balances'):
+            (limits.transaction_limiter, limits.token_user),
+        ('POST', f'{settings.API_PATH}/balances/transfer'):
+            (limits.transaction_limiter, limits.token_user),
+        ('POST', f'{settings.API_PATH}/balances/holds'):
+            (limits.transaction_limiter, limits.token_user),
+        ('POST', f'{settings.API_PATH}/auth/token'):
+            (limits.auth_limiter, limits.client_address),
+        ('POST', f'{settings.API_PATH}/auth/register'):
+            (limits.auth_limiter, limits.client_address),
+    })
+
+# Only the server profile is read here, uvicorn is imported by server.run
+profile = server.get_profile()
+if profile.compression:
+    app.add_middleware(
+        middleware.CompressionMiddleware,
+        minimum_size=profile.compression_min_size)
+
 if settings.LOGGING:
+    import logging.handlers
+
     logger_level = logging.INFO
     if settings.DEBUG:
         logger_level = logging.DEBUG
 
     os.makedirs(os.path.dirname(settings.LOG_PATH), exist_ok=True)
-    test = os.path.dirname(settings.LOG_PATH)
     formatter = logging.Formatter(
         '%(levelname)s:%(name)s %(asctime)s: %(message)s')
     handler = logging.handlers.RotatingFileHandler(
@@ -65,18 +124,40 @@ if settings.LOGGING:
 @app.on_event('startup')
 async def startup_database():
     logger.info('FastAPI starting up...')
-    async with db.engine.begin() as conn:
+
+    # Schema and superuser are managed by the cold path CLI commands
+    # `migrate` and `create-superuser`, serving workers skip them
+    if not (settings.TESTING or settings.MIGRATE_ON_STARTUP):
+        return
+
+    from client_transactions_api import migrations
+
+    for shard in db.shards:
         # DROP ALL TABLES when testing!
         if settings.TESTING:
-            await conn.run_sync(models.Base.metadata.drop_all)
-        await conn.run_sync(models.Base.metadata.create_all)
-    await db.engine.dispose()
+            runner = migrations.get_runner(shard.engine)
+            await runner.reset(models.Base.metadata)
+            await runner.run()
+        else:
+            await migrations.run_migrations(shard.engine)
+        await migrations.configure_shard(
+            shard.engine, shard.index, len(db.shards))
+    await db.dispose()
+
     if settings.FIRST_SUPERUSER:
+        from client_transactions_api.utils import create_superuser
         await create_superuser(
             username=settings.FIRST_SUPERUSER,
             password=settings.FIRST_SUPERUSER_PASSWORD.get_secret_value())
 
 
+@app.on_event('startup')
+async def startup_docs():
+    if settings.DOCS:
+        from client_transactions_api import docs
+        docs.setup(app, settings.OPENAPI_FILE, settings.DOCS_MAX_AGE)
+
+
 @app.on_event('startup')
 async def startup_offline_pool():
     # Run pffline transaction checker pool
@@ -84,10 +165,70 @@ async def startup_offline_pool():
     asyncio.create_task(pool.run())
 
 
+@app.on_event('startup')
+async def startup_idempotency_store():
+    IdempotencyStore.configure(
+        ttl=settings.IDEMPOTENCY_TTL,
+        max_size=settings.IDEMPOTENCY_CACHE_SIZE)
+    sweeper = IdempotencyKeySweeper(settings.IDEMPOTENCY_SWEEP_INTERVAL)
+    asyncio.create_task(sweeper.run())
+
+
+@app.on_event('startup')
+async def startup_balance_cache():
+    channel = None
+    if settings.BALANCE_CACHE_NOTIFY and settings.BALANCE_CACHE_TTL > 0:
+        # Invalidations of all shards go through the first one
+        channel = BalanceCacheInvalidator(db.shards[0].url)
+        asyncio.create_task(channel.run())
+    BalanceCache.configure(
+        ttl=settings.BALANCE_CACHE_TTL,
+        max_size=settings.BALANCE_CACHE_SIZE,
+        channel=channel)
+
+
+@app.on_event('startup')
+async def startup_outbox():
+    if not settings.OUTBOX:
+        return
+    if not dispatcher.sinks:
+        logger.warning('Outbox enabled without sinks, events are dropped')
+    models.OutboxEvent.enabled = True
+    asyncio.create_task(dispatcher.run())
+
+
+@app.on_event('startup')
+async def startup_ledger_maintenance():
+    if settings.LEDGER_MAINTENANCE_INTERVAL:
+        for shard in db.shards:
+            asyncio.create_task(ledger_maintenance.for_shard(shard).run())
+
+
+@app.on_event('startup')
+async def startup_balance_snapshots():
+    if settings.SNAPSHOT_INTERVAL:
+        for shard in db.shards:
+            asyncio.create_task(snapshot_job.for_shard(shard).run())
+
+
+@app.on_event('startup')
+async def startup_hold_sweeper():
+    if settings.HOLD_SWEEP_INTERVAL:
+        asyncio.create_task(hold_sweeper.run())
+
+
+@app.on_event('startup')
+async def startup_transfer_credits():
+    # Only transfers across shards leave credits to deliver
+    if settings.TRANSFER_CREDIT_INTERVAL and len(db.shards) > 1:
+        asyncio.create_task(credit_delivery.run())
+
+
 @app.on_event('shutdown')
 async def shutdown_event():
     logger.info('FastAPI shutting down...')
+    password_hasher.shutdown()
+    await dispatcher.close()
 
 if __name__ == '__main__':
-    import uvicorn
-    uvicorn.run(app, host='0.0.0.0', port=8000)
+    server.run()
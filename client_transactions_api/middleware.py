@@ -1,7 +1,21 @@
 import logging
+import math
 import time
+import zlib
+from typing import Callable
 
+from starlette.datastructures import Headers, MutableHeaders
 from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from client_transactions_api.services.limits import (AdmissionControl,
+                                                     RateLimiter)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 logger = logging.getLogger(__name__)
 
@@ -35,3 +49,194 @@ class ProcessTimeMiddleware(BaseHTTPMiddleware):
             logger.error(log_message)
 
         return response
+
+
+class AdmissionMiddleware:
+    """Shed requests over the worker's concurrency limit with 503
+
+    Args:
+        admission (AdmissionControl): Concurrency limit and its metrics
+        exempt (tuple, optional): Paths that are always admitted,
+            i.e. health checks
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        admission: AdmissionControl,
+        exempt: tuple[str, ...] = ()
+    ):
+        self.app = app
+        self.admission = admission
+        self.exempt = exempt
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or scope['path'] in self.exempt:
+            return await self.app(scope, receive, send)
+
+        if not await self.admission.acquire():
+            logger.warning(f'Request "{scope["path"]}" shed, server busy')
+            response = JSONResponse(
+                {'detail': 'Server is busy, try again later'},
+                status_code=503,
+                headers={'Retry-After': '1'})
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.admission.release()
+
+
+class RateLimitMiddleware:
+    """Reject requests over their rate limit with 429
+
+    Runs before admission control, so that requests of a client over its
+    rate do not take the slots of other clients.
+
+    Args:
+        rules (dict): Rate limiter and key function by method and path
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        rules: dict[tuple[str, str],
+                    tuple[RateLimiter, Callable[[Scope], int | str]]]
+    ):
+        self.app = app
+        self.rules = rules
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        rule = self.rules.get((scope['method'], scope['path']))
+        if rule is None:
+            return await self.app(scope, receive, send)
+
+        limiter, key = rule
+        if not limiter.enabled:
+            return await self.app(scope, receive, send)
+        retry_after = limiter.acquire(key(scope))
+        if not retry_after:
+            return await self.app(scope, receive, send)
+        logger.warning(f'Request "{scope["path"]}" over rate limit')
+        response = JSONResponse(
+            {'detail': 'Too many requests, slow down'},
+            status_code=429,
+            headers={'Retry-After': str(math.ceil(retry_after))})
+        await response(scope, receive, send)
+
+
+class GZipEncoder:
+    name = 'gzip'
+
+    def __init__(self, level: int = 6):
+        # wbits 31 writes a gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        # Sync flush, so that streamed chunks reach the client right away
+        return self.compressor.compress(data) + \
+            self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b'') -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush()
+
+
+class BrotliEncoder:
+    name = 'br'
+
+    def __init__(self, quality: int = 4):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self, data: bytes = b'') -> bytes:
+        return self.compressor.process(data) + self.compressor.finish()
+
+
+class CompressionMiddleware:
+    """Compress responses with brotli or gzip, as accepted by the client
+
+    Brotli is used if the `brotli` package is installed. Responses smaller
+    than `minimum_size`, already encoded responses and event streams are
+    sent as they are. Streamed responses are compressed chunk by chunk.
+    """
+
+    excluded_media_types = ('text/event-stream',)
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    def encoder(self, scope: Scope) -> type | None:
+        accept_encoding = Headers(scope=scope).get('accept-encoding', '')
+        if brotli is not None and 'br' in accept_encoding:
+            return BrotliEncoder
+        if 'gzip' in accept_encoding:
+            return GZipEncoder
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        encoder_class = self.encoder(scope)
+        if encoder_class is None:
+            return await self.app(scope, receive, send)
+
+        start_message: Message = {}
+        encoder = None
+        started = False
+        passthrough = False
+        # Body is held back until it reaches the minimum size, responses
+        # passing through BaseHTTPMiddleware are always streamed
+        buffer = b''
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start_message, encoder, started, passthrough, buffer
+            if message['type'] == 'http.response.start':
+                # Encoded responses and event streams are never compressed,
+                # so they are sent right away rather than buffered
+                headers = Headers(raw=message['headers'])
+                if 'content-encoding' in headers or \
+                        headers.get('content-type', '').startswith(
+                            self.excluded_media_types):
+                    passthrough = True
+                    return await send(message)
+                start_message = message
+                return
+            if passthrough or message['type'] != 'http.response.body':
+                return await send(message)
+
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if not started:
+                buffer += body
+                if more_body and len(buffer) < self.minimum_size:
+                    return
+                started = True
+                body, buffer = buffer, b''
+                message['body'] = body
+                headers = MutableHeaders(raw=start_message['headers'])
+                skip = len(body) < self.minimum_size and not more_body
+                if not skip:
+                    encoder = encoder_class()
+                    headers['Content-Encoding'] = encoder.name
+                    headers.add_vary_header('Accept-Encoding')
+                    if more_body:
+                        if 'content-length' in headers:
+                            del headers['Content-Length']
+                        message['body'] = encoder.compress(body)
+                    else:
+                        message['body'] = encoder.finish(body)
+                        headers['Content-Length'] = str(len(message['body']))
+                await send(start_message)
+                return await send(message)
+
+            if encoder is not None:
+                message['body'] = encoder.compress(body) if more_body \
+                    else encoder.finish(body)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,51 @@
+import logging
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.sql import text
+
+from .runner import (SQL, Backfill, CreateIndex, Migration, MigrationRunner,
+                     RunSync)
+from .versions import MIGRATIONS
+
+logger = logging.getLogger(__name__)
+
+
+def get_runner(engine: AsyncEngine) -> MigrationRunner:
+    from client_transactions_api.models import Base
+    return MigrationRunner(engine, MIGRATIONS, metadata=Base.metadata)
+
+
+async def run_migrations(engine: AsyncEngine) -> list[int]:
+    """Apply all pending migrations"""
+    return await get_runner(engine).run()
+
+
+async def configure_shard(engine: AsyncEngine, index: int, count: int) -> None:
+    """Make the users id sequence of a shard generate routable ids
+
+    Ids of the `index`th of `count` shards are all `index` modulo
+    `count`, and larger than any id it generated before.
+    """
+
+    if engine.dialect.name != 'postgresql':
+        return
+    async with engine.begin() as conn:
+        sequence = (await conn.execute(
+            text("SELECT pg_get_serial_sequence('users', 'id')"))).scalar()
+        increment, last = (await conn.execute(
+            text(
+                'SELECT seqincrement, GREATEST(last_value, '
+                '(SELECT COALESCE(MAX(id), 0) FROM users)) '
+                f'FROM pg_sequence, {sequence} '
+                'WHERE seqrelid = CAST(:sequence AS regclass)'),
+            {'sequence': sequence})).one()
+        if increment == count and last % count == index:
+            return
+        start = last + 1
+        start += (index - start) % count
+        await conn.execute(
+            text(f'ALTER SEQUENCE {sequence} INCREMENT BY {count}'))
+        await conn.execute(
+            text('SELECT setval(:sequence, :start, false)'),
+            {'sequence': sequence, 'start': start})
+    logger.info(f'Users of shard {index} get ids from {start} by {count}')
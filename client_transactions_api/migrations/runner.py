@@ -0,0 +1,229 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable
+
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table,
+                        select, text)
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary application wide key for pg_advisory_lock()
+ADVISORY_LOCK_KEY = 0x637461
+
+migration_metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations',
+    migration_metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('name', String(100), nullable=False),
+    Column('applied_at', DateTime, default=datetime.utcnow),
+)
+
+
+class Operation:
+    """Base migration operation
+
+    Operations must be idempotent: operations that can not run inside a
+    transaction (concurrent index builds, batched backfills) are not rolled
+    back if a later operation of the same migration fails, so the whole
+    migration is simply re-run on the next deployment.
+    """
+
+    transactional: bool = True
+
+    async def apply(self, conn: AsyncConnection) -> None:
+        raise NotImplementedError
+
+
+@dataclass
+class SQL(Operation):
+    """Run a raw SQL statement"""
+
+    statement: str
+    transactional: bool = True
+
+    async def apply(self, conn: AsyncConnection) -> None:
+        await conn.execute(text(self.statement))
+
+
+@dataclass
+class RunSync(Operation):
+    """Run a sync callable with the connection, i.e. metadata.create_all"""
+
+    fn: Callable
+    transactional: bool = True
+
+    async def apply(self, conn: AsyncConnection) -> None:
+        await conn.run_sync(self.fn)
+
+
+@dataclass
+class CreateIndex(Operation):
+    """Build an index without taking a write lock on the table
+
+    CREATE INDEX CONCURRENTLY can not run inside a transaction block.
+    A failed concurrent build leaves an INVALID index behind, which is
+    dropped before retrying.
+    """
+
+    name: str
+    table: str
+    columns: list[str]
+    unique: bool = False
+    where: str | None = None
+    concurrently: bool = True
+
+    @property
+    def transactional(self) -> bool:
+        return not self.concurrently
+
+    async def apply(self, conn: AsyncConnection) -> None:
+        concurrently = 'CONCURRENTLY ' if self.concurrently else ''
+        invalid = await conn.execute(
+            text(
+                'SELECT 1 FROM pg_index i '
+                'JOIN pg_class c ON c.oid = i.indexrelid '
+                'WHERE c.relname = :name AND NOT i.indisvalid'),
+            {'name': self.name})
+        if invalid.scalar():
+            logger.warning(f'Dropping invalid index {self.name}')
+            await conn.execute(
+                text(f'DROP INDEX {concurrently}IF EXISTS {self.name}'))
+
+        unique = 'UNIQUE ' if self.unique else ''
+        columns = ', '.join(self.columns)
+        statement = f'CREATE {unique}INDEX {concurrently}IF NOT EXISTS ' \
+            f'{self.name} ON {self.table} ({columns})'
+        if self.where:
+            statement += f' WHERE {self.where}'
+        await conn.execute(text(statement))
+
+
+@dataclass
+class Backfill(Operation):
+    """Update rows in small batches, each batch in its own transaction
+
+    Rows are picked with SKIP LOCKED so that the backfill never waits on
+    rows locked by live transactions, those are picked up on the next pass.
+    `where` must stop matching a row once it has been backfilled.
+    """
+
+    table: str
+    set: str
+    where: str
+    batch_size: int = 5000
+    pause: float = 0.05
+    transactional: bool = field(default=False, init=False)
+
+    async def apply(self, conn: AsyncConnection) -> None:
+        statement = text(
+            f'UPDATE {self.table} SET {self.set} WHERE id IN ('
+            f'SELECT id FROM {self.table} WHERE {self.where} '
+            f'ORDER BY id LIMIT :batch_size FOR UPDATE SKIP LOCKED)')
+        total = 0
+        while True:
+            # Connection is in autocommit mode, every batch commits on its own
+            result = await conn.execute(
+                statement, {'batch_size': self.batch_size})
+            if not result.rowcount:
+                break
+            total += result.rowcount
+            logger.info(f'Backfilled {total} rows in {self.table}')
+            await asyncio.sleep(self.pause)
+
+
+@dataclass
+class Migration:
+    """A numbered list of schema operations"""
+
+    version: int
+    name: str
+    operations: list[Operation] = field(default_factory=list)
+
+
+class MigrationRunner:
+    """Apply pending migrations once per deployment
+
+    The runner holds a session level advisory lock while it works, so that
+    concurrently started runners (i.e. several containers of one deployment)
+    wait for the first one and then find nothing left to do.
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        migrations: list[Migration],
+        metadata: MetaData | None = None
+    ):
+        self.engine = engine
+        self.migrations = sorted(migrations, key=lambda m: m.version)
+        # Models metadata, used instead of migrations for other databases
+        self.metadata = metadata
+
+    async def applied_versions(self, conn: AsyncConnection) -> set[int]:
+        result = await conn.execute(select(schema_migrations.c.version))
+        return set(result.scalars().all())
+
+    async def _apply(self, conn: AsyncConnection, migration: Migration) -> None:
+        logger.info(
+            f'Applying migration {migration.version:04d} {migration.name}')
+        for operation in migration.operations:
+            if operation.transactional:
+                async with self.engine.begin() as tx_conn:
+                    await operation.apply(tx_conn)
+            else:
+                await operation.apply(conn)
+        async with self.engine.begin() as tx_conn:
+            await tx_conn.execute(schema_migrations.insert().values(
+                version=migration.version,
+                name=migration.name))
+
+    async def run(self) -> list[int]:
+        """Apply all pending migrations, return applied versions"""
+
+        # Migrations are written for Postgres. Other databases, like the
+        # SQLite stand-in used by benchmarks, get the schema of the models
+        if self.engine.dialect.name != 'postgresql':
+            logger.warning(
+                f'Creating {self.engine.dialect.name} schema from models')
+            async with self.engine.begin() as conn:
+                await conn.run_sync(self.metadata.create_all)
+            return []
+
+        applied = []
+        async with self.engine.connect() as conn:
+            # Lock holder connection, also used for operations that can not
+            # run inside a transaction. Transactional operations get their own
+            conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+            await conn.execute(
+                text('SELECT pg_advisory_lock(:key)'),
+                {'key': ADVISORY_LOCK_KEY})
+            try:
+                await conn.run_sync(migration_metadata.create_all)
+                done = await self.applied_versions(conn)
+                for migration in self.migrations:
+                    if migration.version in done:
+                        continue
+                    await self._apply(conn, migration)
+                    applied.append(migration.version)
+            finally:
+                await conn.execute(
+                    text('SELECT pg_advisory_unlock(:key)'),
+                    {'key': ADVISORY_LOCK_KEY})
+
+        if applied:
+            logger.info(f'Applied migrations {applied}')
+        else:
+            logger.info('Database schema is up to date')
+        return applied
+
+    async def reset(self, metadata: MetaData) -> None:
+        """Drop all tables including migration history. Testing only!"""
+
+        async with self.engine.begin() as conn:
+            await conn.run_sync(metadata.drop_all)
+            await conn.run_sync(migration_metadata.drop_all)
@@ -0,0 +1,378 @@
+from .runner import SQL, CreateIndex, Migration
+
+# Migrations are frozen snapshots of the schema changes at the time they
+# were written. Never edit an applied migration, add a new one instead.
+MIGRATIONS: list[Migration] = [
+    Migration(1, 'initial', [
+        SQL("""
+            CREATE TABLE IF NOT EXISTS users (
+                id SERIAL NOT NULL,
+                created_at TIMESTAMP WITHOUT TIME ZONE,
+                updated_at TIMESTAMP WITHOUT TIME ZONE,
+                username VARCHAR(20) NOT NULL,
+                hashed_password VARCHAR(130),
+                is_active BOOLEAN,
+                is_admin BOOLEAN,
+                PRIMARY KEY (id)
+            )"""),
+        SQL('CREATE INDEX IF NOT EXISTS ix_users_id ON users (id)'),
+        SQL("""
+            CREATE TABLE IF NOT EXISTS balances (
+                id SERIAL NOT NULL,
+                created_at TIMESTAMP WITHOUT TIME ZONE,
+                updated_at TIMESTAMP WITHOUT TIME ZONE,
+                user_id INTEGER,
+                value FLOAT,
+                PRIMARY KEY (id),
+                UNIQUE (user_id),
+                FOREIGN KEY(user_id) REFERENCES users (id)
+            )"""),
+        SQL('CREATE INDEX IF NOT EXISTS ix_balances_id ON balances (id)'),
+    ]),
+    Migration(2, 'users_username_index', [
+        CreateIndex('ix_users_username', 'users', ['username']),
+    ]),
+    Migration(3, 'idempotency_keys', [
+        SQL("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                id SERIAL NOT NULL,
+                created_at TIMESTAMP WITHOUT TIME ZONE,
+                updated_at TIMESTAMP WITHOUT TIME ZONE,
+                user_id INTEGER NOT NULL,
+                key VARCHAR(64) NOT NULL,
+                fingerprint VARCHAR(32) NOT NULL,
+                status_code INTEGER,
+                response TEXT,
+                expires_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                PRIMARY KEY (id),
+                FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE
+            )"""),
+        SQL('CREATE INDEX IF NOT EXISTS ix_idempotency_keys_id '
+            'ON idempotency_keys (id)'),
+        SQL('CREATE INDEX IF NOT EXISTS ix_idempotency_keys_expires_at '
+            'ON idempotency_keys (expires_at)'),
+        SQL('CREATE UNIQUE INDEX IF NOT EXISTS ix_idempotency_keys_user_id_key '
+            'ON idempotency_keys (user_id, key)'),
+    ]),
+    Migration(4, 'ledger_entries', [
+        SQL("""
+            CREATE TABLE IF NOT EXISTS ledger_entries (
+                id SERIAL NOT NULL,
+                created_at TIMESTAMP WITHOUT TIME ZONE,
+                updated_at TIMESTAMP WITHOUT TIME ZONE,
+                user_id INTEGER NOT NULL,
+                transfer_id VARCHAR(32),
+                amount FLOAT NOT NULL,
+                balance FLOAT NOT NULL,
+                PRIMARY KEY (id),
+                FOREIGN KEY(user_id) REFERENCES users (id)
+            )"""),
+        SQL('CREATE INDEX IF NOT EXISTS ix_ledger_entries_id '
+            'ON ledger_entries (id)'),
+        SQL('CREATE INDEX IF NOT EXISTS ix_ledger_entries_transfer_id '
+            'ON ledger_entries (transfer_id)'),
+        SQL('CREATE INDEX IF NOT EXISTS ix_ledger_entries_user_id_id '
+            'ON ledger_entries (user_id, id)'),
+    ]),
+    Migration(5, 'outbox_events', [
+        SQL("""
+            CREATE TABLE IF NOT EXISTS outbox_events (
+                id SERIAL NOT NULL,
+                created_at TIMESTAMP WITHOUT TIME ZONE,
+                updated_at TIMESTAMP WITHOUT TIME ZONE,
+                user_id INTEGER NOT NULL,
+                kind VARCHAR(16) NOT NULL,
+                amount FLOAT NOT NULL,
+                balance FLOAT NOT NULL,
+                transfer_id VARCHAR(32),
+                attempts INTEGER NOT NULL,
+                available_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                PRIMARY KEY (id),
+                FOREIGN KEY(user_id) REFERENCES users (id)
+            )"""),
+        SQL('CREATE INDEX IF NOT EXISTS ix_outbox_events_id '
+            'ON outbox_events (id)'),
+        SQL('CREATE INDEX IF NOT EXISTS ix_outbox_events_available_at '
+            'ON outbox_events (available_at)'),
+    ]),
+    # The live table becomes the partition of all rows up to the end of
+    # next month. Its rows are proven to fit by CHECK constraints, added
+    # NOT VALID and validated without blocking writes, and its primary key
+    # index is built concurrently, so that neither SET NOT NULL nor ATTACH
+    # PARTITION scan the table under their ACCESS EXCLUSIVE lock. The
+    # conversion runs last, in one transaction, with the partitions of the
+    # following months and a DEFAULT partition, so writes never miss a
+    # partition if the ledger maintenance job does not run. The id
+    # sequence is shared.
+    Migration(6, 'partitioned_ledger_entries', [
+        SQL("""
+            CREATE TABLE IF NOT EXISTS ledger_summaries (
+                id SERIAL NOT NULL,
+                created_at TIMESTAMP WITHOUT TIME ZONE,
+                updated_at TIMESTAMP WITHOUT TIME ZONE,
+                user_id INTEGER NOT NULL,
+                period_start TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                period_end TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                entries INTEGER NOT NULL,
+                amount FLOAT NOT NULL,
+                balance FLOAT NOT NULL,
+                first_entry_id INTEGER NOT NULL,
+                last_entry_id INTEGER NOT NULL,
+                PRIMARY KEY (id),
+                UNIQUE (user_id, period_start),
+                FOREIGN KEY(user_id) REFERENCES users (id)
+            )"""),
+        SQL('CREATE INDEX IF NOT EXISTS ix_ledger_summaries_id '
+            'ON ledger_summaries (id)'),
+        SQL("""
+            DO $$
+            BEGIN
+                IF (SELECT relkind FROM pg_class
+                    WHERE oid = CAST('ledger_entries' AS regclass)) <> 'r'
+                THEN
+                    RETURN;
+                END IF;
+                IF NOT EXISTS (
+                    SELECT FROM pg_constraint
+                    WHERE conname = 'ledger_entries_initial_created_at')
+                THEN
+                    ALTER TABLE ledger_entries
+                        ADD CONSTRAINT ledger_entries_initial_created_at
+                        CHECK (created_at IS NOT NULL) NOT VALID;
+                END IF;
+                IF NOT EXISTS (
+                    SELECT FROM pg_constraint
+                    WHERE conname = 'ledger_entries_initial_bound')
+                THEN
+                    EXECUTE format(
+                        'ALTER TABLE ledger_entries '
+                        'ADD CONSTRAINT ledger_entries_initial_bound '
+                        'CHECK (created_at < %L) NOT VALID',
+                        date_trunc('month', now() AT TIME ZONE 'utc')
+                        + interval '2 month');
+                END IF;
+            END
+            $$"""),
+        SQL("""
+            DO $$
+            BEGIN
+                IF (SELECT relkind FROM pg_class
+                    WHERE oid = CAST('ledger_entries' AS regclass)) = 'r'
+                THEN
+                    ALTER TABLE ledger_entries
+                        VALIDATE CONSTRAINT ledger_entries_initial_created_at;
+                    ALTER TABLE ledger_entries
+                        VALIDATE CONSTRAINT ledger_entries_initial_bound;
+                END IF;
+            END
+            $$"""),
+        # Becomes the primary key of the partition
+        CreateIndex('ledger_entries_initial_pkey_idx', 'ledger_entries',
+                    ['id', 'created_at'], unique=True),
+        SQL("""
+            DO $$
+            DECLARE
+                bound TIMESTAMP WITHOUT TIME ZONE;
+                month TIMESTAMP WITHOUT TIME ZONE;
+            BEGIN
+                IF (SELECT relkind FROM pg_class
+                    WHERE oid = CAST('ledger_entries' AS regclass)) <> 'r'
+                THEN
+                    RETURN;
+                END IF;
+                SELECT CAST(substring(
+                    pg_get_constraintdef(oid)
+                    FROM '[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9:]+')
+                    AS TIMESTAMP WITHOUT TIME ZONE)
+                INTO bound FROM pg_constraint
+                WHERE conname = 'ledger_entries_initial_bound';
+
+                ALTER TABLE ledger_entries RENAME TO ledger_entries_initial;
+                ALTER TABLE ledger_entries_initial
+                    DROP CONSTRAINT ledger_entries_pkey;
+                ALTER TABLE ledger_entries_initial
+                    ALTER COLUMN id DROP DEFAULT,
+                    ALTER COLUMN created_at SET NOT NULL;
+                ALTER TABLE ledger_entries_initial
+                    ADD CONSTRAINT ledger_entries_initial_pkey
+                    PRIMARY KEY USING INDEX ledger_entries_initial_pkey_idx;
+                DROP INDEX ix_ledger_entries_id;
+                ALTER INDEX ix_ledger_entries_transfer_id
+                    RENAME TO ledger_entries_initial_transfer_id_idx;
+                ALTER INDEX ix_ledger_entries_user_id_id
+                    RENAME TO ledger_entries_initial_user_id_id_idx;
+
+                CREATE TABLE ledger_entries (
+                    id INTEGER NOT NULL
+                        DEFAULT nextval('ledger_entries_id_seq'),
+                    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                    updated_at TIMESTAMP WITHOUT TIME ZONE,
+                    user_id INTEGER NOT NULL,
+                    transfer_id VARCHAR(32),
+                    amount FLOAT NOT NULL,
+                    balance FLOAT NOT NULL,
+                    PRIMARY KEY (id, created_at),
+                    FOREIGN KEY(user_id) REFERENCES users (id)
+                ) PARTITION BY RANGE (created_at);
+                ALTER SEQUENCE ledger_entries_id_seq
+                    OWNED BY ledger_entries.id;
+                CREATE INDEX ix_ledger_entries_transfer_id
+                    ON ledger_entries (transfer_id);
+                CREATE INDEX ix_ledger_entries_user_id_id
+                    ON ledger_entries (user_id, id);
+
+                EXECUTE format(
+                    'ALTER TABLE ledger_entries '
+                    'ATTACH PARTITION ledger_entries_initial '
+                    'FOR VALUES FROM (MINVALUE) TO (%L)', bound);
+                ALTER TABLE ledger_entries_initial
+                    DROP CONSTRAINT ledger_entries_initial_created_at,
+                    DROP CONSTRAINT ledger_entries_initial_bound;
+
+                FOR month IN SELECT generate_series(
+                    bound, bound + interval '2 month', interval '1 month')
+                LOOP
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF ledger_entries '
+                        'FOR VALUES FROM (%L) TO (%L)',
+                        'ledger_entries_p' || to_char(month, 'YYYYMM'),
+                        month, month + interval '1 month');
+                END LOOP;
+                CREATE TABLE ledger_entries_default
+                    PARTITION OF ledger_entries DEFAULT;
+            END
+            $$"""),
+    ]),
+    Migration(7, 'balance_snapshots', [
+        # Indexes of a partitioned table can not be built concurrently,
+        # its partitions are indexed in one go
+        SQL('CREATE INDEX IF NOT EXISTS ix_ledger_entries_user_id_created_at '
+            'ON ledger_entries (user_id, created_at)'),
+        SQL("""
+            CREATE TABLE IF NOT EXISTS balance_snapshots (
+                id SERIAL NOT NULL,
+                created_at TIMESTAMP WITHOUT TIME ZONE,
+                updated_at TIMESTAMP WITHOUT TIME ZONE,
+                user_id INTEGER NOT NULL,
+                taken_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                balance FLOAT NOT NULL,
+                PRIMARY KEY (id),
+                UNIQUE (user_id, taken_at),
+                FOREIGN KEY(user_id) REFERENCES users (id)
+            )"""),
+        SQL('CREATE INDEX IF NOT EXISTS ix_balance_snapshots_id '
+            'ON balance_snapshots (id)'),
+        SQL("""
+            CREATE TABLE IF NOT EXISTS balance_snapshot_runs (
+                id SERIAL NOT NULL,
+                created_at TIMESTAMP WITHOUT TIME ZONE,
+                updated_at TIMESTAMP WITHOUT TIME ZONE,
+                taken_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                users INTEGER NOT NULL,
+                PRIMARY KEY (id),
+                UNIQUE (taken_at)
+            )"""),
+        SQL('CREATE INDEX IF NOT EXISTS ix_balance_snapshot_runs_id '
+            'ON balance_snapshot_runs (id)'),
+    ]),
+    # Adding a NOT NULL column with a constant default only touches the
+    # catalog, existing rows read as USD without a table rewrite. The
+    # composite unique indexes, which upserts name as their conflict
+    # target, are built before the narrower constraints are dropped.
+    Migration(8, 'balance_currencies', [
+        SQL("ALTER TABLE balances ADD COLUMN IF NOT EXISTS "
+            "currency VARCHAR(3) NOT NULL DEFAULT 'USD'"),
+        SQL("ALTER TABLE ledger_entries ADD COLUMN IF NOT EXISTS "
+            "currency VARCHAR(3) NOT NULL DEFAULT 'USD'"),
+        SQL("ALTER TABLE ledger_summaries ADD COLUMN IF NOT EXISTS "
+            "currency VARCHAR(3) NOT NULL DEFAULT 'USD'"),
+        SQL("ALTER TABLE balance_snapshots ADD COLUMN IF NOT EXISTS "
+            "currency VARCHAR(3) NOT NULL DEFAULT 'USD'"),
+        SQL("ALTER TABLE outbox_events ADD COLUMN IF NOT EXISTS "
+            "currency VARCHAR(3) NOT NULL DEFAULT 'USD'"),
+        CreateIndex('ix_balances_user_id_currency', 'balances',
+                    ['user_id', 'currency'], unique=True),
+        SQL('ALTER TABLE balances DROP CONSTRAINT IF EXISTS '
+            'balances_user_id_key'),
+        CreateIndex('ledger_summaries_user_id_currency_period_start_key',
+                    'ledger_summaries',
+                    ['user_id', 'currency', 'period_start'], unique=True),
+        SQL('ALTER TABLE ledger_summaries DROP CONSTRAINT IF EXISTS '
+            'ledger_summaries_user_id_period_start_key'),
+        CreateIndex('balance_snapshots_user_id_currency_taken_at_key',
+                    'balance_snapshots',
+                    ['user_id', 'currency', 'taken_at'], unique=True),
+        SQL('ALTER TABLE balance_snapshots DROP CONSTRAINT IF EXISTS '
+            'balance_snapshots_user_id_taken_at_key'),
+    ]),
+    # Catalog-only column like the currencies of migration 8. Only open
+    # holds are indexed by expiry time, so the index stays small however
+    # many settled holds the table keeps.
+    Migration(9, 'balance_holds', [
+        SQL('ALTER TABLE balances ADD COLUMN IF NOT EXISTS '
+            'held FLOAT NOT NULL DEFAULT 0'),
+        SQL("""
+            CREATE TABLE IF NOT EXISTS holds (
+                id SERIAL NOT NULL,
+                created_at TIMESTAMP WITHOUT TIME ZONE,
+                updated_at TIMESTAMP WITHOUT TIME ZONE,
+                user_id INTEGER NOT NULL,
+                currency VARCHAR(3) NOT NULL,
+                amount FLOAT NOT NULL,
+                status VARCHAR(16) NOT NULL,
+                captured FLOAT,
+                expires_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                PRIMARY KEY (id),
+                FOREIGN KEY(user_id) REFERENCES users (id)
+            )"""),
+        SQL('CREATE INDEX IF NOT EXISTS ix_holds_id ON holds (id)'),
+        SQL('CREATE INDEX IF NOT EXISTS ix_holds_expires_at '
+            "ON holds (expires_at) WHERE status = 'held'"),
+    ]),
+    # Credits of transfers to users of other shards, waiting on the
+    # sender's shard to be delivered on the recipient's
+    Migration(10, 'transfer_credits', [
+        SQL("""
+            CREATE TABLE IF NOT EXISTS transfer_credits (
+                id SERIAL NOT NULL,
+                created_at TIMESTAMP WITHOUT TIME ZONE,
+                updated_at TIMESTAMP WITHOUT TIME ZONE,
+                transfer_id VARCHAR(32) NOT NULL,
+                sender_id INTEGER NOT NULL,
+                recipient_id INTEGER NOT NULL,
+                currency VARCHAR(3) NOT NULL,
+                amount FLOAT NOT NULL,
+                attempts INTEGER NOT NULL,
+                available_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                PRIMARY KEY (id),
+                UNIQUE (transfer_id),
+                FOREIGN KEY(sender_id) REFERENCES users (id)
+            )"""),
+        SQL('CREATE INDEX IF NOT EXISTS ix_transfer_credits_id '
+            'ON transfer_credits (id)'),
+        SQL('CREATE INDEX IF NOT EXISTS ix_transfer_credits_available_at '
+            'ON transfer_credits (available_at)'),
+    ]),
+    Migration(11, 'received_transfers', [
+        SQL("""
+            CREATE TABLE IF NOT EXISTS received_transfers (
+                id SERIAL NOT NULL,
+                created_at TIMESTAMP WITHOUT TIME ZONE,
+                updated_at TIMESTAMP WITHOUT TIME ZONE,
+                transfer_id VARCHAR(32) NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (id),
+                UNIQUE (transfer_id, user_id),
+                FOREIGN KEY(user_id) REFERENCES users (id)
+            )"""),
+        SQL('CREATE INDEX IF NOT EXISTS ix_received_transfers_id '
+            'ON received_transfers (id)'),
+        # Credits of transfers received before may still be delivered again
+        SQL("""
+            INSERT INTO received_transfers (created_at, transfer_id, user_id)
+            SELECT min(created_at), transfer_id, user_id FROM ledger_entries
+            WHERE transfer_id IS NOT NULL AND amount > 0
+            GROUP BY transfer_id, user_id
+            ON CONFLICT DO NOTHING"""),
+    ]),
+]
@@ -1,3 +1,10 @@
 from .base import *
+from .partitions import *
 from .users import *
 from .balances import *
+from .holds import *
+from .idempotency import *
+from .ledger import *
+from .snapshots import *
+from .outbox import *
+from .transfers import *
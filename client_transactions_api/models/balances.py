@@ -1,38 +1,77 @@
 import logging
+from datetime import datetime
+from typing import List
 
 from fastapi import HTTPException, status
-from sqlalchemy import Column, Float, ForeignKey, Integer
+from sqlalchemy import (Column, Float, ForeignKey, Index, Integer, String,
+                        select, tuple_, update)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from client_transactions_api.services.cache import BalanceCache
 from client_transactions_api.services.offline import OfflineException
 
 from .base import BaseModel
+from .ledger import LedgerEntry
+from .transfers import ReceivedTransfer, TransferCredit
 
 logger = logging.getLogger(__name__)
 
 
 class Balance(BaseModel):
-    """Balance class"""
+    """Balance of a user in one currency
 
-    user_id = Column(Integer, ForeignKey('users.id'), unique=True)
+    Users have one balance per currency they hold, created by its first
+    transaction. Balances of different currencies never mix. The `held`
+    part of the value is reserved by open holds, debits can only spend
+    the rest of it.
+    """
+
+    __table_args__ = (
+        Index('ix_balances_user_id_currency', 'user_id', 'currency',
+              unique=True),
+    )
+
+    user_id = Column(Integer, ForeignKey('users.id'))
+    # ISO 4217 code
+    currency = Column(String(3), nullable=False)
 
     value = Column(Float, default=0.0)
+    # Sum of the open holds on the balance
+    held = Column(Float, nullable=False, default=0.0)
 
     def __init__(self,
                  user_id: int,
+                 currency: str,
                  value: float = 0.0):
         self.user_id = user_id
+        self.currency = currency
         self.value = value
 
     @classmethod
     async def get_or_create(
         cls,
         db_session: AsyncSession,
-        user_id: int
+        user_id: int,
+        currency: str,
+        for_update: bool = False
     ) -> "Balance | OfflineException":
-        """Get or create new balance"""
+        """Get or create new balance of a user in a currency
 
-        balance = await cls.get(db_session, raise_404=False, user_id=user_id)
+        Args:
+            for_update (bool, optional): Lock balance row until the end of
+                the transaction, serializing writes across workers.
+                Defaults to False.
+        """
+
+        db_query = select(cls).where(
+            cls.user_id == user_id, cls.currency == currency)
+        if for_update:
+            # Refresh a balance already loaded by the session
+            db_query = db_query.with_for_update() \
+                .execution_options(populate_existing=True)
+        balance = await cls.get(db_session, db_query=db_query, raise_404=False)
 
         if type(balance) is OfflineException:
             logger.info('OfflineException return')
@@ -40,38 +79,437 @@ class Balance(BaseModel):
 
         # Create new balance if none
         if not balance:
-            balance = await cls(user_id=user_id).save(db_session)
+            balance = await cls(
+                user_id=user_id, currency=currency).save(db_session)
         return balance
 
+    @classmethod
+    async def get_all(
+        cls,
+        db_session: AsyncSession,
+        user_id: int
+    ) -> "List[Balance] | OfflineException":
+        """Get balances of a user in all currencies, by currency"""
+
+        db_query = select(cls).where(cls.user_id == user_id) \
+            .order_by(cls.currency)
+        try:
+            result = await db_session.execute(db_query)
+            return result.scalars().all()
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
     @classmethod
     async def transaction(
         cls,
         db_session: AsyncSession,
         user_id: int,
-        sum: float = 0
+        currency: str,
+        sum: float = 0,
+        commit: bool = True
     ) -> "Balance | OfflineException":
         """Make a transaction for a user
 
         Args:
             db_session (AsyncSession): Current db session
             user_id (int): User id
+            currency (str): Currency of the balance
             sum (float): Transaction sum (negative or positive)
+            commit (bool, optional): Commit the transaction, only flush
+                it otherwise, for the caller to commit more changes with
+                it. Defaults to True.
 
         Returns:
             result (Balance): Balance object
         """
 
-        balance = await cls.get_or_create(db_session, user_id=user_id)
+        # Locked, so that holds placed by other workers are accounted for
+        balance = await cls.get_or_create(
+            db_session, user_id=user_id, currency=currency, for_update=True)
 
         if type(balance) is OfflineException:
             logger.info('OfflineException return')
             return balance
 
         new_balance_value = balance.value + sum
-        if new_balance_value < 0:
+        if new_balance_value < balance.held:
             raise HTTPException(
                 status_code=status.HTTP_402_PAYMENT_REQUIRED,
-                detail=f'Not enough funds ({balance.value:.2f}) for a {sum:.2f} transaction!')
+                detail=f'Not enough funds ({balance.value - balance.held:.2f}) for a {sum:.2f} transaction!')
+
+        entry = await LedgerEntry.record(db_session, 'transaction', [
+            {'user_id': user_id, 'currency': currency, 'amount': sum,
+             'balance': new_balance_value}])
+        if type(entry) is OfflineException:
+            return entry
 
         balance.value = new_balance_value
-        return await balance.update(db_session)
+        balance = await balance.update(db_session, commit=commit)
+        if commit and type(balance) is not OfflineException:
+            BalanceCache.write(balance)
+        return balance
+
+    @classmethod
+    async def _reload(
+        cls,
+        db_session: AsyncSession,
+        user_id: int,
+        currency: str
+    ) -> "Balance | None | OfflineException":
+        """Read a balance again after a bulk update"""
+
+        db_query = select(cls).where(
+            cls.user_id == user_id, cls.currency == currency) \
+            .execution_options(populate_existing=True)
+        return await cls.get(db_session, db_query=db_query, raise_404=False)
+
+    @classmethod
+    async def reserve(
+        cls,
+        db_session: AsyncSession,
+        user_id: int,
+        currency: str,
+        sum: float
+    ) -> "Balance | OfflineException":
+        """Hold a sum of a balance, does not commit
+
+        Available funds are checked and the sum held by one conditional
+        update, which locks the balance row until the end of the
+        transaction.
+        """
+
+        db_query = update(cls).where(
+            cls.user_id == user_id,
+            cls.currency == currency,
+            cls.value - cls.held >= sum
+        ).values(
+            held=cls.held + sum,
+            updated_at=datetime.utcnow()
+        ).execution_options(synchronize_session=False)
+        try:
+            result = await db_session.execute(db_query)
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+        balance = await cls._reload(db_session, user_id, currency)
+        if type(balance) is OfflineException or result.rowcount:
+            return balance
+        available = balance.value - balance.held if balance else 0.0
+        raise HTTPException(
+            status_code=status.HTTP_402_PAYMENT_REQUIRED,
+            detail=f'Not enough funds ({available:.2f}) for a {sum:.2f} hold!')
+
+    @classmethod
+    async def release(
+        cls,
+        db_session: AsyncSession,
+        user_id: int,
+        currency: str,
+        held: float,
+        captured: float = 0.0
+    ) -> "Balance | OfflineException":
+        """Release a held sum, debiting the captured part of it, with one
+        update, does not commit"""
+
+        db_query = update(cls).where(
+            cls.user_id == user_id,
+            cls.currency == currency
+        ).values(
+            value=cls.value - captured,
+            held=cls.held - held,
+            updated_at=datetime.utcnow()
+        ).execution_options(synchronize_session=False)
+        try:
+            await db_session.execute(db_query)
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+        return await cls._reload(db_session, user_id, currency)
+
+    @classmethod
+    async def get_many_for_update(
+        cls,
+        db_session: AsyncSession,
+        keys: List[tuple[int, str]]
+    ) -> "dict[tuple[int, str], Balance] | OfflineException":
+        """Get and lock balances by user id and currency
+
+        Rows are locked in user_id and currency order, so that concurrent
+        batches never deadlock on each other.
+        """
+
+        db_query = select(cls) \
+            .where(tuple_(cls.user_id, cls.currency).in_(keys)) \
+            .order_by(cls.user_id, cls.currency).with_for_update() \
+            .execution_options(populate_existing=True)
+        try:
+            result = await db_session.execute(db_query)
+            return {(balance.user_id, balance.currency): balance
+                    for balance in result.scalars()}
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def add_many(
+        cls,
+        db_session: AsyncSession,
+        deltas: dict[tuple[int, str], float]
+    ) -> None | OfflineException:
+        """Add sums to balances by user id and currency with one upsert
+
+        Balances that do not exist yet are created with the sum as value.
+        Does not commit, nor check for sufficient funds.
+        """
+
+        if db_session.bind.dialect.name == 'postgresql':
+            insert = postgresql.insert
+        else:
+            insert = sqlite.insert
+
+        now = datetime.utcnow()
+        db_query = insert(cls).values([
+            {'user_id': user_id, 'currency': currency, 'value': delta,
+             'created_at': now, 'updated_at': now}
+            for (user_id, currency), delta in deltas.items()])
+        db_query = db_query.on_conflict_do_update(
+            index_elements=[cls.user_id, cls.currency],
+            set_={
+                'value': cls.value + db_query.excluded.value,
+                'updated_at': db_query.excluded.updated_at,
+            })
+        try:
+            await db_session.execute(db_query)
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def create_missing(
+        cls,
+        db_session: AsyncSession,
+        keys: List[tuple[int, str]]
+    ) -> None | OfflineException:
+        """Create missing balances by user id and currency, does not commit
+
+        Existing rows are left alone and not locked. Rows are inserted in
+        user_id and currency order, the order `get_many_for_update` locks
+        them in, so that concurrent inserts never deadlock either.
+        """
+
+        if db_session.bind.dialect.name == 'postgresql':
+            insert = postgresql.insert
+        else:
+            insert = sqlite.insert
+
+        now = datetime.utcnow()
+        db_query = insert(cls).values([
+            {'user_id': user_id, 'currency': currency, 'value': 0.0,
+             'created_at': now}
+            for user_id, currency in sorted(keys)])
+        db_query = db_query.on_conflict_do_nothing(
+            index_elements=[cls.user_id, cls.currency])
+        try:
+            await db_session.execute(db_query)
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def transfer(
+        cls,
+        db_session: AsyncSession,
+        sender_id: int,
+        recipient_id: int,
+        sum: float,
+        transfer_id: str,
+        currency: str
+    ) -> "tuple[Balance, Balance] | OfflineException":
+        """Move funds between balances of two users in one currency
+
+        Both balance rows are locked in user_id order, so that concurrent
+        transfers in opposite directions never deadlock, and both ledger
+        legs are written with the balances.
+
+        Returns:
+            result (tuple): Sender and recipient balances
+        """
+
+        keys = [(sender_id, currency), (recipient_id, currency)]
+        created = await cls.create_missing(db_session, keys)
+        if type(created) is OfflineException:
+            return created
+
+        balances = await cls.get_many_for_update(db_session, keys)
+        if type(balances) is OfflineException:
+            return balances
+        sender, recipient = (balances[key] for key in keys)
+
+        if sender.value - sum < sender.held:
+            raise HTTPException(
+                status_code=status.HTTP_402_PAYMENT_REQUIRED,
+                detail=f'Not enough funds ({sender.value - sender.held:.2f}) for a {sum:.2f} transfer!')
+
+        sender.value -= sum
+        recipient.value += sum
+        legs = await LedgerEntry.record(db_session, 'transfer', [
+            {'user_id': sender_id, 'currency': currency, 'amount': -sum,
+             'balance': sender.value, 'transfer_id': transfer_id},
+            {'user_id': recipient_id, 'currency': currency, 'amount': sum,
+             'balance': recipient.value, 'transfer_id': transfer_id},
+        ])
+        if type(legs) is OfflineException:
+            return legs
+
+        try:
+            await db_session.commit()
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+        return sender, recipient
+
+    @classmethod
+    async def send(
+        cls,
+        db_session: AsyncSession,
+        sender_id: int,
+        recipient_id: int,
+        sum: float,
+        transfer_id: str,
+        currency: str
+    ) -> "Balance | OfflineException":
+        """Debit the sender of a transfer to a user of another shard
+
+        The sender's ledger leg and the credit of the recipient, delivered
+        later on the recipient's shard by `receive`, are written with the
+        sender's balance in one DB transaction.
+
+        Returns:
+            result (Balance): Sender's balance
+        """
+
+        keys = [(sender_id, currency)]
+        created = await cls.create_missing(db_session, keys)
+        if type(created) is OfflineException:
+            return created
+
+        balances = await cls.get_many_for_update(db_session, keys)
+        if type(balances) is OfflineException:
+            return balances
+        sender = balances[keys[0]]
+
+        if sender.value - sum < sender.held:
+            raise HTTPException(
+                status_code=status.HTTP_402_PAYMENT_REQUIRED,
+                detail=f'Not enough funds ({sender.value - sender.held:.2f}) for a {sum:.2f} transfer!')
+
+        sender.value -= sum
+        leg = await LedgerEntry.record(db_session, 'transfer', [
+            {'user_id': sender_id, 'currency': currency, 'amount': -sum,
+             'balance': sender.value, 'transfer_id': transfer_id}])
+        if type(leg) is OfflineException:
+            return leg
+        db_session.add(TransferCredit(
+            transfer_id, sender_id, recipient_id, currency, sum))
+
+        try:
+            await db_session.commit()
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+        return sender
+
+    @classmethod
+    async def receive(
+        cls,
+        db_session: AsyncSession,
+        recipient_id: int,
+        sum: float,
+        transfer_id: str,
+        currency: str
+    ) -> "Balance | None | OfflineException":
+        """Credit the recipient of a transfer from a user of another shard
+
+        Credits are delivered at least once, the recipient is credited
+        once: the transfer is recorded as received with the credit, and
+        looked up under the lock of the recipient's balance, which is left
+        alone if it was received before.
+
+        Returns:
+            result (Balance): Recipient's balance, None if already credited
+        """
+
+        keys = [(recipient_id, currency)]
+        created = await cls.create_missing(db_session, keys)
+        if type(created) is OfflineException:
+            return created
+
+        balances = await cls.get_many_for_update(db_session, keys)
+        if type(balances) is OfflineException:
+            return balances
+        recipient = balances[keys[0]]
+
+        received = await ReceivedTransfer.get(
+            db_session,
+            db_query=select(ReceivedTransfer).where(
+                ReceivedTransfer.transfer_id == transfer_id,
+                ReceivedTransfer.user_id == recipient_id),
+            raise_404=False)
+        if type(received) is OfflineException:
+            return received
+        if received is not None:
+            await db_session.rollback()
+            return None
+
+        recipient.value += sum
+        leg = await LedgerEntry.record(db_session, 'transfer', [
+            {'user_id': recipient_id, 'currency': currency, 'amount': sum,
+             'balance': recipient.value, 'transfer_id': transfer_id}])
+        if type(leg) is OfflineException:
+            return leg
+        db_session.add(ReceivedTransfer(transfer_id, recipient_id))
+
+        try:
+            await db_session.commit()
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+        return recipient
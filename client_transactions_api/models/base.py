@@ -1,11 +1,15 @@
+import asyncio
+import heapq
 import logging
 from datetime import datetime
 from typing import List
 
 from fastapi import HTTPException, status
+from fastapi_pagination import resolve_params
+from fastapi_pagination.api import create_page
 from fastapi_pagination.bases import AbstractPage
 from fastapi_pagination.ext.async_sqlalchemy import paginate
-from sqlalchemy import Column, DateTime, Integer, func, inspect, select
+from sqlalchemy import Column, DateTime, Integer, String, func, inspect, select
 from sqlalchemy.engine.result import Result
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -94,7 +98,7 @@ class BaseModel(Base):
             Database model or None
         """
 
-        if not db_query:
+        if db_query is None:
             if not len(kwarg):
                 db_query = select(cls)
             else:
@@ -126,15 +130,24 @@ class BaseModel(Base):
     async def update(
         self,
         db_session: AsyncSession,
+        commit: bool = True,
         **kwargs
     ) -> "BaseModel | OfflineException":
-        """Update model object with provided attributes"""
+        """Update model object with provided attributes
+
+        Args:
+            commit (bool, optional): Commit the transaction, only flush
+                the update otherwise. Defaults to True.
+        """
 
         for k, v in kwargs.items():
             setattr(self, k, v)
         try:
             db_session.add(self)
-            await db_session.commit()
+            if commit:
+                await db_session.commit()
+            else:
+                await db_session.flush()
             return self
         except SQLAlchemyError as ex:
             raise HTTPException(
@@ -158,6 +171,38 @@ class BaseModel(Base):
             logger.warning('ConnectionRefusedError raised')
             return OfflineException()
 
+    @classmethod
+    def _sort_column(cls, sort_by: str | None = None) -> str:
+        if not sort_by:
+            sort_by = inspect(cls).primary_key[0].name
+        return cls.__table__.columns.get(sort_by).name
+
+    @classmethod
+    def _list_query(
+        cls,
+        sort_by: str | None = None,
+        desc: bool = True,
+        collation: str | None = None,
+        **kwargs
+    ) -> Select:
+        """Query of objects sorted by a column and filtered by kwargs,
+        text columns in `collation` if given"""
+
+        filter_by = {k: v for k, v in kwargs.items() if v is not None}
+
+        column = cls._sort_column(sort_by)
+        sort = 'desc'
+        if not desc:
+            sort = 'asc'
+        order = column
+        if collation and isinstance(
+                cls.__table__.columns[column].type, String):
+            order = f'{column} COLLATE "{collation}"'
+        if len(filter_by):
+            return select(cls).order_by(
+                text(f'{order} {sort}')).filter_by(**filter_by)
+        return select(cls).order_by(text(f'{order} {sort}'))
+
     @classmethod
     async def _get_objects(
         cls,
@@ -185,20 +230,8 @@ class BaseModel(Base):
             Database models or None
         """
 
-        filter_by = {k: v for k, v in kwargs.items() if v is not None}
-
-        if not sort_by:
-            sort_by = inspect(cls).primary_key[0].name
         if db_query is None:
-            column = cls.__table__.columns.get(sort_by).name
-            sort = 'desc'
-            if not desc:
-                sort = 'asc'
-            if len(filter_by):
-                db_query = select(cls).order_by(
-                    text(f'{column} {sort}')).filter_by(**filter_by)
-            else:
-                db_query = select(cls).order_by(text(f'{column} {sort}'))
+            db_query = cls._list_query(sort_by, desc, **kwargs)
 
         try:
             if paginated:
@@ -251,6 +284,70 @@ class BaseModel(Base):
 
         return await cls._get_objects(db_session, paginated=True, **kwargs)
 
+    @classmethod
+    async def paginate_shards(
+        cls,
+        db_sessions: List[AsyncSession],
+        sort_by: str | None = None,
+        desc: bool = True,
+        **kwargs
+    ) -> "AbstractPage | OfflineException":
+        """Get paginated list of objects of all shards
+
+        Every shard is queried at once for its count and its first
+        `offset + limit` objects, which are merged in sort order to take
+        the page. Deep pages cost more on every shard. Shards sort text
+        byte-wise (collation "C"), in the order of Python strings, so that
+        the merge agrees with them whatever the database collation.
+
+        Args:
+            db_sessions (list): Sessions of all shards
+        """
+
+        if len(db_sessions) == 1:
+            return await cls.paginate(
+                db_sessions[0], sort_by=sort_by, desc=desc, **kwargs)
+
+        params = resolve_params()
+        raw_params = params.to_raw_params()
+        # SQLite compares text byte-wise already
+        collation = None
+        if db_sessions[0].bind.dialect.name == 'postgresql':
+            collation = 'C'
+        db_query = cls._list_query(sort_by, desc, collation, **kwargs)
+        count_query = select(func.count()).select_from(
+            db_query.order_by(None).subquery())
+        db_query = db_query.limit(raw_params.offset + raw_params.limit)
+
+        async def shard_page(db_session: AsyncSession) -> tuple[int, list]:
+            total = await db_session.scalar(count_query)
+            result = await db_session.execute(db_query)
+            return total, result.scalars().all()
+
+        try:
+            pages = await asyncio.gather(*map(shard_page, db_sessions))
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+        column = cls._sort_column(sort_by)
+
+        def key(obj: BaseModel) -> tuple:
+            # Postgres sorts NULLs as larger than any value
+            value = getattr(obj, column)
+            return value is None, value
+
+        items = list(heapq.merge(
+            *(objects for _, objects in pages), key=key, reverse=desc))
+        return create_page(
+            items[raw_params.offset:raw_params.offset + raw_params.limit],
+            sum(total for total, _ in pages),
+            params)
+
     @classmethod
     async def get_distinct(
         cls,
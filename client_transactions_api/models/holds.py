@@ -0,0 +1,284 @@
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import List
+
+from fastapi import HTTPException, status
+from sqlalchemy import (Column, DateTime, Float, ForeignKey, Index, Integer,
+                        String, select, text, update)
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from client_transactions_api.services.offline import OfflineException
+
+from .balances import Balance
+from .base import BaseModel
+from .ledger import LedgerEntry
+
+logger = logging.getLogger(__name__)
+
+
+class Hold(BaseModel):
+    """Funds of a balance reserved for a later debit
+
+    A hold is open until it is captured, debiting all or part of its sum
+    and releasing the rest, voided, or expired by the hold sweeper. Open
+    holds are closed by conditional updates that only match open holds,
+    so a hold is closed exactly once, whatever closes it first.
+    """
+
+    __table_args__ = (
+        # Only open holds are indexed, the sweeper's range scan stays as
+        # small as the number of open holds
+        Index('ix_holds_expires_at', 'expires_at',
+              postgresql_where=text("status = 'held'"),
+              sqlite_where=text("status = 'held'")),
+    )
+
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    currency = Column(String(3), nullable=False)
+    amount = Column(Float, nullable=False)
+    # held, captured, voided or expired
+    status = Column(String(16), nullable=False, default='held')
+    # Debited sum of a captured hold
+    captured = Column(Float, nullable=True)
+    expires_at = Column(DateTime, nullable=False)
+
+    def __init__(self,
+                 user_id: int,
+                 currency: str,
+                 amount: float,
+                 ttl: int):
+        self.user_id = user_id
+        self.currency = currency
+        self.amount = amount
+        self.status = 'held'
+        self.expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+
+    @classmethod
+    async def place(
+        cls,
+        db_session: AsyncSession,
+        user_id: int,
+        currency: str,
+        sum: float,
+        ttl: int
+    ) -> "tuple[Hold, Balance] | OfflineException":
+        """Hold a sum of a user's balance for ttl seconds
+
+        Returns:
+            result (tuple): Hold and the balance it is held on
+        """
+
+        balance = await Balance.reserve(db_session, user_id, currency, sum)
+        if type(balance) is OfflineException:
+            return balance
+
+        hold = cls(user_id=user_id, currency=currency, amount=sum, ttl=ttl)
+        try:
+            db_session.add(hold)
+            await db_session.commit()
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+        return hold, balance
+
+    @classmethod
+    async def _close(
+        cls,
+        db_session: AsyncSession,
+        hold_id: int,
+        user_id: int,
+        closed_as: str,
+        sum: float | None = None
+    ) -> "Hold | OfflineException":
+        """Close a user's open hold with one conditional update, does not
+        commit
+
+        Captures only match holds that have not expired, nor are smaller
+        than the captured sum. Holds that do not match explain why.
+        """
+
+        now = datetime.utcnow()
+        db_query = update(cls).where(
+            cls.id == hold_id,
+            cls.user_id == user_id,
+            cls.status == 'held')
+        values = {'status': closed_as, 'updated_at': now}
+        if closed_as == 'captured':
+            db_query = db_query.where(cls.expires_at > now)
+            if sum is None:
+                values['captured'] = cls.amount
+            else:
+                db_query = db_query.where(cls.amount >= sum)
+                values['captured'] = sum
+        db_query = db_query.values(**values) \
+            .execution_options(synchronize_session=False)
+        try:
+            result = await db_session.execute(db_query)
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+        hold = await cls.get(
+            db_session,
+            db_query=select(cls).where(
+                cls.id == hold_id, cls.user_id == user_id)
+            .execution_options(populate_existing=True),
+            raise_404=False)
+        if type(hold) is OfflineException or result.rowcount:
+            return hold
+
+        if hold is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f'Hold {hold_id} not found')
+        if hold.status != 'held':
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f'Hold {hold_id} is already {hold.status}')
+        if hold.expires_at <= now:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f'Hold {hold_id} has expired')
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f'Can not capture {sum:.2f} of a {hold.amount:.2f} hold')
+
+    @classmethod
+    async def capture(
+        cls,
+        db_session: AsyncSession,
+        hold_id: int,
+        user_id: int,
+        sum: float | None = None
+    ) -> "tuple[Hold, Balance] | OfflineException":
+        """Debit a sum of a user's open hold, all of it by default, and
+        release the rest
+
+        The debit is written to the ledger with the balance.
+        """
+
+        hold = await cls._close(db_session, hold_id, user_id, 'captured', sum)
+        if type(hold) is OfflineException:
+            return hold
+
+        balance = await Balance.release(
+            db_session, user_id, hold.currency, hold.amount,
+            captured=hold.captured)
+        if type(balance) is OfflineException:
+            return balance
+        entry = await LedgerEntry.record(db_session, 'capture', [
+            {'user_id': user_id, 'currency': hold.currency,
+             'amount': -hold.captured, 'balance': balance.value}])
+        if type(entry) is OfflineException:
+            return entry
+
+        try:
+            await db_session.commit()
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+        return hold, balance
+
+    @classmethod
+    async def void(
+        cls,
+        db_session: AsyncSession,
+        hold_id: int,
+        user_id: int
+    ) -> "tuple[Hold, Balance] | OfflineException":
+        """Release all of a user's open hold"""
+
+        hold = await cls._close(db_session, hold_id, user_id, 'voided')
+        if type(hold) is OfflineException:
+            return hold
+
+        balance = await Balance.release(
+            db_session, user_id, hold.currency, hold.amount)
+        if type(balance) is OfflineException:
+            return balance
+
+        try:
+            await db_session.commit()
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+        return hold, balance
+
+    @classmethod
+    async def expire_due(
+        cls,
+        db_session: AsyncSession,
+        batch_size: int = 500
+    ) -> "List[Balance] | OfflineException":
+        """Expire a batch of open holds past their expiry time
+
+        Due holds are read from the partial index of open holds, those
+        locked by a capture, void or another sweeper are skipped on
+        Postgres. Their balances are locked in user_id and currency order
+        and released in the same DB transaction.
+
+        Returns:
+            result (list): Balances with released holds, empty once no
+                holds are due
+        """
+
+        db_query = select(cls).where(
+            cls.status == 'held',
+            cls.expires_at <= datetime.utcnow()
+        ).order_by(cls.expires_at).limit(batch_size) \
+            .with_for_update(skip_locked=True)
+        try:
+            result = await db_session.execute(db_query)
+            holds = result.scalars().all()
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+        if not len(holds):
+            return []
+
+        released = defaultdict(float)
+        for hold in holds:
+            hold.status = 'expired'
+            released[(hold.user_id, hold.currency)] += hold.amount
+
+        balances = await Balance.get_many_for_update(
+            db_session, sorted(released))
+        if type(balances) is OfflineException:
+            return balances
+        for key, balance in balances.items():
+            balance.held -= released[key]
+
+        try:
+            await db_session.commit()
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+        logger.info(
+            f'Expired {len(holds)} holds of {len(balances)} balances')
+        return list(balances.values())
@@ -0,0 +1,155 @@
+import logging
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException, status
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Integer, String,
+                        Text, delete, select)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from client_transactions_api.services.offline import OfflineException
+
+from .base import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyKey(BaseModel):
+    """Stored result of a request made with an Idempotency-Key header"""
+
+    __table_args__ = (
+        Index('ix_idempotency_keys_user_id_key', 'user_id', 'key', unique=True),
+    )
+
+    user_id = Column(
+        Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    key = Column(String(64), nullable=False)
+    fingerprint = Column(String(32), nullable=False)
+
+    # Empty until the request's result is known
+    status_code = Column(Integer, nullable=True)
+    response = Column(Text, nullable=True)
+
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def __init__(self,
+                 user_id: int,
+                 key: str,
+                 fingerprint: str,
+                 ttl: int,
+                 status_code: int | None = None,
+                 response: str | None = None):
+        self.user_id = user_id
+        self.key = key
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        self.response = response
+        self.expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+
+    @classmethod
+    async def lookup(
+        cls,
+        db_session: AsyncSession,
+        user_id: int,
+        key: str
+    ) -> "IdempotencyKey | None | OfflineException":
+        """Get a user's non expired key"""
+
+        db_query = select(cls).where(
+            cls.user_id == user_id,
+            cls.key == key,
+            cls.expires_at > datetime.utcnow())
+        return await cls.get(db_session, db_query=db_query, raise_404=False)
+
+    @classmethod
+    async def reserve(
+        cls,
+        db_session: AsyncSession,
+        user_id: int,
+        key: str,
+        fingerprint: str,
+        ttl: int
+    ) -> "IdempotencyKey | OfflineException":
+        """Reserve key within the current transaction
+
+        The reservation is committed together with the request's changes,
+        a concurrent request with the same key fails on the unique index.
+        """
+
+        obj = cls(user_id=user_id, key=key, fingerprint=fingerprint, ttl=ttl)
+        try:
+            db_session.add(obj)
+            await db_session.flush()
+            return obj
+        except IntegrityError:
+            await db_session.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"A request with Idempotency-Key '{key}' is already being processed")
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def add_many(
+        cls,
+        db_session: AsyncSession,
+        user_id: int,
+        results: list[dict]
+    ) -> None | OfflineException:
+        """Store results of a user's requests, keys already stored are kept
+
+        Results are dicts of key, fingerprint, ttl, status_code and
+        response. Keys another worker stored in the meantime are skipped
+        rather than failing the insert.
+        """
+
+        if db_session.bind.dialect.name == 'postgresql':
+            insert = postgresql.insert
+        else:
+            insert = sqlite.insert
+
+        now = datetime.utcnow()
+        db_query = insert(cls).values([
+            {'user_id': user_id, 'key': result['key'],
+             'fingerprint': result['fingerprint'],
+             'status_code': result['status_code'],
+             'response': result['response'],
+             'expires_at': now + timedelta(seconds=result['ttl']),
+             'created_at': now}
+            for result in results])
+        db_query = db_query.on_conflict_do_nothing(
+            index_elements=[cls.user_id, cls.key])
+        try:
+            await db_session.execute(db_query)
+            await db_session.commit()
+        except SQLAlchemyError as ex:
+            await db_session.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def purge_expired(
+        cls,
+        db_session: AsyncSession,
+        batch_size: int = 1000
+    ) -> int | OfflineException:
+        """Delete a batch of expired keys, return number of deleted keys"""
+
+        expired = select(cls.id).where(
+            cls.expires_at <= datetime.utcnow()).limit(batch_size)
+        db_query = delete(cls).where(
+            cls.id.in_(expired.scalar_subquery())).execution_options(
+                synchronize_session=False)
+        try:
+            result = await db_session.execute(db_query)
+            await db_session.commit()
+            return result.rowcount
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
@@ -0,0 +1,206 @@
+import logging
+from datetime import datetime
+
+from fastapi import HTTPException, status
+from sqlalchemy import (Column, DateTime, Float, ForeignKey, Index, Integer,
+                        String, UniqueConstraint, func, insert, literal,
+                        select)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from client_transactions_api.services.offline import OfflineException
+
+from .base import BaseModel
+from .outbox import OutboxEvent
+from .partitions import PartitionedModel
+
+logger = logging.getLogger(__name__)
+
+
+class LedgerEntry(PartitionedModel):
+    """Balance change of a user, append only
+
+    Every committed change of a balance has an entry, written in the same
+    DB transaction, see `record`. Transfers have one entry per leg.
+    Partitioned by month on Postgres, expired months are compacted into
+    `LedgerSummary` rows by the ledger maintenance job.
+    """
+
+    __tablename__ = 'ledger_entries'
+    __table_args__ = (
+        Index('ix_ledger_entries_user_id_id', 'user_id', 'id'),
+        Index('ix_ledger_entries_user_id_created_at', 'user_id', 'created_at'),
+    )
+
+    # Partition key
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    currency = Column(String(3), nullable=False)
+    # Legs of one transfer share its id
+    transfer_id = Column(String(32), nullable=True, index=True)
+    amount = Column(Float, nullable=False)
+    # Balance of the user in the currency right after the movement
+    balance = Column(Float, nullable=False)
+
+    def __init__(self,
+                 user_id: int,
+                 currency: str,
+                 amount: float,
+                 balance: float,
+                 transfer_id: str | None = None):
+        self.user_id = user_id
+        self.currency = currency
+        self.amount = amount
+        self.balance = balance
+        self.transfer_id = transfer_id
+
+    @classmethod
+    async def record(
+        cls,
+        db_session: AsyncSession,
+        kind: str,
+        entries: list[dict]
+    ) -> None | OfflineException:
+        """Insert entries of balance changes with their outbox events
+
+        Does not commit, the changed balances are written in the same
+        DB transaction.
+        """
+
+        result = await cls.add_many(db_session, entries)
+        if type(result) is OfflineException:
+            return result
+        return await OutboxEvent.add_many(db_session, [
+            {'kind': kind, **entry} for entry in entries])
+
+    @classmethod
+    async def add_many(
+        cls,
+        db_session: AsyncSession,
+        entries: list[dict]
+    ) -> None | OfflineException:
+        """Insert entries with one multi-row insert, does not commit"""
+
+        now = datetime.utcnow()
+        db_query = insert(cls).values([
+            {'created_at': now, **entry} for entry in entries])
+        try:
+            await db_session.execute(db_query)
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def total(
+        cls,
+        db_session: AsyncSession,
+        user_id: int,
+        currency: str,
+        start: datetime,
+        end: datetime
+    ) -> tuple[int, float] | OfflineException:
+        """Count and sum of a user's entries in a currency created from
+        start up to end"""
+
+        db_query = select(
+            func.count(cls.id),
+            func.coalesce(func.sum(cls.amount), 0.0)
+        ).where(
+            cls.user_id == user_id,
+            cls.currency == currency,
+            cls.created_at >= start,
+            cls.created_at <= end)
+        try:
+            result = await db_session.execute(db_query)
+            return tuple(result.one())
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+
+class LedgerSummary(BaseModel):
+    """Ledger entries of a user in one currency and period, kept once
+    they are archived"""
+
+    __tablename__ = 'ledger_summaries'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'currency', 'period_start'),
+    )
+
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    currency = Column(String(3), nullable=False)
+    period_start = Column(DateTime, nullable=False)
+    period_end = Column(DateTime, nullable=False)
+    entries = Column(Integer, nullable=False)
+    amount = Column(Float, nullable=False)
+    # Balance of the user after the last entry of the period
+    balance = Column(Float, nullable=False)
+    first_entry_id = Column(Integer, nullable=False)
+    last_entry_id = Column(Integer, nullable=False)
+
+    @classmethod
+    async def summarize(
+        cls,
+        db_session: AsyncSession,
+        start: datetime,
+        end: datetime
+    ) -> None | OfflineException:
+        """Summarize ledger entries of a period per user and currency,
+        does not commit
+
+        Periods that are already summarized are left alone.
+        """
+
+        if db_session.bind.dialect.name == 'postgresql':
+            insert = postgresql.insert
+        else:
+            insert = sqlite.insert
+
+        in_period = (LedgerEntry.created_at >= start,
+                     LedgerEntry.created_at < end)
+        totals = (
+            select(
+                LedgerEntry.user_id,
+                LedgerEntry.currency,
+                func.count(LedgerEntry.id).label('entries'),
+                func.sum(LedgerEntry.amount).label('amount'),
+                func.min(LedgerEntry.id).label('first_entry_id'),
+                func.max(LedgerEntry.id).label('last_entry_id'))
+            .where(*in_period)
+            .group_by(LedgerEntry.user_id, LedgerEntry.currency)
+            .subquery())
+        # Entries of a balance are written under the lock of its row,
+        # so the last id holds the closing balance
+        summaries = (
+            select(
+                totals.c.user_id,
+                totals.c.currency,
+                literal(start, DateTime),
+                literal(end, DateTime),
+                totals.c.entries,
+                totals.c.amount,
+                LedgerEntry.balance,
+                totals.c.first_entry_id,
+                totals.c.last_entry_id,
+                literal(datetime.utcnow(), DateTime))
+            .join(LedgerEntry, LedgerEntry.id == totals.c.last_entry_id)
+            # Range prunes the other partitions from the join
+            .where(*in_period))
+        db_query = insert(cls).from_select(
+            ['user_id', 'currency', 'period_start', 'period_end', 'entries',
+             'amount', 'balance', 'first_entry_id', 'last_entry_id',
+             'created_at'],
+            summaries)
+        db_query = db_query.on_conflict_do_nothing(
+            index_elements=[cls.user_id, cls.currency, cls.period_start])
+        try:
+            await db_session.execute(db_query)
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
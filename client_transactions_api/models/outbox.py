@@ -0,0 +1,141 @@
+import logging
+from datetime import datetime, timedelta
+from typing import List
+
+from fastapi import HTTPException, status
+from sqlalchemy import (Column, DateTime, Float, ForeignKey, Integer, String,
+                        delete, insert, select, update)
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from client_transactions_api.services.offline import OfflineException
+
+from .base import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxEvent(BaseModel):
+    """Balance change waiting to be delivered to downstream systems
+
+    Events are inserted in the DB transaction of the balance change
+    itself, so an event exists if and only if its change was committed.
+    Delivered events are deleted.
+    """
+
+    __tablename__ = 'outbox_events'
+
+    # Events are only written while a dispatcher delivers them,
+    # see startup_outbox in main.py
+    enabled: bool = False
+
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    currency = Column(String(3), nullable=False)
+    # transaction, transfer, capture or offline_sync
+    kind = Column(String(16), nullable=False)
+    amount = Column(Float, nullable=False)
+    # Balance of the user right after the change
+    balance = Column(Float, nullable=False)
+    transfer_id = Column(String(32), nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    # Not dispatched before, pushed back after a failed delivery
+    available_at = Column(DateTime, nullable=False, index=True)
+
+    def __init__(self,
+                 user_id: int,
+                 currency: str,
+                 kind: str,
+                 amount: float,
+                 balance: float,
+                 transfer_id: str | None = None):
+        self.user_id = user_id
+        self.currency = currency
+        self.kind = kind
+        self.amount = amount
+        self.balance = balance
+        self.transfer_id = transfer_id
+
+    @classmethod
+    async def add_many(
+        cls,
+        db_session: AsyncSession,
+        events: list[dict]
+    ) -> None | OfflineException:
+        """Insert events with one multi-row insert, does not commit
+
+        Does nothing while the outbox is disabled.
+        """
+
+        if not cls.enabled or not events:
+            return
+        now = datetime.utcnow()
+        db_query = insert(cls).values([
+            {'created_at': now, 'available_at': now, 'attempts': 0,
+             'transfer_id': None, **event}
+            for event in events])
+        try:
+            await db_session.execute(db_query)
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def claim(
+        cls,
+        db_session: AsyncSession,
+        batch_size: int = 100
+    ) -> "List[OutboxEvent] | OfflineException":
+        """Lock the oldest events due for delivery
+
+        Events locked by another worker's dispatcher are skipped on
+        Postgres. The lock is held until `delivered` or `retry` commits.
+        """
+
+        db_query = select(cls) \
+            .where(cls.available_at <= datetime.utcnow()) \
+            .order_by(cls.id).limit(batch_size) \
+            .with_for_update(skip_locked=True)
+        try:
+            result = await db_session.execute(db_query)
+            return result.scalars().all()
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def delivered(
+        cls,
+        db_session: AsyncSession,
+        ids: List[int]
+    ) -> None | OfflineException:
+        """Delete delivered events"""
+
+        try:
+            await db_session.execute(delete(cls).where(cls.id.in_(ids)))
+            await db_session.commit()
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def retry(
+        cls,
+        db_session: AsyncSession,
+        ids: List[int],
+        delay: float
+    ) -> None | OfflineException:
+        """Count a failed delivery and put events back after delay"""
+
+        db_query = update(cls).where(cls.id.in_(ids)).values(
+            attempts=cls.attempts + 1,
+            available_at=datetime.utcnow() + timedelta(seconds=delay))
+        try:
+            await db_session.execute(db_query)
+            await db_session.commit()
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
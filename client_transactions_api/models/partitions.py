@@ -0,0 +1,255 @@
+import logging
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import text
+
+from client_transactions_api.services.offline import OfflineException
+
+from .base import BaseModel
+
+logger = logging.getLogger(__name__)
+
+BOUND_PATTERN = re.compile(r"FROM \((.+)\) TO \((.+)\)")
+
+
+def month_start(moment: datetime) -> datetime:
+    """First instant of the month of a datetime"""
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(moment: datetime, months: int) -> datetime:
+    """First instant of the month `months` after the month of a datetime"""
+    month = moment.year * 12 + moment.month - 1 + months
+    return month_start(moment).replace(year=month // 12, month=month % 12 + 1)
+
+
+def parse_bound(bound: str) -> datetime | None:
+    """Partition bound value, None for MINVALUE and MAXVALUE"""
+    if bound in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.fromisoformat(bound.strip("'"))
+
+
+@dataclass
+class Partition:
+    name: str
+    # None when the partition is unbounded on that side
+    start: datetime | None
+    end: datetime | None
+
+
+class PartitionedModel(BaseModel):
+    """Abstract base model of a table partitioned by month
+
+    On Postgres the table is declaratively partitioned by range of
+    `created_at` (see migrations), with one partition per month named
+    `<table>_pYYYYMM`. Partitions are created ahead of time and archived
+    once expired by the ledger maintenance job. Rows past the last month
+    land in the `<table>_default` partition until their month is created.
+    Other databases keep one plain table, where expired rows are deleted
+    instead.
+
+    The primary key of a partitioned table must include `created_at`,
+    the model keeps `id` as its identity, which the shared sequence keeps
+    unique across partitions.
+    """
+
+    __abstract__ = True
+
+    @classmethod
+    def partition_name(cls, start: datetime) -> str:
+        return f'{cls.__tablename__}_p{start:%Y%m}'
+
+    @classmethod
+    def _quote(cls, db_session: AsyncSession, name: str) -> str:
+        return db_session.bind.dialect.identifier_preparer.quote(name)
+
+    @classmethod
+    async def is_partitioned(
+        cls,
+        db_session: AsyncSession
+    ) -> bool | OfflineException:
+        """Whether the table is partitioned in this database"""
+
+        if db_session.bind.dialect.name != 'postgresql':
+            return False
+        db_query = text(
+            'SELECT CAST(relkind AS text) FROM pg_class '
+            'WHERE oid = CAST(:table AS regclass)')
+        try:
+            result = await db_session.execute(
+                db_query, {'table': cls.__tablename__})
+            return result.scalar() == 'p'
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def partitions(
+        cls,
+        db_session: AsyncSession
+    ) -> List[Partition] | OfflineException:
+        """Partitions of the table, oldest first, without the DEFAULT
+        partition"""
+
+        db_query = text(
+            'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) '
+            'FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = CAST(:table AS regclass)')
+        try:
+            result = await db_session.execute(
+                db_query, {'table': cls.__tablename__})
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+        partitions = []
+        for name, bound in result.all():
+            match = BOUND_PATTERN.search(bound)
+            if match is None:
+                # DEFAULT partition
+                continue
+            partitions.append(Partition(
+                name, parse_bound(match[1]), parse_bound(match[2])))
+        return sorted(partitions, key=lambda p: p.start or datetime.min)
+
+    @classmethod
+    async def create_partitions(
+        cls,
+        db_session: AsyncSession,
+        until: datetime
+    ) -> List[str] | OfflineException:
+        """Create monthly partitions after the last one up to a month
+
+        Rows of a new month already in the DEFAULT partition are moved
+        into the month's partition, which is attached once filled.
+        Returns names of the created partitions, does not commit.
+        """
+
+        partitions = await cls.partitions(db_session)
+        if type(partitions) is OfflineException:
+            return partitions
+        if partitions and partitions[-1].end is None:
+            # Last partition takes everything up to MAXVALUE
+            return []
+        start = partitions[-1].end if partitions \
+            else month_start(datetime.utcnow())
+
+        table = cls._quote(db_session, cls.__tablename__)
+        default = cls._quote(db_session, f'{cls.__tablename__}_default')
+        created = []
+        try:
+            result = await db_session.execute(
+                text('SELECT to_regclass(:name) IS NOT NULL'),
+                {'name': f'{cls.__tablename__}_default'})
+            has_default = result.scalar()
+            while start < until:
+                end = add_months(start, 1)
+                name = cls._quote(db_session, cls.partition_name(start))
+                bounds = f"FROM ('{start.isoformat()}') " \
+                    f"TO ('{end.isoformat()}')"
+                in_default = False
+                if has_default:
+                    result = await db_session.execute(text(
+                        f'SELECT EXISTS (SELECT FROM {default} '
+                        'WHERE created_at >= :start AND created_at < :end)'),
+                        {'start': start, 'end': end})
+                    in_default = result.scalar()
+                if in_default:
+                    await db_session.execute(text(
+                        f'CREATE TABLE {name} (LIKE {table} '
+                        'INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+                    await db_session.execute(text(
+                        f'WITH moved AS (DELETE FROM {default} '
+                        'WHERE created_at >= :start AND created_at < :end '
+                        f'RETURNING *) INSERT INTO {name} SELECT * FROM moved'),
+                        {'start': start, 'end': end})
+                    await db_session.execute(text(
+                        f'ALTER TABLE {table} ATTACH PARTITION {name} '
+                        f'FOR VALUES {bounds}'))
+                else:
+                    await db_session.execute(text(
+                        f'CREATE TABLE {name} PARTITION OF {table} '
+                        f'FOR VALUES {bounds}'))
+                created.append(cls.partition_name(start))
+                start = end
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+        return created
+
+    @classmethod
+    async def archive_partition(
+        cls,
+        db_session: AsyncSession,
+        partition: Partition,
+        drop: bool = False
+    ) -> None | OfflineException:
+        """Detach a partition into a table of its own, or drop it
+
+        A detached partition keeps its name and rows, without foreign
+        keys, so it can be dumped and dropped later. Does not commit.
+        """
+
+        name = cls._quote(db_session, partition.name)
+        try:
+            if drop:
+                await db_session.execute(text(f'DROP TABLE {name}'))
+                return
+            await db_session.execute(text(
+                f'ALTER TABLE {cls._quote(db_session, cls.__tablename__)} '
+                f'DETACH PARTITION {name}'))
+            result = await db_session.execute(text(
+                'SELECT conname FROM pg_constraint '
+                "WHERE conrelid = CAST(:name AS regclass) AND contype = 'f'"),
+                {'name': partition.name})
+            for constraint in result.scalars().all():
+                await db_session.execute(text(
+                    f'ALTER TABLE {name} DROP CONSTRAINT '
+                    f'{cls._quote(db_session, constraint)}'))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def first_created(
+        cls,
+        db_session: AsyncSession,
+        before: datetime
+    ) -> datetime | None | OfflineException:
+        """Creation time of the oldest row created before a datetime"""
+
+        db_query = select(func.min(cls.created_at)) \
+            .where(cls.created_at < before)
+        try:
+            result = await db_session.execute(db_query)
+            return result.scalar()
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def purge(
+        cls,
+        db_session: AsyncSession,
+        start: datetime,
+        end: datetime
+    ) -> int | OfflineException:
+        """Delete rows created in a period of an unpartitioned table
+
+        Returns number of deleted rows, does not commit.
+        """
+
+        db_query = delete(cls).where(
+            cls.created_at >= start, cls.created_at < end)
+        try:
+            result = await db_session.execute(db_query)
+            return result.rowcount
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
@@ -0,0 +1,146 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, Float, ForeignKey, Integer, String,
+                        UniqueConstraint, and_, func, literal, select, true,
+                        tuple_)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from client_transactions_api.services.offline import OfflineException
+
+from .balances import Balance
+from .base import BaseModel
+from .ledger import LedgerEntry
+
+logger = logging.getLogger(__name__)
+
+
+class BalanceSnapshot(BaseModel):
+    """Balance of a user in one currency at the end of a day
+
+    Only written for balances that changed during the day, so the last
+    snapshot of a balance before a time holds it as of the last snapshot
+    run before that time.
+    """
+
+    __tablename__ = 'balance_snapshots'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'currency', 'taken_at'),
+    )
+
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    currency = Column(String(3), nullable=False)
+    # Day boundary, the balance includes ledger entries created before it
+    taken_at = Column(DateTime, nullable=False)
+    balance = Column(Float, nullable=False)
+
+    @classmethod
+    async def take(
+        cls,
+        db_session: AsyncSession,
+        taken_at: datetime,
+        since: datetime | None = None
+    ) -> int | OfflineException:
+        """Snapshot balances as of a time with one bulk insert
+
+        Balances are read now and rewound by the ledger entries created
+        from `taken_at` on. Only balances with entries from `since` on are
+        snapshotted, all balances if not set. Returns number of snapshots,
+        does not commit.
+        """
+
+        if db_session.bind.dialect.name == 'postgresql':
+            insert = postgresql.insert
+        else:
+            insert = sqlite.insert
+
+        later = (
+            select(
+                LedgerEntry.user_id,
+                LedgerEntry.currency,
+                func.sum(LedgerEntry.amount).label('amount'))
+            .where(LedgerEntry.created_at >= taken_at)
+            .group_by(LedgerEntry.user_id, LedgerEntry.currency)
+            .subquery())
+        snapshots = (
+            select(
+                Balance.user_id,
+                Balance.currency,
+                literal(taken_at, DateTime),
+                Balance.value - func.coalesce(later.c.amount, 0.0),
+                literal(datetime.utcnow(), DateTime))
+            .outerjoin(later, and_(
+                later.c.user_id == Balance.user_id,
+                later.c.currency == Balance.currency)))
+        if since is not None:
+            changed = select(LedgerEntry.user_id, LedgerEntry.currency).where(
+                LedgerEntry.created_at >= since,
+                LedgerEntry.created_at < taken_at)
+            snapshots = snapshots.where(
+                tuple_(Balance.user_id, Balance.currency).in_(changed))
+        else:
+            # SQLite needs a WHERE to tell ON CONFLICT from a join
+            snapshots = snapshots.where(true())
+        db_query = insert(cls).from_select(
+            ['user_id', 'currency', 'taken_at', 'balance', 'created_at'],
+            snapshots)
+        db_query = db_query.on_conflict_do_nothing(
+            index_elements=[cls.user_id, cls.currency, cls.taken_at])
+        try:
+            result = await db_session.execute(db_query)
+            return result.rowcount
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def latest(
+        cls,
+        db_session: AsyncSession,
+        user_id: int,
+        currency: str,
+        before: datetime
+    ) -> "BalanceSnapshot | None | OfflineException":
+        """Last snapshot of a user's balance taken at or before a time"""
+
+        db_query = select(cls) \
+            .where(cls.user_id == user_id, cls.currency == currency,
+                   cls.taken_at <= before) \
+            .order_by(cls.taken_at.desc()).limit(1)
+        return await cls.get(db_session, db_query=db_query, raise_404=False)
+
+
+class BalanceSnapshotRun(BaseModel):
+    """Day boundary balances were snapshotted at
+
+    Runs are consecutive days: balances that changed before a run's
+    `taken_at` and after the previous run were all snapshotted.
+    """
+
+    __tablename__ = 'balance_snapshot_runs'
+
+    taken_at = Column(DateTime, nullable=False, unique=True)
+    users = Column(Integer, nullable=False)
+
+    def __init__(self, taken_at: datetime, users: int):
+        self.taken_at = taken_at
+        self.users = users
+
+    @classmethod
+    async def bounds(
+        cls,
+        db_session: AsyncSession,
+        before: datetime | None = None
+    ) -> "tuple[datetime | None, datetime | None] | OfflineException":
+        """First run, and last run at or before a time if set"""
+
+        db_query = select(func.min(cls.taken_at), func.max(cls.taken_at))
+        if before is not None:
+            db_query = db_query.where(cls.taken_at <= before)
+        try:
+            result = await db_session.execute(db_query)
+            return tuple(result.one())
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
@@ -0,0 +1,130 @@
+import logging
+from datetime import datetime, timedelta
+from typing import List
+
+from fastapi import HTTPException, status
+from sqlalchemy import (Column, DateTime, Float, ForeignKey, Integer, String,
+                        UniqueConstraint, delete, select)
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from client_transactions_api.services.offline import OfflineException
+
+from .base import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+class TransferCredit(BaseModel):
+    """Credit of a transfer to a user of another shard, not delivered yet
+
+    Written on the sender's shard in the DB transaction debiting the
+    sender, so a credit exists if and only if the debit was committed.
+    The credit is delivered on the recipient's shard, and deleted once
+    the recipient's ledger leg of the transfer is committed there.
+    """
+
+    __tablename__ = 'transfer_credits'
+
+    transfer_id = Column(String(32), nullable=False, unique=True)
+    sender_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    # Lives on another shard, not a foreign key
+    recipient_id = Column(Integer, nullable=False)
+    currency = Column(String(3), nullable=False)
+    amount = Column(Float, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    # Not delivered before, pushed back by every claim
+    available_at = Column(DateTime, nullable=False, index=True)
+
+    def __init__(self,
+                 transfer_id: str,
+                 sender_id: int,
+                 recipient_id: int,
+                 currency: str,
+                 amount: float):
+        self.transfer_id = transfer_id
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.currency = currency
+        self.amount = amount
+        self.attempts = 0
+        self.available_at = datetime.utcnow()
+
+    @classmethod
+    async def claim(
+        cls,
+        db_session: AsyncSession,
+        batch_size: int = 100,
+        delay: float = 1,
+        max_delay: float = 60,
+        transfer_ids: List[str] | None = None
+    ) -> "List[TransferCredit] | OfflineException":
+        """Take the oldest credits due for delivery, and commit
+
+        Every claim counts an attempt and pushes the credits back by
+        `delay` doubled per attempt, up to `max_delay` seconds, so that
+        other workers leave them alone while they are delivered, and
+        retry them after that if they were not. Credits locked by another
+        worker's claim are skipped on Postgres.
+        """
+
+        now = datetime.utcnow()
+        db_query = select(cls).where(cls.available_at <= now)
+        if transfer_ids is not None:
+            db_query = db_query.where(cls.transfer_id.in_(transfer_ids))
+        db_query = db_query.order_by(cls.id).limit(batch_size) \
+            .with_for_update(skip_locked=True)
+        try:
+            result = await db_session.execute(db_query)
+            credits = result.scalars().all()
+            for credit in credits:
+                backoff = min(max_delay, delay * 2 ** credit.attempts)
+                credit.attempts += 1
+                credit.available_at = now + timedelta(seconds=backoff)
+            await db_session.commit()
+            return credits
+        except SQLAlchemyError as ex:
+            await db_session.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def delivered(
+        cls,
+        db_session: AsyncSession,
+        transfer_ids: List[str]
+    ) -> None | OfflineException:
+        """Delete delivered credits"""
+
+        try:
+            await db_session.execute(
+                delete(cls).where(cls.transfer_id.in_(transfer_ids)))
+            await db_session.commit()
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+
+class ReceivedTransfer(BaseModel):
+    """Transfer credited to a user of this shard by another shard
+
+    Written in the DB transaction crediting the recipient, so that a
+    credit delivered again is recognized. Unlike the recipient's ledger
+    leg it is never archived by ledger retention.
+    """
+
+    __tablename__ = 'received_transfers'
+    __table_args__ = (
+        UniqueConstraint('transfer_id', 'user_id'),
+    )
+
+    transfer_id = Column(String(32), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+
+    def __init__(self, transfer_id: str, user_id: int):
+        self.transfer_id = transfer_id
+        self.user_id = user_id
@@ -1,13 +1,22 @@
-from sqlalchemy import BigInteger, Boolean, Column, String
+import logging
+
+from fastapi import HTTPException, status
+from sqlalchemy import BigInteger, Boolean, Column, String, insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship
 
+from client_transactions_api.services.offline import OfflineException
+
 from .base import BaseModel
 
+logger = logging.getLogger(__name__)
+
 
 class User(BaseModel):
     """User class"""
 
-    username = Column(String(20), nullable=False)
+    username = Column(String(20), nullable=False, index=True)
     hashed_password = Column(String(130), nullable=True)
 
     is_active = Column(Boolean(), default=True)
@@ -22,3 +31,63 @@ class User(BaseModel):
         self.hashed_password = password
         self.is_active = is_active
         self.is_admin = is_admin
+
+    @classmethod
+    async def existing_usernames(
+        cls,
+        db_session: AsyncSession,
+        usernames: list[str]
+    ) -> set[str] | OfflineException:
+        """Return which of the usernames are taken, with one query"""
+
+        db_query = select(cls.username).where(cls.username.in_(usernames))
+        try:
+            result = await db_session.execute(db_query)
+            return set(result.scalars())
+        except SQLAlchemyError as ex:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
+
+    @classmethod
+    async def add_many(
+        cls,
+        db_session: AsyncSession,
+        users: list[dict]
+    ) -> dict[str, int] | OfflineException:
+        """Insert users with one multi-row insert and commit
+
+        Args:
+            users (list): Rows with username and hashed_password
+
+        Returns:
+            result (dict): Ids of the inserted users by username
+        """
+
+        db_query = insert(cls).values([
+            {'is_active': True, 'is_admin': False, **user}
+            for user in users])
+        usernames = [user['username'] for user in users]
+        try:
+            if db_session.bind.dialect.name == 'postgresql':
+                result = await db_session.execute(
+                    db_query.returning(cls.id, cls.username))
+            else:
+                await db_session.execute(db_query)
+                result = await db_session.execute(
+                    select(cls.id, cls.username)
+                    .where(cls.username.in_(usernames)))
+            ids = {username: id for id, username in result}
+            await db_session.commit()
+            return ids
+        except SQLAlchemyError as ex:
+            await db_session.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=repr(ex))
+        except ConnectionRefusedError:
+            logger.warning('ConnectionRefusedError raised')
+            return OfflineException()
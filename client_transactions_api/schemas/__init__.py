@@ -1,3 +1,6 @@
 from .tokens import *
 from .users import *
 from .balances import *
+from .holds import *
+from .limits import *
+from .outbox import *
@@ -3,24 +3,116 @@ from typing import Optional
 
 from pydantic import BaseModel, Field
 
+from client_transactions_api.config import settings
 
-class BalanceIn(BaseModel):
+
+class BalanceBase(BaseModel):
     user_id: int = Field(example=2, description="PK id user's id")
     value: float = Field(example=420.69, description="User's balance in currency")
+    currency: str = Field(
+        default=settings.DEFAULT_CURRENCY, regex='^[A-Z]{3}$', example='USD',
+        description='ISO 4217 code of the currency, one balance per currency')
 
     class Config:
         orm_mode = True
 
 
-class BalanceOut(BalanceIn):
+class BalanceIn(BalanceBase):
+    user_id: Optional[int] = Field(
+        default=None, example=2, deprecated=True,
+        description="Deprecated, transactions go to the authenticated user's balance. Rejected with 403 if it is another user's id")
+
+
+class BalanceOut(BalanceBase):
+    held: float = Field(default=0.0, example=42.0, description='Part of the balance reserved by open holds, not available for debits')
     created_at: datetime = Field(description="Date when balance was created")
     updated_at: Optional[datetime] = Field(description="Date when balance was updated")
     id: int = Field(example=1)
 
 
-class OfflineBalanceOut(BalanceIn):
+class TransferIn(BaseModel):
+    recipient_id: int = Field(example=3, description="Recipient user's id")
+    value: float = Field(gt=0, example=42.0, description='Sum to transfer')
+    currency: str = Field(
+        default=settings.DEFAULT_CURRENCY, regex='^[A-Z]{3}$', example='USD',
+        description='Currency of the balances the sum moves between')
+
+
+class TransferOut(BaseModel):
+    transfer_id: str = Field(
+        example='3f1c9a0e5b7d4e6f8a2b1c0d9e8f7a6b',
+        description='Id shared by the ledger entries of the transfer')
+    sender_id: int = Field(example=2)
+    recipient_id: int = Field(example=3)
+    value: float = Field(example=42.0, description='Transferred sum')
+    currency: str = Field(example='USD')
+    balance: float = Field(example=378.69, description="Sender's balance after the transfer")
+    created_at: datetime = Field(description='Date when transfer was made')
+
+
+class BalanceAtOut(BalanceBase):
+    at: datetime = Field(description='Time the balance was asked for')
+    as_of: datetime = Field(description='Time the balance is exact for, the last snapshot before `at` once its ledger entries are archived')
+    snapshot_at: datetime = Field(description='Date of the snapshot the balance was computed from')
+    entries: int = Field(example=3, description='Ledger entries added to the snapshot')
+
+
+class OfflineBalanceOut(BalanceBase):
     balance: float
     message: str = Field(
         default='Service partially down. But your transaction is being processed offline and will be processed once online',
         example='Service partially down. But your transaction is being processed offline and will be processed once online',
         description='Message notifying that transaction is being processes in offline mode')
+
+
+class OfflineBalanceAccepted(OfflineBalanceOut):
+    tracking_id: str = Field(
+        example='3f1c9a0e5b7d4e6f8a2b1c0d9e8f7a6b',
+        description='Id to poll the reconciliation status of the transaction with')
+    status: str = Field(
+        default='pending',
+        example='pending',
+        description='Reconciliation status, pending until the transaction is synced with the database')
+
+
+class OfflineTransactionStatus(BaseModel):
+    tracking_id: str = Field(example='3f1c9a0e5b7d4e6f8a2b1c0d9e8f7a6b')
+    user_id: int = Field(example=2, description="PK id user's id")
+    value: float = Field(example=420.69, description='Transaction sum')
+    currency: str = Field(example='USD')
+    status: str = Field(
+        example='reconciled',
+        description='Either pending or reconciled')
+    accepted_at: datetime = Field(description='Date when transaction was accepted offline')
+    reconciled_at: Optional[datetime] = Field(description='Date when transaction was synced with the database')
+
+
+class StaleBalanceOut(BalanceBase):
+    stale: bool = Field(
+        default=True,
+        description='Balance is served from the offline cache while the database is down')
+    synced_at: datetime = Field(description='Date when balance was last synced with the database')
+    age: float = Field(example=12.5, description='Seconds since balance was last synced with the database')
+    pending: float = Field(example=-30.0, description='Sum of offline transactions not yet synced with the database')
+    held: float = Field(default=0.0, example=42.0, description='Part of the balance reserved by open holds when last synced')
+
+
+class BalanceCacheStats(BaseModel):
+    size: int = Field(example=120, description='Number of users with cached balances')
+    max_size: int = Field(example=10000)
+    ttl: float = Field(example=5, description='Seconds a balance is cached for')
+    hits: int = Field(example=9000)
+    misses: int = Field(example=1000)
+    hit_rate: float = Field(example=0.9, description='Share of balance reads served from the cache')
+    invalidations: int = Field(example=10, description='Balances dropped on notification of other workers')
+    evictions: int = Field(example=0, description='Balances dropped to stay within max size')
+    channel: bool = Field(description='Whether cross-worker invalidation is enabled')
+
+
+class BalanceStreamStats(BaseModel):
+    subscribers: int = Field(example=2000, description='Open balance streams')
+    users: int = Field(example=1800, description='Users with an open stream')
+    max_subscribers: int = Field(example=10000)
+    queue_size: int = Field(example=16, description='Events queued per stream before it is dropped')
+    published: int = Field(example=9000, description='Changes sent to open streams')
+    dropped: int = Field(example=3, description='Streams ended for falling behind')
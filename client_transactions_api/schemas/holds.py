@@ -0,0 +1,34 @@
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+from client_transactions_api.config import settings
+
+
+class HoldIn(BaseModel):
+    value: float = Field(gt=0, example=42.0, description='Sum to reserve')
+    currency: str = Field(
+        default=settings.DEFAULT_CURRENCY, regex='^[A-Z]{3}$', example='USD',
+        description='Currency of the balance the sum is held on')
+    ttl: Optional[int] = Field(
+        gt=0, le=settings.HOLD_MAX_TTL, example=900,
+        description='Seconds until the hold expires and its sum is released, defaults to the HOLD_TTL setting')
+
+
+class HoldCaptureIn(BaseModel):
+    value: Optional[float] = Field(
+        gt=0, example=40.0,
+        description='Sum to debit, at most the held sum and all of it by default. The rest is released')
+
+
+class HoldOut(BaseModel):
+    id: int = Field(example=7)
+    user_id: int = Field(example=2)
+    value: float = Field(example=42.0, description='Held sum')
+    currency: str = Field(example='USD')
+    status: str = Field(example='held', description='held, captured, voided or expired')
+    captured: Optional[float] = Field(example=None, description='Debited sum of a captured hold')
+    expires_at: datetime = Field(description='Date when an open hold expires')
+    created_at: datetime
+    updated_at: Optional[datetime]
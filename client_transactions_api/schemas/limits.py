@@ -0,0 +1,27 @@
+from pydantic import BaseModel, Field
+
+
+class RateLimiterStats(BaseModel):
+    rate: float = Field(example=20, description='Requests per second per key, 0 if disabled')
+    burst: int = Field(example=40)
+    keys: int = Field(example=120, description='Number of keys with a bucket')
+    allowed: int = Field(example=9000)
+    rejected: int = Field(example=10, description='Requests rejected with 429')
+    evictions: int = Field(example=0, description='Buckets dropped to stay within max keys')
+
+
+class AdmissionStats(BaseModel):
+    limit: int = Field(example=20, description='Requests processed at once, 0 if disabled')
+    max_queue: int = Field(example=20)
+    in_flight: int = Field(example=3)
+    queued: int = Field(example=0)
+    peak: int = Field(example=20, description='Most requests processed at once')
+    admitted: int = Field(example=9000)
+    rejected: int = Field(example=10, description='Requests shed with 503')
+    timeouts: int = Field(example=2, description='Shed requests that waited for a slot')
+
+
+class LimitsStats(BaseModel):
+    admission: AdmissionStats
+    transactions: RateLimiterStats
+    auth: RateLimiterStats
@@ -0,0 +1,29 @@
+from datetime import datetime
+
+from pydantic import BaseModel, Field
+
+
+class BalanceEvent(BaseModel):
+    id: int = Field(example=1042, description='Unique, the same when an event is delivered again')
+    kind: str = Field(example='transaction', description='transaction, transfer, capture or offline_sync')
+    user_id: int = Field(example=2)
+    currency: str = Field(example='USD')
+    amount: float = Field(example=-5.0, description='Change of the balance')
+    balance: float = Field(example=95.0, description='Balance right after the change')
+    transfer_id: str | None = Field(example=None)
+    created_at: datetime
+
+
+class OutboxSinkStats(BaseModel):
+    name: str = Field(example='webhook')
+    delivered: int = Field(example=9000)
+    failures: int = Field(example=2)
+
+
+class OutboxStats(BaseModel):
+    enabled: bool
+    batch_size: int = Field(example=100)
+    dispatched: int = Field(example=9000, description='Events delivered to every sink')
+    retried: int = Field(example=20, description='Events put back after a failed delivery')
+    last_error: str | None = Field(example=None)
+    sinks: list[OutboxSinkStats]
@@ -12,3 +12,10 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     """Helper Class for FastAPI's deps"""
     username: str
+
+
+class TokenUser(TokenData):
+    """User identity and permissions from verified token claims"""
+    id: int
+    is_active: bool = True
+    is_admin: bool = False
@@ -36,6 +36,26 @@ class UserCreate(UserUpdate):
 
 class User(UserCreate):
     """Complete user model"""
-    id: str = Field(
+    id: int = Field(
         example=2,
         description='Id of the user')
+
+
+class UsersImportIn(BaseModel):
+    users: list[UserLogin] = Field(
+        max_items=1000,
+        description='Users to register, at most 1000 per request')
+
+
+class UserImportResult(UserBase):
+    status: str = Field(
+        example='created',
+        description='One of created, exists, duplicate, invalid or failed')
+    id: Optional[int] = Field(example=2, description='Id of a created user')
+    detail: Optional[str] = Field(description='Why the user was not created')
+
+
+class UsersImportOut(BaseModel):
+    created: int = Field(example=998)
+    rejected: int = Field(example=2, description='Users that were not created')
+    results: list[UserImportResult] = Field(description='Outcome of every user, in request order')
@@ -0,0 +1,92 @@
+"""Fast JSON serialization for hot endpoints
+
+Endpoints that return a response themselves skip FastAPI's response_model
+validation and `jsonable_encoder`. Serializers read a schema's fields
+straight from ORM objects, so the values must already be of the schema's
+types. The schemas stay the documented response models.
+"""
+
+import json
+import operator
+from datetime import date, datetime
+from typing import Any, Iterable
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from client_transactions_api import schemas
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def dumps(content: Any) -> bytes:
+    """Serialize to JSON, with orjson if it is installed"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(
+        content, default=_default, separators=(',', ':')).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson if it is installed"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class Serializer:
+    """Pre-built serializer of a schema's fields
+
+    Args:
+        schema (BaseModel): Schema whose fields are serialized, in order
+        constants (dict, optional): Fields with a fixed value, that the
+            serialized objects do not have
+    """
+
+    def __init__(self, schema: type[BaseModel], constants: dict | None = None):
+        self.constants = constants or {}
+        self.fields = tuple(schema.__fields__)
+        self.attributes = tuple(
+            name for name in self.fields if name not in self.constants)
+        getter = operator.attrgetter(*self.attributes)
+        if len(self.attributes) == 1:
+            self.getter = lambda obj: (getter(obj),)
+        else:
+            self.getter = getter
+
+    def __call__(self, obj: Any) -> dict:
+        if not self.constants:
+            return dict(zip(self.fields, self.getter(obj)))
+        values = dict(zip(self.attributes, self.getter(obj)))
+        return {name: self.constants[name] if name in self.constants
+                else values[name] for name in self.fields}
+
+    def many(self, objs: Iterable[Any]) -> list[dict]:
+        return [self(obj) for obj in objs]
+
+
+balance = Serializer(schemas.BalanceOut)
+
+balance_event = Serializer(schemas.BalanceEvent)
+
+# Password is never read back, kept for the response shape of schemas.User
+user = Serializer(schemas.User, constants={'password': None})
+
+
+def page(page: Any, serializer: Serializer) -> dict:
+    """Serialize a fastapi_pagination limit offset page"""
+    return {
+        'items': serializer.many(page.items),
+        'total': page.total,
+        'limit': page.limit,
+        'offset': page.offset,
+    }
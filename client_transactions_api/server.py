@@ -0,0 +1,96 @@
+import os
+from dataclasses import dataclass, fields
+
+from client_transactions_api.config import Settings, settings
+
+
+@dataclass
+class ServerProfile:
+    """uvicorn and response compression options"""
+
+    workers: int = 1
+    # auto, asyncio or uvloop
+    loop: str = 'auto'
+    # auto, h11 or httptools
+    http: str = 'auto'
+    # Seconds an idle connection is kept open
+    keep_alive: int = 5
+    backlog: int = 2048
+    # Compress responses with gzip, or brotli if installed
+    compression: bool = False
+    compression_min_size: int = 1024
+    access_log: bool = True
+
+
+PROFILES = {
+    'development': ServerProfile(),
+    'production': ServerProfile(
+        workers=os.cpu_count() or 1,
+        loop='uvloop',
+        http='httptools',
+        # Longer than the idle timeout of common load balancers (60s),
+        # so that connections are closed by the balancer, not by workers
+        keep_alive=75,
+        backlog=4096,
+        compression=True,
+        # Requests are logged by the app's middleware
+        access_log=False,
+    ),
+}
+
+# Settings overriding the options of the selected profile
+OVERRIDES = {
+    'workers': 'WORKERS',
+    'loop': 'SERVER_LOOP',
+    'http': 'SERVER_HTTP',
+    'keep_alive': 'KEEP_ALIVE',
+    'backlog': 'BACKLOG',
+    'compression': 'COMPRESSION',
+    'compression_min_size': 'COMPRESSION_MIN_SIZE',
+    'access_log': 'ACCESS_LOG',
+}
+
+
+def get_profile(settings: Settings = settings) -> ServerProfile:
+    """Server profile selected by settings, with overrides applied"""
+
+    if settings.SERVER_PROFILE not in PROFILES:
+        raise ValueError(
+            f'Unknown server profile {settings.SERVER_PROFILE}, '
+            f'choose one of {", ".join(PROFILES)}')
+    options = {
+        field.name: getattr(PROFILES[settings.SERVER_PROFILE], field.name)
+        for field in fields(ServerProfile)}
+    for option, setting in OVERRIDES.items():
+        value = getattr(settings, setting)
+        if value is not None:
+            options[option] = value
+    return ServerProfile(**options)
+
+
+def run(host: str | None = None, port: int | None = None) -> None:
+    """Serve the app with uvicorn using the selected server profile"""
+
+    import uvicorn
+    from uvicorn.supervisors import Multiprocess
+
+    from client_transactions_api.uvicorn_server import Server
+
+    profile = get_profile()
+    config = uvicorn.Config(
+        'client_transactions_api.main:app',
+        host=host or settings.API_HOST,
+        port=port or settings.API_PORT,
+        workers=profile.workers,
+        loop=profile.loop,
+        http=profile.http,
+        timeout_keep_alive=profile.keep_alive,
+        backlog=profile.backlog,
+        access_log=profile.access_log)
+    server = Server(config=config)
+    # Same as uvicorn.run, with the server above
+    if config.workers > 1:
+        sock = config.bind_socket()
+        Multiprocess(config, target=server.run, sockets=[sock]).run()
+    else:
+        server.run()
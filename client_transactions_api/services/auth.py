@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from datetime import datetime, timedelta
 from typing import Optional
@@ -5,14 +6,13 @@ from typing import Optional
 from fastapi import Depends
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
-from passlib.context import CryptContext
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from client_transactions_api import db, models
 from client_transactions_api.config import settings
+from client_transactions_api.services.hashing import PasswordHasher, context
 from client_transactions_api.services.offline import OfflineException
 
-context = CryptContext(schemes=['argon2'], deprecated='auto')
 oauth2_scheme = OAuth2PasswordBearer(
     tokenUrl=f'{settings.API_PATH}/auth/token')
 
@@ -35,6 +35,8 @@ class AuthService:
 
         self.context = context
         self.oauth2_scheme = oauth2_scheme
+        # Lookups of users in flight, by user id
+        self.active_lookups: dict[int, asyncio.Future] = {}
 
     @staticmethod
     async def get_user(
@@ -74,6 +76,30 @@ class AuthService:
             return None
         return user
 
+    async def is_active(self, user_id: int) -> bool | OfflineException:
+        """Whether user still exists and is active, looked up on their shard
+
+        Concurrent requests of a user share one lookup, so that a burst of
+        them takes a single connection, like their coalesced writes do.
+        """
+        lookup = self.active_lookups.get(user_id)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._lookup_active(user_id))
+            self.active_lookups[user_id] = lookup
+            lookup.add_done_callback(
+                lambda _: self.active_lookups.pop(user_id, None))
+        # A cancelled request leaves the lookup to the others
+        return await asyncio.shield(lookup)
+
+    @staticmethod
+    async def _lookup_active(user_id: int) -> bool | OfflineException:
+        async with db.shard_for(user_id).Session() as db_session:
+            user = await models.User.get(
+                db_session, id=user_id, raise_404=False)
+            if type(user) is OfflineException:
+                return user
+            return user is not None and user.is_active
+
     async def create_access_token(
         self,
         data: dict,
@@ -98,3 +124,6 @@ auth_service = AuthService(
     secret=settings.SECRET_KEY.get_secret_value(),
     algorithm=settings.CRYPT_ALGORITHM,
     expire=settings.TOKEN_EXPIRE_MINUTES)
+
+# Bulk imports hash passwords across all cores
+password_hasher = PasswordHasher(workers=settings.HASH_WORKERS)
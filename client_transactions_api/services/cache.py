@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from sqlalchemy.engine import make_url
+
+from client_transactions_api import schemas, serializers
+from client_transactions_api.services.stream import balance_broker
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'balance_cache'
+
+
+@dataclass
+class CachedBalance:
+    # Serialized schemas.BalanceOut
+    balance: dict
+    expires: float
+
+
+class BalanceCache:
+    """Balance read cache Singleton class
+
+    Cache-aside: reads fill the cache on a miss, writes update it after
+    their commit (write-through), so within a worker a read never returns
+    a balance older than the last write it could have observed. Balances
+    written by other workers are seen after at most `ttl` seconds, or as
+    soon as their invalidation arrives if the channel is enabled.
+
+    Balances are cached by user and currency. All currencies of a user
+    are evicted and invalidated together, `max_size` counts users.
+    """
+
+    # For instantiation as a Singleton Pattern Class
+    __instance = None
+
+    ttl: float = 5
+    max_size: int = 10000
+    balances: OrderedDict[int, dict[str, CachedBalance]] = OrderedDict()
+    channel: "BalanceCacheInvalidator | None" = None
+
+    hits: int = 0
+    misses: int = 0
+    invalidations: int = 0
+    evictions: int = 0
+
+    def __init__(self):
+        raise RuntimeError('Call BalanceCache.instance() instead')
+
+    def __len__(self):
+        return len(self.balances)
+
+    @classmethod
+    def instance(cls):
+        """Return singleton instance"""
+        if cls.__instance is None:
+            logger.debug('Creating Balance Cache Instance')
+            cls.__instance = cls.__new__(cls)
+        return cls.__instance
+
+    @classmethod
+    def configure(
+        cls,
+        ttl: float,
+        max_size: int,
+        channel: "BalanceCacheInvalidator | None" = None
+    ) -> None:
+        cls.ttl = ttl
+        cls.max_size = max_size
+        cls.channel = channel
+
+    @classmethod
+    def get(cls, user_id: int, currency: str) -> dict | None:
+        """Get cached balance of a user in a currency"""
+        self = cls.instance()
+        currencies = self.balances.get(user_id)
+        cached = currencies.get(currency) if currencies else None
+        if cached is None or cached.expires <= time.monotonic():
+            cls.misses += 1
+            return None
+        self.balances.move_to_end(user_id)
+        cls.hits += 1
+        return cached.balance
+
+    @classmethod
+    def set(cls, balance: schemas.BalanceOut) -> None:
+        """Cache balance read from the database"""
+        self = cls.instance()
+        if self.ttl <= 0:
+            return
+        currencies = self.balances.get(balance.user_id)
+        if currencies is None:
+            currencies = self.balances[balance.user_id] = {}
+        currencies[balance.currency] = CachedBalance(
+            balance=serializers.balance(balance),
+            expires=time.monotonic() + self.ttl)
+        self.balances.move_to_end(balance.user_id)
+        while len(self.balances) > self.max_size:
+            self.balances.popitem(last=False)
+            cls.evictions += 1
+
+    @classmethod
+    def write(cls, balance: schemas.BalanceOut) -> None:
+        """Update cache with a committed balance, notify other workers
+        and the balance streams of the user"""
+        cls.set(balance)
+        balance_broker.publish_balance(balance)
+        if cls.channel is not None:
+            cls.channel.publish(balance.user_id)
+
+    @classmethod
+    def invalidate(cls, user_id: int) -> None:
+        if cls.instance().balances.pop(user_id, None) is not None:
+            cls.invalidations += 1
+
+    @classmethod
+    def clear(cls) -> None:
+        cls.instance().balances.clear()
+
+    @classmethod
+    def stats(cls) -> dict:
+        lookups = cls.hits + cls.misses
+        return {
+            'size': len(cls.instance()),
+            'max_size': cls.max_size,
+            'ttl': cls.ttl,
+            'hits': cls.hits,
+            'misses': cls.misses,
+            'hit_rate': round(cls.hits / lookups, 4) if lookups else 0.0,
+            'invalidations': cls.invalidations,
+            'evictions': cls.evictions,
+            'channel': cls.channel is not None,
+        }
+
+
+class BalanceCacheInvalidator:
+    """Cross-worker balance cache invalidation over Postgres LISTEN/NOTIFY
+
+    Written user ids are collected and sent in one NOTIFY per interval on
+    a dedicated connection. Every worker listens on the same connection
+    and drops cached balances written by other workers. While the
+    connection is down notifications are missed, so the whole cache is
+    cleared once it is back.
+    """
+
+    def __init__(self, database_url: str, interval: float = 0.01):
+        url = make_url(database_url).set(drivername='postgresql')
+        self.dsn = url.render_as_string(hide_password=False)
+        self.interval = interval
+        self.worker = str(os.getpid())
+        self.written: set[int] = set()
+        self.wakeup = asyncio.Event()
+
+    def publish(self, user_id: int) -> None:
+        """Queue invalidation of user's balance in other workers"""
+        self.written.add(user_id)
+        self.wakeup.set()
+
+    def receive(self, connection, pid, channel: str, payload: str) -> None:
+        worker, _, user_ids = payload.partition(':')
+        if worker == self.worker:
+            return
+        for user_id in map(int, user_ids.split(',')):
+            BalanceCache.invalidate(user_id)
+            balance_broker.refresh(user_id)
+
+    async def _notify(self, connection, batch_size: int = 500) -> None:
+        while not connection.is_closed():
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                continue
+            await asyncio.sleep(self.interval)
+            self.wakeup.clear()
+            written, self.written = list(self.written), set()
+            # NOTIFY payloads are limited to 8000 bytes
+            for start in range(0, len(written), batch_size):
+                user_ids = ','.join(map(str, written[start:start + batch_size]))
+                await connection.execute(
+                    'SELECT pg_notify($1, $2)', INVALIDATION_CHANNEL,
+                    f'{self.worker}:{user_ids}')
+
+    async def run(self, retry: float = 5):
+        """Listen and publish invalidations, reconnecting on failure"""
+        import asyncpg
+
+        while True:
+            try:
+                connection = await asyncpg.connect(self.dsn)
+            except (OSError, asyncpg.PostgresError) as ex:
+                logger.warning(f'Balance cache channel unavailable: {ex!r}')
+                await asyncio.sleep(retry)
+                continue
+            try:
+                await connection.add_listener(
+                    INVALIDATION_CHANNEL, self.receive)
+                BalanceCache.clear()
+                logger.info('Listening for balance cache invalidations')
+                await self._notify(connection)
+            except (OSError, asyncpg.PostgresError,
+                    asyncpg.InterfaceError) as ex:
+                logger.warning(f'Balance cache channel lost: {ex!r}')
+            finally:
+                connection.terminate()
+            BalanceCache.clear()
+            await asyncio.sleep(retry)
@@ -0,0 +1,209 @@
+import asyncio
+import csv
+import heapq
+import io
+import logging
+import time
+from datetime import datetime
+from typing import AsyncIterator
+
+from sqlalchemy import and_, func, select, union_all
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from client_transactions_api import models, serializers
+from client_transactions_api.services.offline import OfflineException
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class BalanceExport:
+    """Stream of all balances, in user id and currency order
+
+    Rows are fetched in batches through a server-side cursor on a
+    connection of its own, so memory stays constant whatever the number
+    of balances. With `snapshot` the rows are read in one REPEATABLE READ
+    transaction on Postgres, every row as of the export's start even
+    while transactions keep committing. `rows_per_second` paces the
+    batches, to keep a long export from competing with live traffic for
+    the DB.
+
+    Rows of several shards are read at once, one cursor each, and merged
+    in user id and currency order. Every shard has its own snapshot.
+
+    Args:
+        engines (list): Engines of the shards, the export's connections
+            are taken from
+        format (str): `csv` or `ndjson`
+        ledger (bool): Add each balance's ledger entry count and sum
+        snapshot (bool): Read all rows from one consistent snapshot
+        batch_size (int): Rows fetched and written at a time
+        rows_per_second (float): Max export rate, 0 for no limit
+    """
+
+    def __init__(self,
+                 engines: list[AsyncEngine],
+                 format: str = 'csv',
+                 ledger: bool = False,
+                 snapshot: bool = True,
+                 batch_size: int = 1000,
+                 rows_per_second: float = 0):
+        self.engines = engines
+        self.format = format
+        self.ledger = ledger
+        self.snapshot = snapshot
+        self.batch_size = batch_size
+        self.rows_per_second = rows_per_second
+        self.exported_at = datetime.utcnow()
+        self.rows = 0
+        self.connections: list[AsyncConnection] = []
+
+    @property
+    def media_type(self) -> str:
+        return FORMATS[self.format]
+
+    @property
+    def columns(self) -> list[str]:
+        columns = ['user_id', 'currency', 'value', 'held', 'updated_at']
+        if self.ledger:
+            columns += ['ledger_entries', 'ledger_sum']
+        return columns
+
+    def query(self):
+        Balance = models.Balance
+        columns = [
+            Balance.user_id, Balance.currency, Balance.value, Balance.held,
+            func.coalesce(Balance.updated_at, Balance.created_at)]
+        db_query = select(*columns).order_by(Balance.user_id, Balance.currency)
+        if self.ledger:
+            LedgerEntry = models.LedgerEntry
+            LedgerSummary = models.LedgerSummary
+            # Archived entries are only left as summaries
+            history = union_all(
+                select(
+                    LedgerEntry.user_id,
+                    LedgerEntry.currency,
+                    func.count(LedgerEntry.id).label('entries'),
+                    func.sum(LedgerEntry.amount).label('amount'))
+                .group_by(LedgerEntry.user_id, LedgerEntry.currency),
+                select(
+                    LedgerSummary.user_id,
+                    LedgerSummary.currency,
+                    func.sum(LedgerSummary.entries),
+                    func.sum(LedgerSummary.amount))
+                .group_by(LedgerSummary.user_id, LedgerSummary.currency)
+            ).subquery()
+            totals = (
+                select(
+                    history.c.user_id,
+                    history.c.currency,
+                    func.sum(history.c.entries).label('entries'),
+                    func.sum(history.c.amount).label('amount'))
+                .group_by(history.c.user_id, history.c.currency)
+                .subquery())
+            db_query = (
+                db_query
+                .add_columns(
+                    func.coalesce(totals.c.entries, 0),
+                    func.coalesce(totals.c.amount, 0.0))
+                .outerjoin(totals, and_(
+                    totals.c.user_id == Balance.user_id,
+                    totals.c.currency == Balance.currency)))
+        return db_query
+
+    async def open(self) -> None | OfflineException:
+        """Connect and begin the export's transactions"""
+        try:
+            for engine in self.engines:
+                connection = await engine.connect()
+                self.connections.append(connection)
+                if self.snapshot and engine.dialect.name == 'postgresql':
+                    await connection.execution_options(
+                        isolation_level='REPEATABLE READ')
+                await connection.begin()
+            self.exported_at = datetime.utcnow()
+        except (ConnectionRefusedError, OSError):
+            logger.warning('ConnectionRefusedError raised')
+            await self.close()
+            return OfflineException()
+
+    async def close(self) -> None:
+        connections, self.connections = self.connections, []
+        for connection in connections:
+            # Finish returning the connection to the pool even when the
+            # client disconnected and the response's task is cancelled
+            await asyncio.shield(connection.close())
+
+    def encode(self, rows: list) -> bytes:
+        if self.format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator='\n')
+            writer.writerows(
+                (*row[:4], row[4].isoformat() if row[4] else '', *row[5:])
+                for row in rows)
+            return buffer.getvalue().encode()
+        columns = self.columns
+        return b''.join(
+            serializers.dumps(dict(zip(columns, row))) + b'\n'
+            for row in rows)
+
+    async def batches(self) -> AsyncIterator[list]:
+        """Rows of all shards, in batches in user id and currency order"""
+        db_query = self.query().execution_options(yield_per=self.batch_size)
+        results = [await connection.stream(db_query)
+                   for connection in self.connections]
+        if len(results) == 1:
+            async for rows in results[0].partitions(self.batch_size):
+                yield rows
+            return
+
+        # Merge on user id and currency, which are unique across shards
+        heads = []
+        for index, result in enumerate(results):
+            row = await anext(result, None)
+            if row is not None:
+                heads.append((row[:2], index, row))
+        heapq.heapify(heads)
+        rows = []
+        while heads:
+            _, index, row = heads[0]
+            rows.append(row)
+            row = await anext(results[index], None)
+            if row is None:
+                heapq.heappop(heads)
+            else:
+                heapq.heapreplace(heads, (row[:2], index, row))
+            if len(rows) == self.batch_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """Encoded rows, closes the connections once exhausted
+
+        Must be called after a successful `open`.
+        """
+        started = time.perf_counter()
+        try:
+            if self.format == 'csv':
+                yield (','.join(self.columns) + '\n').encode()
+            async for rows in self.batches():
+                yield self.encode(rows)
+                self.rows += len(rows)
+                if self.rows_per_second > 0:
+                    ahead = self.rows / self.rows_per_second - (
+                        time.perf_counter() - started)
+                    if ahead > 0:
+                        await asyncio.sleep(ahead)
+            for connection in self.connections:
+                await connection.commit()
+            logger.info(
+                f'Exported {self.rows} balances in '
+                f'{time.perf_counter() - started:.1f}s')
+        finally:
+            await self.close()
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+logger = logging.getLogger(__name__)
+
+# Kept free of app imports, the module is imported by every pool process
+context = CryptContext(schemes=['argon2'], deprecated='auto')
+
+
+def hash_passwords(passwords: list[str]) -> list[str]:
+    return [context.hash(password) for password in passwords]
+
+
+class PasswordHasher:
+    """Hash passwords in a pool of processes, one per core by default
+
+    argon2 is CPU bound, so hashing in the worker's own process blocks
+    its event loop and uses a single core. The pool is started on first
+    use, with spawned processes that do not inherit the app's state.
+    """
+
+    def __init__(self, workers: int | None = None, batch_size: int = 8):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self._pool: ProcessPoolExecutor | None = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            logger.info(f'Starting password hashing pool of {self.workers}')
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    async def hash_many(self, passwords: list[str]) -> list[str]:
+        """Hash passwords in batches spread over the pool, in order"""
+
+        loop = asyncio.get_running_loop()
+        batches = [
+            passwords[i:i + self.batch_size]
+            for i in range(0, len(passwords), self.batch_size)]
+        results = await asyncio.gather(*[
+            loop.run_in_executor(self.pool, hash_passwords, batch)
+            for batch in batches])
+        return [hashed for batch in results for hashed in batch]
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
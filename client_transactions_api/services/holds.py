@@ -0,0 +1,159 @@
+import asyncio
+import logging
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from client_transactions_api import db, models, schemas
+from client_transactions_api.config import settings
+from client_transactions_api.services.cache import BalanceCache
+from client_transactions_api.services.locks import UserLocks, user_locks
+from client_transactions_api.services.offline import (OfflineException,
+                                                      OfflineTransactions,
+                                                      UserData)
+
+logger = logging.getLogger(__name__)
+
+
+def hold_out(hold: models.Hold) -> schemas.HoldOut:
+    return schemas.HoldOut(
+        id=hold.id,
+        user_id=hold.user_id,
+        value=hold.amount,
+        currency=hold.currency,
+        status=hold.status,
+        captured=hold.captured,
+        expires_at=hold.expires_at,
+        created_at=hold.created_at,
+        updated_at=hold.updated_at)
+
+
+async def _settle(
+    db_session: AsyncSession,
+    user_id: int,
+    operation,
+    *args,
+    locks: UserLocks
+) -> schemas.HoldOut | OfflineException:
+    """Run a hold operation of a user after their offline transactions
+
+    Offline transactions are synced first, so that the available funds
+    of the balance include them.
+    """
+
+    async with locks.lock(user_id):
+        offline = OfflineTransactions.instance()
+        gathered = await offline.gather(db_session, user_id)
+        if type(gathered) is OfflineException:
+            return gathered
+
+        result = await operation(db_session, *args)
+        if type(result) is OfflineException:
+            return result
+
+        hold, balance = result
+        offline.add_balance(
+            user_id, balance.currency, balance.value, balance.held)
+        BalanceCache.write(balance)
+    return hold_out(hold)
+
+
+async def place_hold(
+    db_session: AsyncSession,
+    user_id: int,
+    sum: float,
+    currency: str,
+    ttl: int,
+    locks: UserLocks = user_locks
+) -> schemas.HoldOut | OfflineException:
+    """Hold a sum of a user's balance in a currency for ttl seconds"""
+
+    return await _settle(
+        db_session, user_id, models.Hold.place,
+        user_id, currency, sum, ttl, locks=locks)
+
+
+async def capture_hold(
+    db_session: AsyncSession,
+    user_id: int,
+    hold_id: int,
+    sum: float | None = None,
+    locks: UserLocks = user_locks
+) -> schemas.HoldOut | OfflineException:
+    """Debit a sum of a user's hold, all of it by default"""
+
+    return await _settle(
+        db_session, user_id, models.Hold.capture,
+        hold_id, user_id, sum, locks=locks)
+
+
+async def void_hold(
+    db_session: AsyncSession,
+    user_id: int,
+    hold_id: int,
+    locks: UserLocks = user_locks
+) -> schemas.HoldOut | OfflineException:
+    """Release a user's hold"""
+
+    return await _settle(
+        db_session, user_id, models.Hold.void,
+        hold_id, user_id, locks=locks)
+
+
+class HoldSweeper:
+    """Hold sweeper class
+
+    Expires holds past their expiry time and releases their funds, in
+    batches of `batch_size` holds per DB transaction, on every shard
+    with interval. Sweepers of all workers can run at once, each skips
+    the holds the others have locked.
+    """
+
+    def __init__(self, interval: int = 60, batch_size: int = 500):
+        """Set sweeper interval in seconds"""
+        self.interval = interval
+        self.batch_size = batch_size
+
+    async def sweep(self) -> int | OfflineException:
+        """Expire due holds until none are left, return number of
+        released balances"""
+        total = 0
+        for shard in db.shards:
+            async with shard.Session() as db_session:
+                while True:
+                    balances = await models.Hold.expire_due(
+                        db_session, self.batch_size)
+                    if type(balances) is OfflineException:
+                        return balances
+                    if not len(balances):
+                        break
+                    for balance in balances:
+                        self._released(balance)
+                    total += len(balances)
+        return total
+
+    def _released(self, balance: models.Balance) -> None:
+        # The offline balance of users with offline transactions pending
+        # sync is left to the sync, only the held sum changes
+        user = OfflineTransactions.get_user_data(balance.user_id)
+        if type(user) is UserData and balance.currency in user:
+            user.set_held(balance.currency, balance.held)
+        BalanceCache.write(balance)
+
+    async def run(self):
+        """Run sweeper with interval"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                released = await self.sweep()
+            except Exception as ex:
+                logger.warning(f'Hold sweep failed: {ex!r}')
+                continue
+            if type(released) is OfflineException:
+                logger.info('Hold sweep skipped, service offline')
+            elif released:
+                logger.info(f'Released expired holds of {released} balances')
+
+
+hold_sweeper = HoldSweeper(
+    interval=settings.HOLD_SWEEP_INTERVAL,
+    batch_size=settings.HOLD_SWEEP_BATCH_SIZE)
@@ -0,0 +1,210 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from fastapi import HTTPException, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from client_transactions_api import db, models
+
+logger = logging.getLogger(__name__)
+
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+
+def fingerprint(payload: dict) -> str:
+    """Short digest of a request payload"""
+    dump = json.dumps(payload, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(dump, digest_size=16).hexdigest()
+
+
+@dataclass
+class IdempotentResult:
+    fingerprint: str
+    status_code: int
+    body: str
+    expires: float
+    # Whether the result is stored in the database as well
+    persisted: bool = False
+
+    def response(self) -> Response:
+        return Response(
+            content=self.body,
+            status_code=self.status_code,
+            media_type='application/json',
+            headers={REPLAYED_HEADER: 'true'})
+
+
+class IdempotencyStore:
+    """In-memory Idempotency-Key store Singleton class
+
+    Recent results keyed by (user_id, key). Results accepted while the DB
+    is offline live here until they are persisted by the offline replay.
+    """
+
+    # For instantiation as a Singleton Pattern Class
+    __instance = None
+
+    ttl: int = 60*60*24
+    max_size: int = 10000
+    results: OrderedDict[tuple[int, str], IdempotentResult] = OrderedDict()
+
+    def __init__(self):
+        raise RuntimeError('Call IdempotencyStore.instance() instead')
+
+    def __len__(self):
+        return len(self.results)
+
+    @classmethod
+    def instance(cls):
+        """Return singleton instance"""
+        if cls.__instance is None:
+            logger.debug('Creating Idempotency Store Instance')
+            cls.__instance = cls.__new__(cls)
+        return cls.__instance
+
+    @classmethod
+    def configure(cls, ttl: int, max_size: int) -> None:
+        cls.ttl = ttl
+        cls.max_size = max_size
+
+    def _evict(self) -> None:
+        """Drop expired results and persisted results over max size
+
+        Since all results share one TTL, insertion order is expiry order.
+        Results accepted offline are never dropped for size before they
+        are persisted.
+        """
+        now = time.monotonic()
+        while self.results:
+            key, result = next(iter(self.results.items()))
+            expired = result.expires <= now
+            oversize = len(self.results) > self.max_size and result.persisted
+            if not (expired or oversize):
+                break
+            del self.results[key]
+
+    @classmethod
+    def get(
+        cls,
+        user_id: int,
+        key: str,
+        request_fingerprint: str
+    ) -> IdempotentResult | None:
+        """Get stored result, check that the key is used for the same request"""
+        self = cls.instance()
+        result = self.results.get((user_id, key))
+        if result is None:
+            return None
+        if result.expires <= time.monotonic():
+            del self.results[(user_id, key)]
+            return None
+        check_fingerprint(key, result.fingerprint, request_fingerprint)
+        return result
+
+    @classmethod
+    def add(
+        cls,
+        user_id: int,
+        key: str,
+        request_fingerprint: str,
+        status_code: int,
+        body: str,
+        persisted: bool = False
+    ) -> IdempotentResult:
+        """Add result of a request"""
+        self = cls.instance()
+        result = IdempotentResult(
+            fingerprint=request_fingerprint,
+            status_code=status_code,
+            body=body,
+            expires=time.monotonic() + self.ttl,
+            persisted=persisted)
+        self.results[(user_id, key)] = result
+        self._evict()
+        return result
+
+    @classmethod
+    async def persist(
+        cls,
+        db_session: AsyncSession,
+        user_id: int
+    ) -> bool:
+        """Persist user's results accepted while offline, return whether
+        they are stored
+
+        Keys of the user another worker has persisted already are kept
+        as they are.
+        """
+        self = cls.instance()
+        pending = [
+            (key, result) for (result_user_id, key), result
+            in self.results.items()
+            if result_user_id == user_id and not result.persisted]
+        if not len(pending):
+            return True
+
+        stored = await models.IdempotencyKey.add_many(db_session, user_id, [
+            {'key': key,
+             'fingerprint': result.fingerprint,
+             'ttl': max(int(result.expires - time.monotonic()), 0),
+             'status_code': result.status_code,
+             'response': result.body}
+            for key, result in pending])
+        # DB went down again, results are persisted by the next sync
+        if stored is not None:
+            return False
+        for key, result in pending:
+            result.persisted = True
+        logger.info(
+            f'Persisted {len(pending)} offline idempotency keys for user #{user_id}')
+        return True
+
+
+def check_fingerprint(key: str, stored: str, request: str) -> None:
+    if stored != request:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Idempotency-Key '{key}' was already used for a different request")
+
+
+class IdempotencyKeySweeper:
+    """Idempotency key sweeper class
+
+    Deletes expired keys from the database of every shard in batches
+    with interval
+    """
+
+    def __init__(self, interval: int = 60, batch_size: int = 1000):
+        """Set sweeper interval in seconds"""
+        self.interval = interval
+        self.batch_size = batch_size
+
+    async def sweep(self) -> int:
+        """Delete expired keys until none are left"""
+        total = 0
+        for shard in db.shards:
+            async with shard.Session() as db_session:
+                while True:
+                    deleted = await models.IdempotencyKey.purge_expired(
+                        db_session, self.batch_size)
+                    if type(deleted) is not int or not deleted:
+                        break
+                    total += deleted
+        return total
+
+    async def run(self):
+        """Run sweeper with interval"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                deleted = await self.sweep()
+            except Exception as ex:
+                logger.warning(f'Idempotency key sweep failed: {ex!r}')
+                continue
+            if deleted:
+                logger.info(f'Deleted {deleted} expired idempotency keys')
@@ -0,0 +1,220 @@
+import asyncio
+import copy
+import logging
+from datetime import datetime
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import text
+
+from client_transactions_api import db, models
+from client_transactions_api.config import settings
+from client_transactions_api.models.partitions import (add_months,
+                                                       month_start)
+from client_transactions_api.services.offline import OfflineException
+
+logger = logging.getLogger(__name__)
+
+# Held by the worker maintaining the ledger, others skip the run
+ADVISORY_LOCK_KEY = 7_210_046
+
+
+class LedgerMaintenance:
+    """Ledger maintenance job class
+
+    Keeps `months_ahead` monthly ledger partitions created ahead of time,
+    and moves rows that were written to the DEFAULT partition while it did
+    not run into the partitions of their months. Compacts the months before the
+    last `retention_months` into per-user `LedgerSummary` rows: their
+    partitions are detached or dropped in the same DB transaction that
+    writes the summaries. Tables without partitions, i.e. on SQLite, get
+    their expired rows deleted month by month instead.
+
+    Every worker runs the job, runs overlapping on Postgres are skipped.
+    DDL gives up after `lock_timeout` rather than queue traffic behind it,
+    it is retried on the next run. A job maintains the ledger of one
+    shard, the first one by default.
+    """
+
+    def __init__(self,
+                 interval: int = 60*60,
+                 months_ahead: int = 3,
+                 retention_months: int = 0,
+                 archive: str = 'detach',
+                 lock_timeout: str = '5s',
+                 shard: db.Shard | None = None):
+        """Set job interval in seconds"""
+        self.interval = interval
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+        self.archive = archive
+        self.lock_timeout = lock_timeout
+        self.shard = shard or db.shards[0]
+
+    def for_shard(self, shard: db.Shard) -> 'LedgerMaintenance':
+        """Same job for another shard"""
+        job = copy.copy(self)
+        job.shard = shard
+        return job
+
+    async def _lock(self, db_session: AsyncSession) -> bool:
+        """Lock the ledger maintenance until the transaction ends"""
+        if db_session.bind.dialect.name != 'postgresql':
+            return True
+        await db_session.execute(
+            text(f"SET LOCAL lock_timeout = '{self.lock_timeout}'"))
+        result = await db_session.execute(
+            text('SELECT pg_try_advisory_xact_lock(:key)'),
+            {'key': ADVISORY_LOCK_KEY})
+        return result.scalar()
+
+    async def _summarize(
+        self,
+        db_session: AsyncSession,
+        start: datetime | None,
+        end: datetime
+    ) -> int | OfflineException:
+        """Summarize every month of a period with entries, does not commit"""
+        first = await models.LedgerEntry.first_created(db_session, end)
+        if type(first) is OfflineException:
+            return first
+        if first is None:
+            return 0
+        month = month_start(max(first, start or first))
+        months = 0
+        while month < end:
+            summarized = await models.LedgerSummary.summarize(
+                db_session, month, min(add_months(month, 1), end))
+            if type(summarized) is OfflineException:
+                return summarized
+            month = add_months(month, 1)
+            months += 1
+        return months
+
+    async def create_partitions(
+        self,
+        now: datetime
+    ) -> list[str] | OfflineException:
+        """Create missing partitions up to `months_ahead` months"""
+        until = add_months(now, self.months_ahead + 1)
+        async with self.shard.Session() as db_session:
+            if not await self._lock(db_session):
+                return []
+            created = await models.LedgerEntry.create_partitions(
+                db_session, until)
+            await db_session.commit()
+        return created
+
+    async def archive_partitions(
+        self,
+        cutoff: datetime
+    ) -> list[str] | OfflineException:
+        """Compact and archive partitions that end before a month"""
+        async with self.shard.Session() as db_session:
+            partitions = await models.LedgerEntry.partitions(db_session)
+            if type(partitions) is OfflineException:
+                return partitions
+            await db_session.rollback()
+
+            archived = []
+            for partition in partitions:
+                if partition.end is None or partition.end > cutoff:
+                    continue
+                if not await self._lock(db_session):
+                    break
+                summarized = await self._summarize(
+                    db_session, partition.start, partition.end)
+                if type(summarized) is OfflineException:
+                    return summarized
+                archive = await models.LedgerEntry.archive_partition(
+                    db_session, partition, drop=self.archive == 'drop')
+                if type(archive) is OfflineException:
+                    return archive
+                await db_session.commit()
+                archived.append(partition.name)
+                logger.info(
+                    f'Archived ledger partition {partition.name} '
+                    f'({self.archive}), {summarized} months summarized')
+        return archived
+
+    async def purge(self, cutoff: datetime) -> int | OfflineException:
+        """Compact and delete entries of an unpartitioned table by month"""
+        deleted = 0
+        async with self.shard.Session() as db_session:
+            first = await models.LedgerEntry.first_created(db_session, cutoff)
+            if type(first) is OfflineException:
+                return first
+            if first is None:
+                return 0
+            month = month_start(first)
+            while month < cutoff:
+                end = add_months(month, 1)
+                summarized = await models.LedgerSummary.summarize(
+                    db_session, month, end)
+                if type(summarized) is OfflineException:
+                    return summarized
+                purged = await models.LedgerEntry.purge(
+                    db_session, month, end)
+                if type(purged) is OfflineException:
+                    return purged
+                await db_session.commit()
+                deleted += purged
+                month = end
+        return deleted
+
+    async def maintain(
+        self,
+        now: datetime | None = None
+    ) -> dict | OfflineException:
+        """Run partition creation and compaction once, as of now by default"""
+        now = now or datetime.utcnow()
+        async with self.shard.Session() as db_session:
+            partitioned = await models.LedgerEntry.is_partitioned(db_session)
+        if type(partitioned) is OfflineException:
+            return partitioned
+
+        results = {'created': [], 'archived': [], 'deleted': 0}
+        if partitioned:
+            created = await self.create_partitions(now)
+            if type(created) is OfflineException:
+                return created
+            results['created'] = created
+        if not self.retention_months:
+            return results
+
+        cutoff = add_months(now, -self.retention_months)
+        if partitioned:
+            archived = await self.archive_partitions(cutoff)
+            if type(archived) is OfflineException:
+                return archived
+            results['archived'] = archived
+        else:
+            deleted = await self.purge(cutoff)
+            if type(deleted) is OfflineException:
+                return deleted
+            results['deleted'] = deleted
+        return results
+
+    async def run(self):
+        """Run job with interval, starting right away"""
+        while True:
+            try:
+                results = await self.maintain()
+            except Exception as ex:
+                logger.warning(
+                    f'Ledger maintenance of shard {self.shard.index} '
+                    f'failed: {ex!r}')
+            else:
+                if type(results) is not OfflineException and \
+                        (results['created'] or results['archived']
+                         or results['deleted']):
+                    logger.info(
+                        f'Ledger maintenance of shard {self.shard.index}: '
+                        f'{results}')
+            await asyncio.sleep(self.interval)
+
+
+ledger_maintenance = LedgerMaintenance(
+    interval=settings.LEDGER_MAINTENANCE_INTERVAL,
+    months_ahead=settings.LEDGER_PARTITIONS_AHEAD,
+    retention_months=settings.LEDGER_RETENTION_MONTHS,
+    archive=settings.LEDGER_ARCHIVE)
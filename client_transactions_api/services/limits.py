@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from jose import JWTError, jwt
+from starlette.datastructures import Headers
+from starlette.types import Scope
+
+from client_transactions_api.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class TokenBucket:
+    tokens: float
+    updated: float
+
+
+class RateLimiter:
+    """Token bucket rate limiter keyed by user or client address
+
+    Each key may make `burst` requests at once and `rate` requests per
+    second after that. A bucket left idle for `burst / rate` seconds is
+    full again, the same as a missing one, so buckets are kept in order
+    of last use and idle ones are dropped from the front as requests
+    come in. Memory is O(1) per key active within that window, capped at
+    `max_keys`.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets: OrderedDict[int | str, TokenBucket] = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.buckets)
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    @property
+    def refill_time(self) -> float:
+        """Seconds an empty bucket takes to fill up"""
+        return self.burst / self.rate
+
+    def _expire(self, now: float) -> None:
+        idle_since = now - self.refill_time
+        while self.buckets:
+            bucket = next(iter(self.buckets.values()))
+            if bucket.updated > idle_since:
+                break
+            self.buckets.popitem(last=False)
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+            self.evictions += 1
+
+    def acquire(self, key: int | str) -> float:
+        """Take a token for key
+
+        Returns:
+            float: 0 if the request is allowed, otherwise seconds until
+                a token is available
+        """
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.burst, now)
+            self._expire(now)
+        else:
+            bucket.tokens = min(
+                self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self.buckets.move_to_end(key)
+
+        if bucket.tokens < 1:
+            self.rejected += 1
+            return (1 - bucket.tokens) / self.rate
+        bucket.tokens -= 1
+        self.allowed += 1
+        return 0
+
+    def stats(self) -> dict:
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'keys': len(self),
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+            'evictions': self.evictions,
+        }
+
+
+class AdmissionControl:
+    """Global limit of requests processed at once by a worker
+
+    Requests over the limit wait up to `timeout` seconds for a slot, at
+    most `max_queue` of them at a time; the rest are shed right away.
+    Keeping the limit at the DB pool capacity sheds load with a fast 503
+    instead of queuing requests for a pool connection until they time out.
+    """
+
+    def __init__(self, limit: int, max_queue: int, timeout: float):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+        self.in_flight = 0
+        self.queued = 0
+        self.peak = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.semaphore is not None
+
+    async def acquire(self) -> bool:
+        """Wait for a slot, False if the request is shed"""
+        if self.semaphore.locked():
+            if self.queued >= self.max_queue or self.timeout <= 0:
+                self.rejected += 1
+                return False
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                self.timeouts += 1
+                return False
+            finally:
+                self.queued -= 1
+        else:
+            await self.semaphore.acquire()
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        self.admitted += 1
+        return True
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self.semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'peak': self.peak,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+        }
+
+
+def trusted_proxies(setting: str | None) -> set[str]:
+    """Addresses of the FORWARDED_ALLOW_IPS setting"""
+    if not setting:
+        return set()
+    return {address.strip() for address in setting.split(',')}
+
+
+proxies = trusted_proxies(settings.FORWARDED_ALLOW_IPS)
+
+
+def client_address(scope: Scope) -> str:
+    """Rate limit key of the client address
+
+    Requests of trusted proxies are keyed by the last address of their
+    X-Forwarded-For header that is not a trusted proxy, the way uvicorn's
+    `--proxy-headers` finds the client. Otherwise every client behind a
+    proxy would share its bucket.
+    """
+    client = scope.get('client')
+    address = client[0] if client else 'unknown'
+    if not proxies or ('*' not in proxies and address not in proxies):
+        return address
+    forwarded_for = Headers(scope=scope).get('x-forwarded-for')
+    if not forwarded_for:
+        return address
+    hosts = [host.strip() for host in forwarded_for.split(',')]
+    if '*' in proxies:
+        return hosts[0]
+    for host in reversed(hosts):
+        if host not in proxies:
+            return host
+    return address
+
+
+def token_user(scope: Scope) -> int | str:
+    """Rate limit key of the user id claim of the bearer token
+
+    Decoded claims are kept in the request state for authentication, so
+    that the token is decoded once. Requests without a valid token are
+    keyed by client address, they are rejected by authentication anyway.
+    """
+    authorization = Headers(scope=scope).get('authorization', '')
+    scheme, _, token = authorization.partition(' ')
+    if scheme.lower() == 'bearer' and token:
+        try:
+            payload = jwt.decode(
+                token, settings.SECRET_KEY.get_secret_value(),
+                algorithms=[settings.CRYPT_ALGORITHM])
+            key = payload.get('uid') or payload['sub']
+        except (JWTError, KeyError):
+            return client_address(scope)
+        scope.setdefault('state', {})['token_claims'] = (token, payload)
+        return key
+    return client_address(scope)
+
+
+def default_concurrency() -> int:
+    """DB pool size plus overflow of all shards, or 0 (no limit) without
+    a pool limit"""
+    from client_transactions_api import db
+
+    return len(db.shards) * (db.pool_options.get('pool_size', 0) +
+                             db.pool_options.get('max_overflow', 0))
+
+
+# Keyed by user id, see RateLimitMiddleware rules in main.py
+transaction_limiter = RateLimiter(
+    rate=settings.TRANSACTION_RATE,
+    burst=settings.TRANSACTION_BURST,
+    max_keys=settings.RATE_LIMIT_KEYS)
+
+# Keyed by client address
+auth_limiter = RateLimiter(
+    rate=settings.AUTH_RATE,
+    burst=settings.AUTH_BURST,
+    max_keys=settings.RATE_LIMIT_KEYS)
+
+concurrency_limit = settings.MAX_CONCURRENCY
+if concurrency_limit is None:
+    concurrency_limit = default_concurrency()
+
+admission = AdmissionControl(
+    limit=concurrency_limit,
+    max_queue=(settings.ADMISSION_QUEUE
+               if settings.ADMISSION_QUEUE is not None else concurrency_limit),
+    timeout=settings.ADMISSION_TIMEOUT)
@@ -0,0 +1,52 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LockEntry:
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    # Number of tasks holding or waiting for the lock
+    users: int = 0
+
+
+class UserLocks:
+    """Table of per-user asyncio locks
+
+    An entry only exists while a task holds or waits for the user's lock,
+    so the table is bounded by the number of in-flight requests and cleans
+    itself up. Locks serialize writes within one worker process only.
+    """
+
+    def __init__(self):
+        self.entries: dict[int, LockEntry] = {}
+
+    def __len__(self):
+        """Return number of users with held or awaited locks"""
+        return len(self.entries)
+
+    def locked(self, user_id: int) -> bool:
+        entry = self.entries.get(user_id)
+        return entry is not None and entry.lock.locked()
+
+    @asynccontextmanager
+    async def lock(self, user_id: int) -> AsyncIterator[None]:
+        """Hold user's lock for the duration of the context"""
+        entry = self.entries.get(user_id)
+        if entry is None:
+            entry = self.entries[user_id] = LockEntry()
+        entry.users += 1
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                del self.entries[user_id]
+
+
+user_locks = UserLocks()
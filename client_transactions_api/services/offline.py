@@ -1,10 +1,17 @@
 import asyncio
 import logging
+import time
+import uuid
+from array import array
+from collections import OrderedDict, deque
 from dataclasses import dataclass, field
+from datetime import datetime, timezone
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from client_transactions_api import db, models
+from client_transactions_api.services.cache import BalanceCache
+from client_transactions_api.services.idempotency import IdempotencyStore
 
 logger = logging.getLogger(__name__)
 
@@ -39,15 +46,97 @@ class OfflineUserUnavailable(Exception):
     """Offline Exception for insufficient funds"""
 
 
+class OfflineCapacityExceeded(Exception):
+    """Offline Exception for too many transactions awaiting reconciliation"""
+
+
 @dataclass
 class OfflineTransaction:
     sum: float
+    currency: str
+    user_id: int = 0
+    tracking_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    accepted_at: datetime = field(default_factory=datetime.utcnow)
+    reconciled_at: datetime | None = None
 
+    @property
+    def status(self) -> str:
+        return 'reconciled' if self.reconciled_at else 'pending'
 
-@dataclass
+
+# Currency codes of users, one tuple shared by all users holding the same
+_currency_sets: dict[tuple[str, ...], tuple[str, ...]] = {}
+
+
+@dataclass(slots=True)
 class UserData:
-    token: str = field(default_factory=str)
-    balance: float = field(default_factory=float)
+    """Last known balances of a user, by currency
+
+    Users hold few currencies. Their codes are kept in a tuple shared by
+    all users holding the same ones, and the balance, the last balance
+    read from or written to the DB, the time of that sync and the sum
+    held on the balance at that time of every currency in one flat array
+    of doubles, rather than an object per balance, so a cached user costs
+    about the same whatever the number of their currencies.
+    """
+
+    currencies: tuple[str, ...] = ()
+    # Balance, synced balance, synced at timestamp and held sum of each
+    # currency
+    values: array = field(default_factory=lambda: array('d'))
+    # Whether there are offline transactions to sync once DB is online
+    offline: bool = False
+
+    def __contains__(self, currency: str) -> bool:
+        return currency in self.currencies
+
+    def _index(self, currency: str) -> int:
+        return self.currencies.index(currency) * 4
+
+    def balance(self, currency: str) -> float:
+        return self.values[self._index(currency)]
+
+    def synced_balance(self, currency: str) -> float:
+        return self.values[self._index(currency) + 1]
+
+    def synced_at(self, currency: str) -> datetime:
+        return datetime.fromtimestamp(
+            self.values[self._index(currency) + 2],
+            timezone.utc).replace(tzinfo=None)
+
+    def held(self, currency: str) -> float:
+        return self.values[self._index(currency) + 3]
+
+    def available(self, currency: str) -> float:
+        """Balance not reserved by holds"""
+        index = self._index(currency)
+        return self.values[index] - self.values[index + 3]
+
+    def pending(self, currency: str) -> float:
+        """Sum of offline transactions not yet synced with the DB"""
+        index = self._index(currency)
+        return self.values[index] - self.values[index + 1]
+
+    def sync(self, currency: str, balance: float, held: float = 0.0) -> None:
+        """Set balance read from or written to the DB"""
+        synced = (balance, balance, time.time(), held)
+        if currency not in self.currencies:
+            currencies = self.currencies + (currency,)
+            self.currencies = _currency_sets.setdefault(currencies, currencies)
+            self.values.extend(synced)
+            return
+        index = self._index(currency)
+        self.values[index:index + 4] = array('d', synced)
+
+    def set_held(self, currency: str, held: float) -> None:
+        """Set sum held on the balance, leaving offline transactions be"""
+        self.values[self._index(currency) + 3] = held
+
+    def add(self, currency: str, sum: float) -> float:
+        """Add an offline transaction, return the new balance"""
+        index = self._index(currency)
+        self.values[index] += sum
+        return self.values[index]
 
 
 class OfflineTransactions:
@@ -56,17 +145,23 @@ class OfflineTransactions:
     # For instantiation as a Singleton Pattern Class
     __instance = None
 
-    user_ids: dict[str, int] = {}
-    user_names: dict[int, str] = {}
-    user_data: dict[str, UserData] = {}
-    users_offline: list[str] = []
+    # Last known balances by user id
+    users: dict[int, UserData] = {}
+
+    # Offline transactions by tracking id, for reconciliation status polling
+    tracked: OrderedDict[str, OfflineTransaction] = OrderedDict()
+    tracked_pending: dict[int, list[OfflineTransaction]] = {}
+    # Tracking ids of reconciled transactions, oldest first, forgotten
+    # first once `max_tracked` transactions are tracked
+    reconciled: deque[str] = deque()
+    max_tracked: int = 10000
 
     def __init__(self):
         raise RuntimeError('Call OfflineTransactions.instance() instead')
 
     def __len__(self):
         """Return length of users that need to be processed once db is online"""
-        return len(self.users_offline)
+        return sum(1 for user in self.users.values() if user.offline)
 
     @classmethod
     def instance(cls):
@@ -77,71 +172,91 @@ class OfflineTransactions:
         return cls.__instance
 
     @classmethod
-    def add_auth_data(cls, user_id: int, username: str, token: str) -> None:
-        """Add valid auth user data to dict"""
-        self = cls.instance()
-
-        # Add user's auth data to offline storage
-        if username not in self.user_data.keys():
-            self.user_data[username] = UserData(token=token)
-            logger.info(f'Added user {username} (#{user_id}) to offline database storage')
-        else:
-            self.user_data[username].token = token
-
-        # Set user id and username lookup dicts
-        self.user_ids[username] = user_id
-        self.user_names[user_id] = username
-
-    @classmethod
-    async def gather(cls, db_session: AsyncSession, user_id: int) -> None:
-        """Gather offline transactions for a user if back online"""
+    async def gather(
+        cls,
+        db_session: AsyncSession,
+        user_id: int
+    ) -> None | OfflineException:
+        """Gather offline transactions of a user in every currency
+        if back online"""
 
         self = cls.instance()
-        username = self.user_names[user_id]
+        user = self.users.get(user_id)
 
         # If user is not in list of user to process offline, do nothing
-        if username not in self.users_offline:
-            return
-
-        offline_user_data = self.user_data[username]
-        balance = await models.Balance.get(db_session, user_id=user_id)
-
-        # If user does not have a balance, do nothing
-        # Or if offline balance is equal to that in DB
-        if balance is None or balance.value == offline_user_data.balance:
+        if user is None or not user.offline:
             return
 
-        # Calculate difference between DB and balance stored offline
-        delta_sum = offline_user_data.balance - balance.value
-        await models.Balance.transaction(db_session, user_id=user_id, sum=delta_sum)
+        for currency in user.currencies:
+            pending = user.pending(currency)
+            if not pending:
+                continue
+            balance = await models.Balance.get_or_create(
+                db_session, user_id=user_id, currency=currency,
+                for_update=True)
+            if type(balance) is OfflineException:
+                return balance
+
+            # Apply the sum of the offline transactions, not the difference
+            # to the DB balance: other workers may have synced their own
+            # offline transactions of the user in the meantime
+            value = balance.value + pending
+            if value < balance.held:
+                logger.warning(
+                    f'Offline {currency} transactions of user #{user_id} of '
+                    f'several workers overdraw their available funds to '
+                    f'{value - balance.held:.2f}')
+            result = await models.LedgerEntry.record(
+                db_session, 'offline_sync', [
+                    {'user_id': user_id, 'currency': currency,
+                     'amount': pending, 'balance': value}])
+            if type(result) is not OfflineException:
+                result = await balance.update(db_session, value=value)
+            if type(result) is OfflineException:
+                return result
+            user.sync(currency, value, balance.held)
+            BalanceCache.write(balance)
+
+        # Keep Idempotency-Keys of requests accepted while offline
+        if not await IdempotencyStore.persist(db_session, user_id):
+            return OfflineException()
 
         # User's offline transactions done
-        self.users_offline.remove(username)
+        now = datetime.utcnow()
+        for transaction in self.tracked_pending.pop(user_id, []):
+            transaction.reconciled_at = now
+            self.reconciled.append(transaction.tracking_id)
+        user.offline = False
 
     @classmethod
-    def add_balance(cls, user_id: int, balance: float) -> None:
-        """Add user's balance"""
-        self = cls.instance()
-        if user_id not in self.user_ids.values():
-            logger.warning(
-                f'User #{user_id} not available for offline transaction '
-                'processing because they have not authenticated yet during '
-                'applications runtime')
-            return
-        username = self.user_names[user_id]
-        if username not in self.user_data.keys():
-            self.user_data[username] = UserData(balance=balance)
-        else:
-            self.user_data[username].balance = balance
+    def is_pending(cls, user_id: int) -> bool:
+        """Whether user has offline transactions not yet synced with the DB"""
+        user = cls.instance().users.get(user_id)
+        return user is not None and user.offline
 
     @classmethod
-    def get_balance(cls, username: str) -> float | OfflineUserUnavailable:
-        """Get user's balance value"""
+    def add_balance(
+        cls,
+        user_id: int,
+        currency: str,
+        balance: float,
+        held: float = 0.0
+    ) -> None:
+        """Add user's balance read from or written to the DB"""
         self = cls.instance()
-        user = self.user_data.get(username) or None
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = UserData()
+            logger.info(f'Added user #{user_id} to offline database storage')
+        user.sync(currency, balance, held)
+
+    @classmethod
+    def get_user_data(cls, user_id: int) -> UserData | OfflineUserUnavailable:
+        """Get user's offline data, if their balance has been seen online"""
+        user = cls.instance().users.get(user_id)
         if user is None:
             return OfflineUserUnavailable()
-        return user.balance
+        return user
 
     @classmethod
     def _check_transaction(cls, balance: float, sum: float) -> bool:
@@ -153,34 +268,64 @@ class OfflineTransactions:
     def transaction(
         cls,
         user_id: int,
-        sum: float
-    ) -> float | OfflineUserUnavailable | InsufficientFundsException:
-        """Add transaction to user's balance"""
+        sum: float,
+        currency: str
+    ) -> float | OfflineUserUnavailable | InsufficientFundsException | \
+            OfflineCapacityExceeded:
+        """Add transaction to user's balance in a currency"""
         self = cls.instance()
-        if user_id not in self.user_ids.values():
+
+        # Pending transactions are tracked until they are reconciled,
+        # new ones are refused rather than tracked without bound
+        if not self._make_room():
+            return OfflineCapacityExceeded()
+
+        # If user's balance was not seen during api's runtime
+        # there is nothing to carry out the transaction on
+        user = self.users.get(user_id)
+        if user is None or currency not in user:
             return OfflineUserUnavailable()
-        else:
-            username = self.user_names[user_id]
-
-            # If user is not present in user_data dict
-            # They have not authenticated during api's runtime
-            if username not in self.user_data.keys():
-                return OfflineUserUnavailable()
-
-            # Check if there are enough funds to carry out the transaction
-            balance = self.user_data[username].balance
-            valid = self._check_transaction(balance, sum)
-            if not valid:
-                return InsufficientFundsException(balance, sum)
-
-            # Update user's new balance based on valid sum
-            self.user_data[username].balance = balance + sum
-
-            # Add username to list of offline users to process
-            # Once DB comes back online
-            if username not in self.users_offline:
-                self.users_offline.append(username)
-            return self.user_data[username].balance
+
+        # Check if there are enough funds to carry out the transaction,
+        # funds held when the DB went down stay reserved
+        balance = user.available(currency)
+        valid = self._check_transaction(balance, sum)
+        if not valid:
+            return InsufficientFundsException(balance, sum)
+
+        # Update user's new balance based on valid sum and mark user
+        # to process once DB comes back online
+        user.offline = True
+        return user.add(currency, sum)
+
+    @classmethod
+    def track(
+        cls,
+        user_id: int,
+        sum: float,
+        currency: str
+    ) -> OfflineTransaction:
+        """Track an accepted offline transaction until it is reconciled"""
+        self = cls.instance()
+        transaction = OfflineTransaction(
+            sum=sum, user_id=user_id, currency=currency)
+        self.tracked[transaction.tracking_id] = transaction
+        self.tracked_pending.setdefault(user_id, []).append(transaction)
+        return transaction
+
+    def _make_room(self) -> bool:
+        """Forget oldest reconciled transactions until another one can be
+        tracked, False if all tracked ones are pending"""
+        while len(self.tracked) >= self.max_tracked:
+            if not self.reconciled:
+                return False
+            self.tracked.pop(self.reconciled.popleft(), None)
+        return True
+
+    @classmethod
+    def get_tracked(cls, tracking_id: str) -> OfflineTransaction | None:
+        """Get tracked offline transaction"""
+        return cls.instance().tracked.get(tracking_id)
 
 
 class OfflineTransactionPool:
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import os
+import urllib.request
+
+from client_transactions_api import db, models, serializers
+from client_transactions_api.config import settings
+from client_transactions_api.services.offline import OfflineException
+
+logger = logging.getLogger(__name__)
+
+
+class SinkFull(Exception):
+    """Sink can not take the events now, they are delivered again later"""
+
+
+class Sink:
+    """Destination of outbox events
+
+    `deliver` gets a batch of serialized events, in id order, and must
+    raise if any of them was not delivered: the whole batch is then
+    delivered again later, to every sink. Consumers see each event at
+    least once and should skip event ids they already handled.
+    """
+
+    name = 'sink'
+
+    def __init__(self):
+        self.delivered = 0
+        self.failures = 0
+
+    async def deliver(self, events: list[dict]) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {
+            'name': self.name,
+            'delivered': self.delivered,
+            'failures': self.failures,
+        }
+
+
+class WebhookSink(Sink):
+    """POST batches of events as a JSON array to a URL
+
+    Any response other than 2xx fails the delivery.
+    """
+
+    name = 'webhook'
+
+    def __init__(self, url: str, timeout: float = 5):
+        super().__init__()
+        self.url = url
+        self.timeout = timeout
+
+    def _post(self, body: bytes) -> None:
+        request = urllib.request.Request(
+            self.url, data=body, method='POST',
+            headers={'Content-Type': 'application/json'})
+        # Raises HTTPError on 4xx and 5xx responses
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+    async def deliver(self, events: list[dict]) -> None:
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._post, serializers.dumps(events))
+
+
+class FileSink(Sink):
+    """Append events to a file as JSON lines, synced to disk per batch"""
+
+    name = 'file'
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def _write(self, body: bytes) -> None:
+        with open(self.path, 'ab') as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def deliver(self, events: list[dict]) -> None:
+        body = b''.join(serializers.dumps(event) + b'\n' for event in events)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._write, body)
+
+
+class QueueSink(Sink):
+    """In-process subscriber queue, i.e. for tests
+
+    The queue is bounded: a batch that does not fit is refused and stays
+    in the outbox until the subscriber has caught up.
+    """
+
+    name = 'queue'
+
+    def __init__(self, max_size: int = 1000):
+        super().__init__()
+        self.queue: asyncio.Queue[dict] = asyncio.Queue(max_size)
+
+    async def deliver(self, events: list[dict]) -> None:
+        if self.queue.maxsize - self.queue.qsize() < len(events):
+            raise SinkFull(
+                f'Subscriber queue has no room for {len(events)} events')
+        for event in events:
+            self.queue.put_nowait(event)
+
+    async def get(self) -> dict:
+        """Wait for the next event"""
+        return await self.queue.get()
+
+
+class OutboxDispatcher:
+    """Outbox dispatcher class
+
+    Drains the outbox in batches of `batch_size` events, oldest first,
+    and delivers every batch to all sinks. A batch is deleted once all
+    sinks took it, and pushed back with exponential backoff, up to
+    `max_delay` seconds, if any of them failed. Only one batch is held
+    in memory at a time, undelivered events wait in the DB. The outboxes
+    of all shards are drained in turn.
+    """
+
+    def __init__(self,
+                 sinks: list[Sink] | None = None,
+                 batch_size: int = 100,
+                 interval: float = 1,
+                 max_delay: float = 60):
+        """Set dispatcher interval in seconds"""
+        self.sinks = sinks or []
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_delay = max_delay
+        self.dispatched = 0
+        self.retried = 0
+        self.last_error: str | None = None
+
+    def add_sink(self, sink: Sink) -> Sink:
+        self.sinks.append(sink)
+        return sink
+
+    async def dispatch(self, shard: db.Shard | None = None) -> int:
+        """Deliver one batch of a shard, return number of delivered events"""
+        async with (shard or db.shards[0]).Session() as db_session:
+            events = await models.OutboxEvent.claim(
+                db_session, self.batch_size)
+            if type(events) is OfflineException or not events:
+                return 0
+            ids = [event.id for event in events]
+            batch = serializers.balance_event.many(events)
+
+            for sink in self.sinks:
+                try:
+                    await sink.deliver(batch)
+                except Exception as ex:
+                    sink.failures += 1
+                    self.last_error = f'{sink.name}: {ex!r}'
+                    logger.warning(
+                        f'Delivery of {len(ids)} outbox events to '
+                        f'{sink.name} failed: {ex!r}')
+                    attempts = max(event.attempts for event in events)
+                    delay = min(self.max_delay, self.interval * 2 ** attempts)
+                    await models.OutboxEvent.retry(db_session, ids, delay)
+                    self.retried += len(ids)
+                    return 0
+                sink.delivered += len(ids)
+
+            await models.OutboxEvent.delivered(db_session, ids)
+        self.dispatched += len(ids)
+        return len(ids)
+
+    async def run(self):
+        """Run dispatcher, with interval while the outbox is drained"""
+        while True:
+            dispatched = 0
+            for shard in db.shards:
+                try:
+                    dispatched = max(dispatched, await self.dispatch(shard))
+                except Exception as ex:
+                    logger.warning(
+                        f'Outbox dispatch of shard {shard.index} '
+                        f'failed: {ex!r}')
+            if dispatched < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+    async def close(self) -> None:
+        for sink in self.sinks:
+            await sink.close()
+
+    def stats(self) -> dict:
+        return {
+            'enabled': models.OutboxEvent.enabled,
+            'batch_size': self.batch_size,
+            'dispatched': self.dispatched,
+            'retried': self.retried,
+            'last_error': self.last_error,
+            'sinks': [sink.stats() for sink in self.sinks],
+        }
+
+
+def configured_sinks() -> list[Sink]:
+    sinks = []
+    if settings.OUTBOX_WEBHOOK_URL:
+        sinks.append(WebhookSink(
+            settings.OUTBOX_WEBHOOK_URL, settings.OUTBOX_WEBHOOK_TIMEOUT))
+    if settings.OUTBOX_FILE:
+        sinks.append(FileSink(settings.OUTBOX_FILE))
+    return sinks
+
+
+dispatcher = OutboxDispatcher(
+    sinks=configured_sinks(),
+    batch_size=settings.OUTBOX_BATCH_SIZE,
+    interval=settings.OUTBOX_INTERVAL,
+    max_delay=settings.OUTBOX_MAX_DELAY)
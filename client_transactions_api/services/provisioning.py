@@ -0,0 +1,151 @@
+import asyncio
+import logging
+from dataclasses import asdict, dataclass
+from typing import Iterable
+
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from client_transactions_api import db, models, schemas
+from client_transactions_api.services.hashing import PasswordHasher
+from client_transactions_api.services.offline import OfflineException
+
+logger = logging.getLogger(__name__)
+
+USERNAME_LENGTH = models.User.username.type.length
+
+
+@dataclass
+class ImportResult:
+    username: str
+    status: str = 'pending'
+    id: int | None = None
+    detail: str | None = None
+
+
+def chunked(items: list, size: int) -> Iterable[list]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def import_users(
+    db_session: AsyncSession,
+    users: list[schemas.UserLogin],
+    hasher: PasswordHasher,
+    chunk_size: int = 1000
+) -> list[dict]:
+    """Register users in bulk
+
+    Taken usernames are looked up with one query per chunk, before any
+    password is hashed. Passwords of all chunks are then hashed in the
+    process pool while earlier chunks are inserted, each chunk with one
+    multi-row insert and commit, so the import is bound by the pool's
+    cores rather than by DB round trips.
+
+    Returns:
+        result (list): Outcome of every user, in input order
+    """
+
+    results = [ImportResult(username=user.username) for user in users]
+    seen = set()
+    candidates = []
+    for user, result in zip(users, results):
+        if not user.username or len(user.username) > USERNAME_LENGTH:
+            result.status = 'invalid'
+            result.detail = f'Username must be 1 to {USERNAME_LENGTH} characters'
+        elif not user.password:
+            result.status = 'invalid'
+            result.detail = 'Password must not be empty'
+        elif user.username in seen:
+            result.status = 'duplicate'
+            result.detail = 'Username repeated in the import'
+        else:
+            seen.add(user.username)
+            candidates.append((user, result))
+
+    chunks = []
+    for chunk in chunked(candidates, chunk_size):
+        taken = await models.User.existing_usernames(
+            db_session, [user.username for user, _ in chunk])
+        if type(taken) is OfflineException:
+            return _failed(results, 'Service down, DB is not available')
+        new = []
+        for user, result in chunk:
+            if user.username in taken:
+                result.status = 'exists'
+                result.detail = f"Username '{user.username}' already taken"
+            else:
+                new.append((user, result))
+        if new:
+            hashing = asyncio.ensure_future(
+                hasher.hash_many([user.password for user, _ in new]))
+            chunks.append((new, hashing))
+
+    try:
+        for new, hashing in chunks:
+            hashed_passwords = await hashing
+            try:
+                ids = await models.User.add_many(db_session, [
+                    {'username': user.username, 'hashed_password': hashed}
+                    for (user, _), hashed in zip(new, hashed_passwords)])
+            except HTTPException as ex:
+                # Chunk was rolled back, the next ones may still succeed
+                logger.warning(f'Import of {len(new)} users failed: {ex.detail}')
+                for _, result in new:
+                    result.status = 'failed'
+                    result.detail = str(ex.detail)
+                continue
+            if type(ids) is OfflineException:
+                return _failed(results, 'Service down, DB is not available')
+            for user, result in new:
+                result.status = 'created'
+                result.id = ids.get(user.username)
+            logger.info(f'Imported {len(new)} users')
+    finally:
+        for _, hashing in chunks:
+            hashing.cancel()
+
+    return [asdict(result) for result in results]
+
+
+async def import_users_by_shard(
+    users: list[schemas.UserLogin],
+    hasher: PasswordHasher,
+    chunk_size: int = 1000
+) -> list[dict]:
+    """Register users in bulk on the shards of their usernames
+
+    Shards import their users at once, sharing the hasher's pool.
+
+    Returns:
+        result (list): Outcome of every user, in input order
+    """
+
+    by_shard = {}
+    for index, user in enumerate(users):
+        shard = db.shard_for_username(user.username)
+        by_shard.setdefault(shard, []).append((index, user))
+
+    async def shard_import(shard: db.Shard, users: list) -> list[dict]:
+        async with db.session(shard) as db_session:
+            return await import_users(
+                db_session, [user for _, user in users], hasher,
+                chunk_size=chunk_size)
+
+    imports = await asyncio.gather(*(
+        shard_import(shard, shard_users)
+        for shard, shard_users in by_shard.items()))
+    results = [None] * len(users)
+    for shard_users, shard_results in zip(by_shard.values(), imports):
+        for (index, _), result in zip(shard_users, shard_results):
+            results[index] = result
+    return results
+
+
+def _failed(results: list[ImportResult], detail: str) -> list[dict]:
+    """Mark users not processed yet as failed"""
+    for result in results:
+        if result.status == 'pending':
+            result.status = 'failed'
+            result.detail = detail
+    return [asdict(result) for result in results]
@@ -0,0 +1,196 @@
+import asyncio
+import copy
+import logging
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import text
+
+from client_transactions_api import db, models
+from client_transactions_api.config import settings
+from client_transactions_api.models.partitions import add_months
+from client_transactions_api.services.offline import OfflineException
+
+logger = logging.getLogger(__name__)
+
+# Held by the worker taking a snapshot, others skip the run
+ADVISORY_LOCK_KEY = 7_210_047
+
+DAY = timedelta(days=1)
+
+
+def day_start(moment: datetime) -> datetime:
+    """Midnight before a datetime"""
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class BalanceSnapshotJob:
+    """Balance snapshot job class
+
+    Snapshots balances at every midnight (UTC) once `delay` seconds have
+    passed, so that transactions in flight at midnight are committed.
+    The first run snapshots every balance, later runs only the balances
+    with ledger entries since the previous run, each day with one bulk
+    insert. Missed days are caught up in order.
+
+    Every worker runs the job, runs overlapping on Postgres are skipped.
+    A job snapshots the balances of one shard, the first one by default.
+    """
+
+    def __init__(
+        self,
+        interval: int = 300,
+        delay: int = 60,
+        shard: db.Shard | None = None
+    ):
+        """Set job interval and delay in seconds"""
+        self.interval = interval
+        self.delay = delay
+        self.shard = shard or db.shards[0]
+
+    def for_shard(self, shard: db.Shard) -> 'BalanceSnapshotJob':
+        """Same job for another shard"""
+        job = copy.copy(self)
+        job.shard = shard
+        return job
+
+    async def _lock(self, db_session: AsyncSession) -> bool:
+        """Lock snapshots until the transaction ends"""
+        if db_session.bind.dialect.name != 'postgresql':
+            return True
+        result = await db_session.execute(
+            text('SELECT pg_try_advisory_xact_lock(:key)'),
+            {'key': ADVISORY_LOCK_KEY})
+        return result.scalar()
+
+    async def take(
+        self,
+        taken_at: datetime,
+        since: datetime | None
+    ) -> int | None | OfflineException:
+        """Snapshot balances of one day, None if already taken"""
+        async with self.shard.Session() as db_session:
+            if not await self._lock(db_session):
+                return None
+            bounds = await models.BalanceSnapshotRun.bounds(db_session)
+            if type(bounds) is OfflineException:
+                return bounds
+            _, last = bounds
+            if last is not None and last >= taken_at:
+                return None
+
+            users = await models.BalanceSnapshot.take(
+                db_session, taken_at, since)
+            if type(users) is OfflineException:
+                return users
+            db_session.add(models.BalanceSnapshotRun(taken_at, users))
+            await db_session.commit()
+        logger.info(
+            f'Snapshotted {users} balances of shard {self.shard.index} '
+            f'at {taken_at.isoformat()}')
+        return users
+
+    async def snapshot(
+        self,
+        now: datetime | None = None,
+        start: datetime | None = None
+    ) -> list[datetime] | OfflineException:
+        """Take snapshots due as of now by default
+
+        Without previous runs snapshots start at the last midnight, or
+        at `start` to backfill days since then. Returns taken snapshots.
+        """
+        now = now or datetime.utcnow()
+        due = day_start(now - timedelta(seconds=self.delay))
+        async with self.shard.Session() as db_session:
+            bounds = await models.BalanceSnapshotRun.bounds(db_session)
+        if type(bounds) is OfflineException:
+            return bounds
+
+        _, since = bounds
+        if since is None:
+            taken_at = day_start(start) if start is not None else due
+        else:
+            taken_at = since + DAY
+
+        taken = []
+        while taken_at <= due:
+            users = await self.take(taken_at, since)
+            if type(users) is OfflineException:
+                return users
+            if users is None:
+                break
+            taken.append(taken_at)
+            since, taken_at = taken_at, taken_at + DAY
+        return taken
+
+    async def run(self):
+        """Run job with interval, starting right away"""
+        while True:
+            try:
+                await self.snapshot()
+            except Exception as ex:
+                logger.warning(
+                    f'Balance snapshot of shard {self.shard.index} '
+                    f'failed: {ex!r}')
+            await asyncio.sleep(self.interval)
+
+
+async def balance_at(
+    db_session: AsyncSession,
+    user_id: int,
+    at: datetime,
+    currency: str
+) -> dict | OfflineException:
+    """Balance of a user in a currency at a time
+
+    Starts from the balance's last snapshot and adds the ledger entries
+    since the last snapshot run, at most a day of them once snapshots
+    are up to date, however old the account. Runs only snapshot balances
+    that changed, so the balance has no entries between its last
+    snapshot and the last run.
+    """
+
+    bounds = await models.BalanceSnapshotRun.bounds(db_session, before=at)
+    if type(bounds) is OfflineException:
+        return bounds
+    _, last = bounds
+    if last is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='No balance snapshots before the given time')
+
+    snapshot = await models.BalanceSnapshot.latest(
+        db_session, user_id, currency, at)
+    if type(snapshot) is OfflineException:
+        return snapshot
+    value = snapshot.balance if snapshot else 0.0
+
+    # Entries of archived ledger months are gone, their balances are
+    # only known at midnight
+    archived = settings.LEDGER_RETENTION_MONTHS and \
+        at < add_months(datetime.utcnow(), -settings.LEDGER_RETENTION_MONTHS)
+    entries = 0
+    if not archived:
+        total = await models.LedgerEntry.total(
+            db_session, user_id, currency, last, at)
+        if type(total) is OfflineException:
+            return total
+        entries, amount = total
+        value += amount
+
+    return {
+        'user_id': user_id,
+        'value': value,
+        'currency': currency,
+        'at': at,
+        'as_of': last if archived else at,
+        'snapshot_at': last,
+        'entries': entries,
+    }
+
+
+snapshot_job = BalanceSnapshotJob(
+    interval=settings.SNAPSHOT_INTERVAL,
+    delay=settings.SNAPSHOT_DELAY)
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+from typing import AsyncIterator
+
+from client_transactions_api import serializers
+from client_transactions_api.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """Bounded queue of encoded events of one stream"""
+
+    __slots__ = ('user_id', 'currency', 'queue')
+
+    def __init__(self, user_id: int, currency: str, queue_size: int):
+        self.user_id = user_id
+        self.currency = currency
+        # None tells the stream to end
+        self.queue: asyncio.Queue[bytes | None] = asyncio.Queue(queue_size)
+
+
+def encode(event: str, data: dict, id: int | None = None) -> bytes:
+    """Encode a server-sent event"""
+    head = f'id: {id}\nevent: {event}\n' if id is not None \
+        else f'event: {event}\n'
+    return head.encode() + b'data: ' + serializers.dumps(data) + b'\n\n'
+
+
+class BalanceBroker:
+    """In-process pub/sub of balance changes by user id
+
+    Every committed balance write of the worker is published to the
+    streams of its user and currency, encoded once. Streams hold a bounded queue and
+    are ended when it is full, so a slow consumer never holds more than
+    `queue_size` events; clients reconnect and start over from their
+    current balance. Idle streams only cost their queue and a heartbeat
+    timer, no DB queries.
+
+    Balances written by other workers are re-read from the DB when their
+    invalidation arrives, only for users streamed by this worker.
+    """
+
+    def __init__(self, queue_size: int = 16, max_subscribers: int = 10000):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.subscribers: dict[int, set[Subscription]] = {}
+        self.count = 0
+        self.sequence = 0
+        self.published = 0
+        self.dropped = 0
+        self.refreshing: set[int] = set()
+        self.tasks: set[asyncio.Task] = set()
+
+    def __len__(self):
+        return self.count
+
+    def subscribe(
+        self,
+        user_id: int,
+        currency: str
+    ) -> Subscription | None:
+        """Open a subscription to a balance of a user, None if the worker
+        has too many"""
+        if self.count >= self.max_subscribers:
+            return None
+        subscription = Subscription(user_id, currency, self.queue_size)
+        self.subscribers.setdefault(user_id, set()).add(subscription)
+        self.count += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscriptions = self.subscribers.get(subscription.user_id)
+        if subscriptions is None or subscription not in subscriptions:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self.subscribers[subscription.user_id]
+        self.count -= 1
+
+    def _end(self, subscription: Subscription) -> None:
+        self.unsubscribe(subscription)
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
+
+    def _drop(self, subscription: Subscription) -> None:
+        """End a stream whose consumer does not keep up"""
+        self._end(subscription)
+        self.dropped += 1
+        logger.info(f'Dropped slow balance stream of user #{subscription.user_id}')
+
+    def close(self) -> None:
+        """End all streams and refuse new ones, i.e. on shutdown"""
+        self.max_subscribers = 0
+        for subscriptions in list(self.subscribers.values()):
+            for subscription in list(subscriptions):
+                self._end(subscription)
+
+    def publish(self, user_id: int, event: str, data: dict) -> None:
+        """Queue an event for all streams of a user's balance"""
+        subscriptions = [
+            subscription
+            for subscription in self.subscribers.get(user_id, ())
+            if subscription.currency == data['currency']]
+        if not subscriptions:
+            return
+        self.sequence += 1
+        message = encode(event, data, self.sequence)
+        for subscription in subscriptions:
+            if subscription.queue.full():
+                self._drop(subscription)
+            else:
+                subscription.queue.put_nowait(message)
+        self.published += 1
+
+    def publish_balance(self, balance) -> None:
+        """Publish a balance committed to the DB"""
+        if balance.user_id in self.subscribers:
+            self.publish(
+                balance.user_id, 'balance', serializers.balance(balance))
+
+    def refresh(self, user_id: int) -> None:
+        """Re-read and publish a balance written by another worker"""
+        if user_id not in self.subscribers or user_id in self.refreshing:
+            return
+        self.refreshing.add(user_id)
+        task = asyncio.create_task(self._refresh(user_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _refresh(self, user_id: int) -> None:
+        from client_transactions_api import db, models
+        from client_transactions_api.services.offline import OfflineException
+
+        try:
+            async with db.shard_for(user_id).Session() as db_session:
+                balances = await models.Balance.get_all(db_session, user_id)
+            if type(balances) is not OfflineException:
+                for balance in balances:
+                    self.publish_balance(balance)
+        except Exception as ex:
+            logger.warning(f'Balance stream refresh failed: {ex!r}')
+        finally:
+            self.refreshing.discard(user_id)
+
+    async def events(
+        self,
+        subscription: Subscription,
+        first: bytes | None = None,
+        heartbeat: float = 15
+    ) -> AsyncIterator[bytes]:
+        """Server-sent events of a subscription, with heartbeat comments
+
+        Unsubscribes once the stream ends or the client disconnects.
+        """
+        try:
+            # Reconnect after 1s once a stream is dropped
+            yield b'retry: 1000\n\n'
+            if first is not None:
+                yield first
+            while True:
+                try:
+                    message = await asyncio.wait_for(
+                        subscription.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield b': heartbeat\n\n'
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self) -> dict:
+        return {
+            'subscribers': self.count,
+            'users': len(self.subscribers),
+            'max_subscribers': self.max_subscribers,
+            'queue_size': self.queue_size,
+            'published': self.published,
+            'dropped': self.dropped,
+        }
+
+
+balance_broker = BalanceBroker(
+    queue_size=settings.STREAM_QUEUE_SIZE,
+    max_subscribers=settings.STREAM_MAX_SUBSCRIBERS)
@@ -0,0 +1,548 @@
+import asyncio
+import logging
+import uuid
+from collections import defaultdict
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+
+from fastapi import HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from client_transactions_api import db, models, schemas
+from client_transactions_api.config import settings
+from client_transactions_api.services.cache import BalanceCache
+from client_transactions_api.services.locks import UserLocks, user_locks
+from client_transactions_api.services.offline import (OfflineException,
+                                                      OfflineTransactions)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PendingTransaction:
+    sum: float
+    future: asyncio.Future
+    user_id: int | None = None
+    currency: str | None = None
+
+    @property
+    def key(self) -> tuple[int, str]:
+        return self.user_id, self.currency
+
+
+def insufficient_funds(balance: float, sum: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_402_PAYMENT_REQUIRED,
+        detail=f'Not enough funds ({balance:.2f}) for a {sum:.2f} transaction!')
+
+
+class TransactionCoalescer:
+    """Coalesce concurrent transactions of one balance into a single update
+
+    Transactions wait for the user's lock. The task that gets the lock
+    takes every transaction queued for the user's balance in the currency
+    so far, validates them in arrival order and writes the combined
+    balance with one update.
+    Each request still gets its own result: the balance right after its
+    transaction, or a 402 if it was declined.
+    """
+
+    def __init__(self, locks: UserLocks):
+        self.locks = locks
+        self.pending: dict[tuple[int, str], list[PendingTransaction]] = {}
+
+    async def transaction(
+        self,
+        db_session: AsyncSession,
+        user_id: int,
+        sum: float,
+        currency: str
+    ) -> schemas.BalanceOut | OfflineException:
+        """Make a transaction for a user in a currency"""
+
+        future = asyncio.get_running_loop().create_future()
+        transaction = PendingTransaction(sum=sum, future=future)
+        self.pending.setdefault((user_id, currency), []).append(transaction)
+
+        try:
+            async with self.locks.lock(user_id):
+                # Transaction was already applied by a previous lock holder
+                if not future.done():
+                    batch = self.pending.pop((user_id, currency))
+                    await self._apply(db_session, user_id, currency, batch)
+        except asyncio.CancelledError:
+            self._withdraw(user_id, currency, transaction)
+            raise
+
+        return future.result()
+
+    def _withdraw(
+        self,
+        user_id: int,
+        currency: str,
+        transaction: PendingTransaction
+    ) -> None:
+        """Drop a transaction whose request was cancelled, unless a lock
+        holder has taken it already
+
+        The request gets no response, so it must not move money.
+        """
+        queue = self.pending.get((user_id, currency), [])
+        if not any(pending is transaction for pending in queue):
+            return
+        queue.remove(transaction)
+        if not len(queue):
+            del self.pending[(user_id, currency)]
+
+    async def _apply(
+        self,
+        db_session: AsyncSession,
+        user_id: int,
+        currency: str,
+        batch: list[PendingTransaction]
+    ) -> None:
+        try:
+            # Check if there are any Offline transactions to run
+            # Before running online transactions
+            offline = OfflineTransactions.instance()
+            gathered = await offline.gather(db_session, user_id)
+            if type(gathered) is OfflineException:
+                for pending in batch:
+                    pending.future.set_result(gathered)
+                return
+
+            balance = await models.Balance.get_or_create(
+                db_session, user_id=user_id, currency=currency,
+                for_update=True)
+            if type(balance) is OfflineException:
+                for pending in batch:
+                    pending.future.set_result(balance)
+                return
+
+            # Add User's balance to Offline Transactions pool
+            offline.add_balance(
+                user_id, currency, balance.value, balance.held)
+
+            value = balance.value
+            accepted = []
+            for pending in batch:
+                if value + pending.sum < balance.held:
+                    pending.future.set_exception(
+                        insufficient_funds(value - balance.held, pending.sum))
+                    continue
+                value += pending.sum
+                accepted.append((pending, value))
+
+            if not len(accepted):
+                return
+
+            if len(batch) > 1:
+                logger.debug(
+                    f'Coalesced {len(batch)} {currency} transactions '
+                    f'for user #{user_id}')
+
+            result = await models.LedgerEntry.record(
+                db_session, 'transaction', [
+                    {'user_id': user_id, 'currency': currency,
+                     'amount': pending.sum, 'balance': value}
+                    for pending, value in accepted])
+            if type(result) is not OfflineException:
+                result = await balance.update(db_session, value=value)
+            if type(result) is OfflineException:
+                for pending, _ in accepted:
+                    pending.future.set_result(result)
+                return
+
+            offline.add_balance(user_id, currency, value, balance.held)
+            BalanceCache.write(balance)
+            for pending, value in accepted:
+                pending.future.set_result(schemas.BalanceOut(
+                    id=balance.id,
+                    user_id=user_id,
+                    value=value,
+                    currency=currency,
+                    held=balance.held,
+                    created_at=balance.created_at,
+                    updated_at=balance.updated_at))
+        except Exception as ex:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(ex)
+        except asyncio.CancelledError:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(HTTPException(
+                        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        detail='Transaction was interrupted, try again'))
+            raise
+
+
+class BalanceWriteBatcher:
+    """Group commit of balance transactions
+
+    Transactions of all users arriving within `window` seconds, or until
+    `max_size` transactions are queued, are validated and written together
+    in one DB transaction with a multi-row upsert, so the whole batch costs
+    a single commit. Each request awaits the durable result of its own
+    transaction. Batches are split by shard, every shard commits its part.
+    The locks of the batch's users are held while it is written, like
+    any other write of their balances.
+    """
+
+    def __init__(self,
+                 window: float = 0.002,
+                 max_size: int = 256,
+                 locks: UserLocks = user_locks):
+        self.window = window
+        self.max_size = max_size
+        self.locks = locks
+        self.queue: list[PendingTransaction] = []
+        self.timer: asyncio.TimerHandle | None = None
+        self.tasks: set[asyncio.Task] = set()
+        self._flush_locks: dict[int, asyncio.Lock] = {}
+
+    def flush_lock(self, shard: db.Shard) -> asyncio.Lock:
+        # Batches of a shard are flushed one at a time within a worker
+        if shard.index not in self._flush_locks:
+            self._flush_locks[shard.index] = asyncio.Lock()
+        return self._flush_locks[shard.index]
+
+    async def transaction(
+        self,
+        user_id: int,
+        sum: float,
+        currency: str
+    ) -> schemas.BalanceOut | OfflineException:
+        """Queue a transaction for a user in a currency and wait for its
+        result"""
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.append(PendingTransaction(
+            sum=sum, future=future, user_id=user_id, currency=currency))
+
+        if len(self.queue) >= self.max_size:
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self._flush)
+
+        # Shield the result from the request's cancellation,
+        # the batch is written either way
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.queue = self.queue, []
+        by_shard = {}
+        for pending in batch:
+            by_shard.setdefault(
+                db.shard_for(pending.user_id), []).append(pending)
+        for shard, shard_batch in by_shard.items():
+            task = asyncio.create_task(self.flush(shard_batch, shard))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def flush(
+        self,
+        batch: list[PendingTransaction],
+        shard: db.Shard
+    ) -> None:
+        """Write batch of a shard in a single DB transaction"""
+
+        user_ids = sorted({pending.user_id for pending in batch})
+        async with self.flush_lock(shard):
+            try:
+                # In user id order, like transfers, so they never deadlock
+                async with AsyncExitStack() as stack:
+                    for user_id in user_ids:
+                        await stack.enter_async_context(
+                            self.locks.lock(user_id))
+                    async with shard.Session() as db_session:
+                        await self._write(db_session, batch)
+            except Exception as ex:
+                logger.warning(f'Balance batch write failed: {ex!r}')
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(ex)
+
+    async def _write(
+        self,
+        db_session: AsyncSession,
+        batch: list[PendingTransaction]
+    ) -> None:
+        keys = sorted({pending.key for pending in batch})
+
+        # Check if there are any Offline transactions to run
+        # Before running online transactions
+        offline = OfflineTransactions.instance()
+        for user_id in sorted({user_id for user_id, _ in keys}):
+            gathered = await offline.gather(db_session, user_id)
+            if type(gathered) is OfflineException:
+                for pending in batch:
+                    pending.future.set_result(gathered)
+                return
+
+        balances = await models.Balance.get_many_for_update(db_session, keys)
+        if type(balances) is OfflineException:
+            for pending in batch:
+                pending.future.set_result(balances)
+            return
+
+        # Validate transactions in arrival order
+        values = {
+            key: balances[key].value if key in balances else 0.0
+            for key in keys}
+        held = {
+            key: balances[key].held if key in balances else 0.0
+            for key in keys}
+        deltas = defaultdict(float)
+        accepted = []
+        for pending in batch:
+            value = values[pending.key]
+            if value + pending.sum < held[pending.key]:
+                pending.future.set_exception(insufficient_funds(
+                    value - held[pending.key], pending.sum))
+                continue
+            values[pending.key] = value + pending.sum
+            deltas[pending.key] += pending.sum
+            accepted.append((pending, value + pending.sum))
+
+        if not len(accepted):
+            return
+
+        result = await models.Balance.add_many(db_session, deltas)
+        if type(result) is not OfflineException:
+            result = await models.LedgerEntry.record(
+                db_session, 'transaction', [
+                    {'user_id': pending.user_id, 'currency': pending.currency,
+                     'amount': pending.sum, 'balance': value}
+                    for pending, value in accepted])
+        if type(result) is OfflineException:
+            for pending, _ in accepted:
+                pending.future.set_result(result)
+            return
+        balances = await models.Balance.get_many_for_update(
+            db_session, list(deltas))
+        await db_session.commit()
+        logger.debug(
+            f'Wrote {len(accepted)} transactions of {len(deltas)} balances in one batch')
+
+        for (user_id, currency), balance in balances.items():
+            offline.add_balance(
+                user_id, currency, balance.value, balance.held)
+            BalanceCache.write(balance)
+        for pending, value in accepted:
+            balance = balances[pending.key]
+            pending.future.set_result(schemas.BalanceOut(
+                id=balance.id,
+                user_id=balance.user_id,
+                value=value,
+                currency=balance.currency,
+                held=balance.held,
+                created_at=balance.created_at,
+                updated_at=balance.updated_at))
+
+
+async def transfer(
+    db_session: AsyncSession,
+    sender_id: int,
+    recipient_id: int,
+    sum: float,
+    currency: str,
+    locks: UserLocks = user_locks
+) -> schemas.TransferOut | OfflineException:
+    """Move funds from one user to another in a currency
+
+    Users of one shard are debited and credited in one DB transaction.
+    The recipient of another shard is credited once the sender's debit is
+    committed, right away unless their shard is not available, by the
+    credit delivery job then. `db_session` is a session of the sender's
+    shard.
+    """
+
+    transfer_id = uuid.uuid4().hex
+    if db.shard_for(recipient_id) is not db.shard_for(sender_id):
+        return await _transfer_across_shards(
+            db_session, sender_id, recipient_id, sum, currency, transfer_id,
+            locks)
+
+    first, second = sorted((sender_id, recipient_id))
+    # Same order as the row locks, so opposite transfers never deadlock
+    async with locks.lock(first), locks.lock(second):
+        offline = OfflineTransactions.instance()
+        for user_id in (first, second):
+            gathered = await offline.gather(db_session, user_id)
+            if type(gathered) is OfflineException:
+                return gathered
+
+        result = await models.Balance.transfer(
+            db_session, sender_id, recipient_id, sum, transfer_id, currency)
+        if type(result) is OfflineException:
+            return result
+
+        for balance in result:
+            offline.add_balance(
+                balance.user_id, currency, balance.value, balance.held)
+            BalanceCache.write(balance)
+
+    sender, _ = result
+    return transfer_out(transfer_id, sender, recipient_id, sum)
+
+
+async def _transfer_across_shards(
+    db_session: AsyncSession,
+    sender_id: int,
+    recipient_id: int,
+    sum: float,
+    currency: str,
+    transfer_id: str,
+    locks: UserLocks
+) -> schemas.TransferOut | OfflineException:
+    async with locks.lock(sender_id):
+        offline = OfflineTransactions.instance()
+        gathered = await offline.gather(db_session, sender_id)
+        if type(gathered) is OfflineException:
+            return gathered
+
+        sender = await models.Balance.send(
+            db_session, sender_id, recipient_id, sum, transfer_id, currency)
+        if type(sender) is OfflineException:
+            return sender
+
+        offline.add_balance(sender_id, currency, sender.value, sender.held)
+        BalanceCache.write(sender)
+
+    # The transfer is committed, a credit not delivered now is retried
+    try:
+        await credit_delivery.deliver(
+            db.shard_for(sender_id), transfer_ids=[transfer_id])
+    except Exception as ex:
+        logger.warning(f'Credit of transfer {transfer_id} failed: {ex!r}')
+    return transfer_out(transfer_id, sender, recipient_id, sum)
+
+
+def transfer_out(
+    transfer_id: str,
+    sender: models.Balance,
+    recipient_id: int,
+    sum: float
+) -> schemas.TransferOut:
+    return schemas.TransferOut(
+        transfer_id=transfer_id,
+        sender_id=sender.user_id,
+        recipient_id=recipient_id,
+        value=sum,
+        currency=sender.currency,
+        balance=sender.value,
+        created_at=sender.updated_at)
+
+
+class TransferCreditDelivery:
+    """Transfer credit delivery class
+
+    Credits the recipients of transfers across shards on their own
+    shard. Credits are claimed on the sender's shard in batches of
+    `batch_size`, oldest first, and deleted once delivered. A claim
+    pushes its credits back with exponential backoff, up to `max_delay`
+    seconds, so credits that were not delivered are retried, and workers
+    do not deliver the same credits at once. A credit delivered twice
+    anyway is only credited once, see `Balance.receive`.
+    """
+
+    def __init__(self,
+                 interval: float = 1,
+                 batch_size: int = 100,
+                 max_delay: float = 60,
+                 locks: UserLocks = user_locks):
+        """Set delivery interval in seconds"""
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.locks = locks
+
+    async def deliver(
+        self,
+        shard: db.Shard,
+        transfer_ids: list[str] | None = None
+    ) -> int | OfflineException:
+        """Deliver one batch of credits due on a shard, all of them or
+        those of `transfer_ids`, return number of delivered credits"""
+
+        async with shard.Session() as db_session:
+            credits = await models.TransferCredit.claim(
+                db_session, self.batch_size, self.interval, self.max_delay,
+                transfer_ids)
+        if type(credits) is OfflineException:
+            return credits
+
+        delivered = []
+        for credit in credits:
+            try:
+                result = await self.credit(credit)
+            except Exception as ex:
+                logger.warning(
+                    f'Credit of transfer {credit.transfer_id} failed: {ex!r}')
+                continue
+            if type(result) is not OfflineException:
+                delivered.append(credit.transfer_id)
+
+        if delivered:
+            async with shard.Session() as db_session:
+                # Credits left behind are delivered again, and skipped
+                await models.TransferCredit.delivered(db_session, delivered)
+        return len(delivered)
+
+    async def credit(
+        self,
+        credit: models.TransferCredit
+    ) -> models.Balance | None | OfflineException:
+        """Credit the recipient of a transfer on their shard"""
+
+        user_id, currency = credit.recipient_id, credit.currency
+        async with self.locks.lock(user_id), \
+                db.shard_for(user_id).Session() as db_session:
+            offline = OfflineTransactions.instance()
+            gathered = await offline.gather(db_session, user_id)
+            if type(gathered) is OfflineException:
+                return gathered
+
+            balance = await models.Balance.receive(
+                db_session, user_id, credit.amount, credit.transfer_id,
+                currency)
+            if balance is not None and type(balance) is not OfflineException:
+                offline.add_balance(
+                    user_id, currency, balance.value, balance.held)
+                BalanceCache.write(balance)
+            return balance
+
+    async def run(self):
+        """Run delivery on every shard, with interval while no credits
+        are left"""
+        while True:
+            delivered = 0
+            for shard in db.shards:
+                try:
+                    result = await self.deliver(shard)
+                except Exception as ex:
+                    logger.warning(
+                        f'Transfer credit delivery of shard {shard.index} '
+                        f'failed: {ex!r}')
+                    continue
+                if type(result) is not OfflineException:
+                    delivered = max(delivered, result)
+            if delivered < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+
+coalescer = TransactionCoalescer(user_locks)
+
+batcher = BalanceWriteBatcher(
+    window=settings.BATCH_WINDOW_MS / 1000,
+    max_size=settings.BATCH_MAX_SIZE)
+
+credit_delivery = TransferCreditDelivery(
+    interval=settings.TRANSFER_CREDIT_INTERVAL,
+    batch_size=settings.TRANSFER_CREDIT_BATCH_SIZE,
+    max_delay=settings.TRANSFER_CREDIT_MAX_DELAY)
@@ -13,8 +13,9 @@ async def create_superuser(
     Create a super user in database
     """
 
-    async with db.Session() as db_session:
-        user = await models.User.get(db_session, raise_404=False)
+    async with db.shard_for_username(username).Session() as db_session:
+        user = await models.User.get(
+            db_session, raise_404=False, username=username)
 
         if not user:
             hashed_password = auth_service.hash_password(password)
@@ -0,0 +1,24 @@
+"""uvicorn server of the serve command
+
+Kept out of `server`, which the app imports for its profile: uvicorn is
+only imported by the serving process.
+"""
+
+import signal
+from types import FrameType
+
+import uvicorn
+
+
+class Server(uvicorn.Server):
+    """uvicorn server that ends balance streams on exit
+
+    uvicorn waits for open connections to close before it shuts down,
+    balance streams would keep it waiting until their clients leave.
+    """
+
+    def handle_exit(self, sig: signal.Signals, frame: FrameType | None) -> None:
+        from client_transactions_api.services.stream import balance_broker
+
+        balance_broker.close()
+        super().handle_exit(sig, frame)
@@ -11,4 +11,9 @@ echo "Port $API_PORT \e[0m"
 echo "Host $API_HOST \e[0m"
 echo "API Path: $API_PATH \e[0m"
 
-$WORKDIR/.venv/bin/python -m uvicorn --host 0.0.0.0 --port "${API_PORT:-8000}" client_transactions_api.main:app
\ No newline at end of file
+# Apply database migrations once, before any worker starts
+$WORKDIR/.venv/bin/python -m client_transactions_api migrate || exit 1
+$WORKDIR/.venv/bin/python -m client_transactions_api create-superuser || exit 1
+
+# Workers, event loop, keep-alive and compression come from SERVER_PROFILE
+SERVER_PROFILE=${SERVER_PROFILE:-production} exec $WORKDIR/.venv/bin/python -m client_transactions_api serve
\ No newline at end of file
@@ -0,0 +1,119 @@
+"""Outage scenarios of `benchmarks.chaos`
+
+Credits and debits run before, during and after a DB outage, then every
+user's offline transactions are reconciled and the balances are checked
+against all acknowledged transactions. Refused connections run on any
+database with `db_down`, dropped and stalled connections go through the
+chaos proxy in front of Postgres.
+"""
+
+import asyncio
+import random
+import time
+
+import pytest
+
+from benchmarks import chaos
+
+pytestmark = pytest.mark.anyio
+
+FUNDS = 100.0
+
+
+@pytest.fixture
+def load(client, api):
+    async def load(run: chaos.Run, phase: str, users: list[dict],
+                   requests: int = 20, timeout: float | None = None,
+                   seed: int = 0) -> None:
+        """Send concurrent credits and debits of random users, the outcome
+        of requests over timeout is unknown"""
+        choices = random.Random(seed)
+
+        async def transaction(user: dict, value: float) -> None:
+            request = client.post(
+                f'{api}/balances',
+                json={'user_id': user['id'], 'value': value},
+                headers=user['headers'])
+            try:
+                response = await asyncio.wait_for(request, timeout)
+            except asyncio.TimeoutError:
+                response = None
+            run.outcomes.append(chaos.Outcome(
+                time=time.perf_counter(),
+                user_id=user['id'],
+                value=value,
+                kind=chaos.classify(response)))
+
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            transaction(choices.choice(users), choices.choice((10.0, -5.0)))
+            for _ in range(requests)])
+        run.phases[phase] = (start, time.perf_counter())
+    return load
+
+
+def kinds(run: chaos.Run, phase: str) -> set[str]:
+    return {outcome.kind for outcome in run.in_phase(phase)}
+
+
+async def test_refused_connections(bench, create_user, load, db_down):
+    users = [await create_user(funds=FUNDS) for _ in range(4)]
+    run = chaos.Run()
+
+    await load(run, 'online', users)
+    with db_down():
+        await load(run, 'outage', users, seed=1)
+    await load(run, 'recovery', users, seed=2)
+
+    # Detected at once, acknowledged offline and online again after
+    assert kinds(run, 'online') == {'online'}
+    assert kinds(run, 'outage') == {'offline'}
+    assert kinds(run, 'recovery') == {'online'}
+
+    await chaos.reconcile(bench, timeout=10, users=users)
+    correctness = await chaos.check_balances(run, FUNDS)
+    assert correctness['correct'], correctness['mismatches']
+
+
+@pytest.fixture
+async def proxy():
+    """Chaos proxy in front of the test database, the app connects
+    through it for the duration of the test"""
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    from client_transactions_api import db
+
+    if db.engine.dialect.name != 'postgresql':
+        pytest.skip('The chaos proxy needs Postgres')
+
+    url = db.engine.url.render_as_string(hide_password=False)
+    _, host, port = chaos.proxied_uri(url, 0)
+    proxy = chaos.ChaosProxy(host, port)
+    await proxy.start()
+    engine = create_async_engine(
+        chaos.proxied_uri(url, proxy.port)[0], pool_pre_ping=True)
+    db.Session.configure(bind=engine)
+    try:
+        yield proxy
+    finally:
+        db.Session.configure(bind=db.engine)
+        await proxy.stop()
+        await engine.dispose()
+
+
+@pytest.mark.parametrize('fault', ['drop', 'stall'])
+async def test_faulty_connections(bench, create_user, load, proxy, fault):
+    users = [await create_user(funds=FUNDS) for _ in range(4)]
+    run = chaos.Run()
+
+    await load(run, 'online', users)
+    await proxy.fault(fault)
+    await load(run, 'outage', users, timeout=2, seed=1)
+    await proxy.restore()
+    await load(run, 'recovery', users, seed=2)
+
+    assert kinds(run, 'recovery') == {'online'}
+
+    await chaos.reconcile(bench, timeout=10, users=users)
+    correctness = await chaos.check_balances(run, FUNDS)
+    assert correctness['correct'], correctness['mismatches']
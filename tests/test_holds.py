@@ -0,0 +1,202 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def holds(client, api):
+    class Holds:
+        def place(self, user: dict, value: float, **fields):
+            return client.post(
+                f'{api}/balances/holds', json={'value': value, **fields},
+                headers=user['headers'])
+
+        def capture(self, user: dict, hold_id: int, value: float = None):
+            return client.post(
+                f'{api}/balances/holds/{hold_id}/capture',
+                json={'value': value} if value else None,
+                headers=user['headers'])
+
+        def void(self, user: dict, hold_id: int):
+            return client.post(
+                f'{api}/balances/holds/{hold_id}/void',
+                headers=user['headers'])
+
+        def get(self, user: dict, hold_id: int):
+            return client.get(
+                f'{api}/balances/holds/{hold_id}', headers=user['headers'])
+    return Holds()
+
+
+async def expire(user_id: int) -> None:
+    """Move the expiry of the user's open holds to the past"""
+    from sqlalchemy import update
+
+    from client_transactions_api import db, models
+
+    async with db.Session() as db_session:
+        await db_session.execute(
+            update(models.Hold)
+            .where(models.Hold.user_id == user_id,
+                   models.Hold.status == 'held')
+            .values(expires_at=datetime.utcnow() - timedelta(seconds=1)))
+        await db_session.commit()
+
+
+async def test_hold_reserves_funds(client, api, holds, create_user, balance,
+                                   ledger):
+    user = await create_user(funds=100)
+
+    response = await holds.place(user, 60.0)
+    assert response.status_code == 201
+    assert response.json()['status'] == 'held'
+    assert await balance(user['id']) == (100.0, 60.0)
+
+    # Only the available 40 can be spent
+    assert (await holds.place(user, 50.0)).status_code == 402
+    response = await client.post(
+        f'{api}/balances', json={'user_id': user['id'], 'value': -50.0},
+        headers=user['headers'])
+    assert response.status_code == 402
+    other = await create_user()
+    response = await client.post(
+        f'{api}/balances/transfer',
+        json={'recipient_id': other['id'], 'value': 50.0},
+        headers=user['headers'])
+    assert response.status_code == 402
+
+    response = await client.get(f'{api}/balances/my', headers=user['headers'])
+    assert response.json()['held'] == 60.0
+    assert await balance(user['id']) == (100.0, 60.0)
+    assert await ledger(user['id']) == [(100.0, 100.0, None)]
+
+
+async def test_invalid_hold(holds, create_user):
+    user = await create_user(funds=100)
+
+    assert (await holds.place(user, -5.0)).status_code == 422
+    assert (await holds.place(user, 5.0, currency='GBP')).status_code == 422
+    assert (await holds.place(user, 5.0, ttl=10**9)).status_code == 422
+    # No EUR to hold
+    assert (await holds.place(user, 5.0, currency='EUR')).status_code == 402
+
+
+async def test_capture(holds, create_user, balance, ledger):
+    user = await create_user(funds=100)
+    hold = (await holds.place(user, 60.0)).json()
+
+    assert (await holds.capture(user, hold['id'], 70.0)).status_code == 422
+
+    response = await holds.capture(user, hold['id'], 40.0)
+    assert response.status_code == 200
+    assert response.json()['status'] == 'captured'
+    assert response.json()['captured'] == 40.0
+    # The rest of the hold is released
+    assert await balance(user['id']) == (60.0, 0.0)
+    assert await ledger(user['id']) == [(100.0, 100.0, None),
+                                        (-40.0, 60.0, None)]
+
+    assert (await holds.capture(user, hold['id'])).status_code == 409
+    assert (await holds.void(user, hold['id'])).status_code == 409
+    assert await balance(user['id']) == (60.0, 0.0)
+
+
+async def test_capture_all(holds, create_user, balance, ledger):
+    user = await create_user(funds=100)
+    hold = (await holds.place(user, 25.0)).json()
+
+    response = await holds.capture(user, hold['id'])
+    assert response.json()['captured'] == 25.0
+    assert await balance(user['id']) == (75.0, 0.0)
+    assert (await ledger(user['id']))[-1] == (-25.0, 75.0, None)
+
+
+async def test_void(holds, create_user, balance, ledger):
+    user = await create_user(funds=100)
+    other = await create_user(funds=100)
+    hold = (await holds.place(user, 60.0)).json()
+
+    # Holds of other users are not found
+    assert (await holds.get(other, hold['id'])).status_code == 404
+    assert (await holds.void(other, hold['id'])).status_code == 404
+    assert (await holds.void(user, 999999)).status_code == 404
+
+    response = await holds.void(user, hold['id'])
+    assert response.status_code == 200
+    assert response.json()['status'] == 'voided'
+    assert (await holds.get(user, hold['id'])).json()['status'] == 'voided'
+    assert (await holds.capture(user, hold['id'])).status_code == 409
+    assert await balance(user['id']) == (100.0, 0.0)
+    assert await ledger(user['id']) == [(100.0, 100.0, None)]
+
+
+async def test_concurrent_holds(holds, create_user, balance):
+    user = await create_user(funds=100)
+
+    responses = await asyncio.gather(*[
+        holds.place(user, 30.0) for _ in range(10)])
+
+    codes = sorted(response.status_code for response in responses)
+    assert codes == [201] * 3 + [402] * 7
+    assert await balance(user['id']) == (100.0, 90.0)
+
+
+async def test_capture_void_race(holds, create_user, balance, ledger):
+    user = await create_user(funds=100)
+    hold = (await holds.place(user, 30.0)).json()
+
+    captured, voided = await asyncio.gather(
+        holds.capture(user, hold['id']), holds.void(user, hold['id']))
+
+    assert sorted([captured.status_code, voided.status_code]) == [200, 409]
+    if captured.status_code == 200:
+        assert await balance(user['id']) == (70.0, 0.0)
+        assert len(await ledger(user['id'])) == 2
+    else:
+        assert await balance(user['id']) == (100.0, 0.0)
+        assert len(await ledger(user['id'])) == 1
+
+
+async def test_expired_holds_released(holds, create_user, balance, ledger):
+    from client_transactions_api.services.holds import HoldSweeper
+
+    user = await create_user(funds=100)
+    placed = [(await holds.place(user, 10.0)).json() for _ in range(3)]
+    await expire(user['id'])
+    kept = (await holds.place(user, 5.0)).json()
+
+    assert (await holds.capture(user, placed[0]['id'])).status_code == 409
+
+    # One hold per batch
+    assert await HoldSweeper(batch_size=1).sweep() >= 3
+    for hold in placed:
+        response = await holds.get(user, hold['id'])
+        assert response.json()['status'] == 'expired'
+    assert (await holds.get(user, kept['id'])).json()['status'] == 'held'
+    assert await balance(user['id']) == (100.0, 5.0)
+    assert await ledger(user['id']) == [(100.0, 100.0, None)]
+
+
+async def test_holds_offline(client, api, holds, create_user, balance,
+                             db_down):
+    user = await create_user(funds=100)
+    hold = (await holds.place(user, 60.0)).json()
+
+    with db_down():
+        assert (await holds.place(user, 1.0)).status_code == 503
+        assert (await holds.void(user, hold['id'])).status_code == 503
+        # Funds held when the DB went down stay reserved
+        response = await client.post(
+            f'{api}/balances', json={'user_id': user['id'], 'value': -50.0},
+            headers=user['headers'])
+        assert response.status_code == 402
+        response = await client.post(
+            f'{api}/balances', json={'user_id': user['id'], 'value': -30.0},
+            headers=user['headers'])
+        assert response.status_code == 202
+
+    assert (await holds.void(user, hold['id'])).status_code == 200
+    assert await balance(user['id']) == (70.0, 0.0)
@@ -0,0 +1,160 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def debit(client, api, user: dict, value: float, key: str):
+    return client.post(
+        f'{api}/balances', json={'user_id': user['id'], 'value': value},
+        headers={**user['headers'], 'Idempotency-Key': key})
+
+
+async def stored_key(user_id: int, key: str):
+    from sqlalchemy import select
+
+    from client_transactions_api import db, models
+
+    async with db.Session() as db_session:
+        result = await db_session.execute(
+            select(models.IdempotencyKey).where(
+                models.IdempotencyKey.user_id == user_id,
+                models.IdempotencyKey.key == key))
+        return result.scalars().first()
+
+
+async def test_replay(client, api, create_user, balance, ledger):
+    from client_transactions_api.services.idempotency import IdempotencyStore
+
+    user = await create_user(funds=100)
+
+    first = await debit(client, api, user, -10.0, 'replay')
+    assert first.status_code == 201
+    assert 'Idempotent-Replayed' not in first.headers
+
+    replayed = await debit(client, api, user, -10.0, 'replay')
+    assert replayed.status_code == 201
+    assert replayed.headers['Idempotent-Replayed'] == 'true'
+    assert replayed.json() == first.json()
+
+    # Stored in the DB with the balance change, for other workers
+    IdempotencyStore.instance().results.clear()
+    replayed = await debit(client, api, user, -10.0, 'replay')
+    assert replayed.status_code == 201
+    assert replayed.json() == first.json()
+
+    stored = await stored_key(user['id'], 'replay')
+    assert stored.status_code == 201
+    assert stored.response == first.text
+    assert await balance(user['id']) == (90.0, 0.0)
+    assert await ledger(user['id']) == [(100.0, 100.0, None),
+                                        (-10.0, 90.0, None)]
+
+
+async def test_failed_commit_leaves_key_free(client, api, create_user,
+                                             balance, ledger, monkeypatch):
+    from fastapi import HTTPException
+
+    from client_transactions_api import models
+
+    user = await create_user(funds=100)
+
+    async def update(*args, **kwargs):
+        raise HTTPException(status_code=422, detail='Commit failed')
+
+    # Storing the response fails, the balance change is rolled back with it
+    monkeypatch.setattr(models.IdempotencyKey, 'update', update)
+    response = await debit(client, api, user, -10.0, 'failed')
+    assert response.status_code == 422
+    monkeypatch.undo()
+    assert await balance(user['id']) == (100.0, 0.0)
+
+    response = await debit(client, api, user, -10.0, 'failed')
+    assert response.status_code == 201
+    assert await balance(user['id']) == (90.0, 0.0)
+    assert await ledger(user['id']) == [(100.0, 100.0, None),
+                                        (-10.0, 90.0, None)]
+
+
+async def test_key_reused_for_other_request(client, api, create_user,
+                                            balance):
+    user = await create_user(funds=100)
+
+    assert (await debit(client, api, user, -10.0, 'reused')).status_code \
+        == 201
+    response = await debit(client, api, user, -20.0, 'reused')
+    assert response.status_code == 422
+    assert await balance(user['id']) == (90.0, 0.0)
+
+
+async def test_key_in_flight(client, api, create_user, balance):
+    from client_transactions_api import db, models
+    from client_transactions_api.services.idempotency import fingerprint
+
+    user = await create_user(funds=100)
+    # Reserved by a request of another worker still being processed
+    async with db.Session() as db_session:
+        db_session.add(models.IdempotencyKey(
+            user_id=user['id'], key='in-flight',
+            fingerprint=fingerprint(
+                {'user_id': user['id'], 'value': -10.0, 'currency': 'USD'}),
+            ttl=60))
+        await db_session.commit()
+
+    response = await debit(client, api, user, -10.0, 'in-flight')
+    assert response.status_code == 409
+    assert await balance(user['id']) == (100.0, 0.0)
+
+
+async def test_declined_request_is_not_stored(client, api, create_user,
+                                              balance, ledger):
+    user = await create_user(funds=10)
+
+    response = await debit(client, api, user, -50.0, 'declined')
+    assert response.status_code == 402
+    assert await stored_key(user['id'], 'declined') is None
+
+    # The key is free for a retry once funds are there
+    await client.post(
+        f'{api}/balances', json={'user_id': user['id'], 'value': 40.0},
+        headers=user['headers'])
+    response = await debit(client, api, user, -50.0, 'declined')
+    assert response.status_code == 201
+    assert await balance(user['id']) == (0.0, 0.0)
+    assert [amount for amount, _, _ in await ledger(user['id'])] == \
+        [10.0, 40.0, -50.0]
+
+
+async def test_offline_replay(client, api, create_user, balance, db_down):
+    from client_transactions_api import db, models
+    from client_transactions_api.services.idempotency import IdempotencyStore
+
+    user = await create_user(funds=100)
+
+    with db_down():
+        accepted = await debit(client, api, user, -10.0, 'offline')
+        assert accepted.status_code == 202
+        replayed = await debit(client, api, user, -10.0, 'offline')
+        assert replayed.status_code == 202
+        assert replayed.json() == accepted.json()
+
+    # Persisted by another worker that replayed the same request
+    async with db.Session() as db_session:
+        db_session.add(models.IdempotencyKey(
+            user_id=user['id'], key='offline',
+            fingerprint=IdempotencyStore.instance().results[
+                (user['id'], 'offline')].fingerprint,
+            ttl=60, status_code=202, response=accepted.text))
+        await db_session.commit()
+
+    # Synced by the next request of the user
+    response = await client.get(
+        f'{api}/balances/my', headers=user['headers'])
+    assert response.json()['value'] == 90.0
+    assert await balance(user['id']) == (90.0, 0.0)
+    assert IdempotencyStore.instance().results[
+        (user['id'], 'offline')].persisted
+
+    response = await debit(client, api, user, -10.0, 'offline')
+    assert response.status_code == 202
+    assert response.json() == accepted.json()
+    assert await balance(user['id']) == (90.0, 0.0)
@@ -0,0 +1,49 @@
+from datetime import datetime
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def partition_of(entry_id: int) -> str:
+    from sqlalchemy.sql import text
+
+    from client_transactions_api import db
+
+    async with db.Session() as db_session:
+        result = await db_session.execute(
+            text('SELECT CAST(CAST(tableoid AS regclass) AS text) '
+                 'FROM ledger_entries WHERE id = :id'), {'id': entry_id})
+        return result.scalar()
+
+
+async def test_entries_past_last_partition(create_user, ledger):
+    """Entries of a month without a partition, i.e. while the ledger
+    maintenance job is disabled as in these tests"""
+    from sqlalchemy import func, select
+
+    from client_transactions_api import db, models
+    from client_transactions_api.models.partitions import add_months
+    from client_transactions_api.services.ledger import LedgerMaintenance
+
+    if db.engine.dialect.name != 'postgresql':
+        pytest.skip('Ledger partitions need Postgres')
+
+    user = await create_user()
+    later = add_months(datetime.utcnow(), 12)
+    async with db.Session() as db_session:
+        await models.LedgerEntry.add_many(db_session, [
+            {'user_id': user['id'], 'currency': 'USD', 'amount': 5.0,
+             'balance': 5.0, 'created_at': later}])
+        await db_session.commit()
+        entry_id = (await db_session.execute(
+            select(func.max(models.LedgerEntry.id)))).scalar()
+    assert await partition_of(entry_id) == 'ledger_entries_default'
+
+    created = await LedgerMaintenance(months_ahead=12).create_partitions(
+        datetime.utcnow())
+    name = models.LedgerEntry.partition_name(later)
+    assert name in created
+    # Moved into the partition of its month
+    assert await partition_of(entry_id) == name
+    assert await ledger(user['id']) == [(5.0, 5.0, None)]
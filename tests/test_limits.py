@@ -0,0 +1,55 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def scope(client: str, forwarded_for: str | None = None) -> dict:
+    headers = []
+    if forwarded_for is not None:
+        headers.append((b'x-forwarded-for', forwarded_for.encode()))
+    return {'type': 'http', 'client': (client, 123), 'headers': headers}
+
+
+def test_client_address_behind_trusted_proxy(monkeypatch):
+    from client_transactions_api.services import limits
+
+    monkeypatch.setattr(limits, 'proxies', {'10.0.0.1', '10.0.0.2'})
+
+    assert limits.client_address(
+        scope('10.0.0.1', '203.0.113.7, 10.0.0.2')) == '203.0.113.7'
+    # Spoofed addresses in front of the client's are ignored
+    assert limits.client_address(
+        scope('10.0.0.1', '1.2.3.4, 203.0.113.7')) == '203.0.113.7'
+    # Untrusted peers are keyed by their own address
+    assert limits.client_address(
+        scope('198.51.100.1', '203.0.113.7')) == '198.51.100.1'
+    assert limits.client_address(scope('10.0.0.1')) == '10.0.0.1'
+
+
+def test_client_address_without_trusted_proxies(monkeypatch):
+    from client_transactions_api.services import limits
+
+    monkeypatch.setattr(limits, 'proxies', set())
+
+    assert limits.client_address(
+        scope('10.0.0.1', '203.0.113.7')) == '10.0.0.1'
+
+
+async def test_token_decoded_once(client, api, create_user, monkeypatch):
+    from client_transactions_api.services import limits
+
+    monkeypatch.setattr(limits.transaction_limiter, 'rate', 1000)
+    user = await create_user(funds=100)
+
+    decode = limits.jwt.decode
+    calls = []
+
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return decode(*args, **kwargs)
+
+    monkeypatch.setattr(limits.jwt, 'decode', counted)
+    response = await client.post(
+        f'{api}/balances', json={'value': -10.0}, headers=user['headers'])
+    assert response.status_code == 201
+    assert len(calls) == 1
@@ -0,0 +1,159 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_offline_transactions_reconciled(client, api, create_user,
+                                               balance, ledger, db_down):
+    user = await create_user(funds=100)
+
+    with db_down():
+        accepted = []
+        for value in (-30.0, -20.0):
+            response = await client.post(
+                f'{api}/balances',
+                json={'user_id': user['id'], 'value': value},
+                headers=user['headers'])
+            assert response.status_code == 202
+            accepted.append(response.json())
+        assert [body['balance'] for body in accepted] == [70.0, 50.0]
+
+        # Declined against the offline balance
+        response = await client.post(
+            f'{api}/balances', json={'user_id': user['id'], 'value': -60.0},
+            headers=user['headers'])
+        assert response.status_code == 402
+
+        response = await client.get(
+            f'{api}/balances/offline/{accepted[0]["tracking_id"]}',
+            headers=user['headers'])
+        assert response.json()['status'] == 'pending'
+        assert response.json()['reconciled_at'] is None
+
+    # Nothing is written before the DB is back
+    assert await balance(user['id']) == (100.0, 0.0)
+
+    # Synced by the next request of the user, as one ledger entry
+    response = await client.post(
+        f'{api}/balances', json={'user_id': user['id'], 'value': -5.0},
+        headers=user['headers'])
+    assert response.status_code == 201
+    assert response.json()['value'] == 45.0
+    assert await balance(user['id']) == (45.0, 0.0)
+    assert await ledger(user['id']) == [(100.0, 100.0, None),
+                                        (-50.0, 50.0, None),
+                                        (-5.0, 45.0, None)]
+
+    for body in accepted:
+        response = await client.get(
+            f'{api}/balances/offline/{body["tracking_id"]}',
+            headers=user['headers'])
+        assert response.json()['status'] == 'reconciled'
+        assert response.json()['reconciled_at'] is not None
+
+
+async def test_offline_user_unavailable(client, api, create_user, db_down):
+    from client_transactions_api.services.offline import OfflineTransactions
+
+    user = await create_user(funds=100)
+    # Balance never seen by this worker
+    del OfflineTransactions.instance().users[user['id']]
+
+    with db_down():
+        response = await client.post(
+            f'{api}/balances', json={'user_id': user['id'], 'value': -10.0},
+            headers=user['headers'])
+    assert response.status_code == 206
+
+
+async def test_offline_status_of_other_user(client, api, create_user,
+                                            db_down):
+    user = await create_user(funds=100)
+    other = await create_user()
+
+    with db_down():
+        response = await client.post(
+            f'{api}/balances', json={'user_id': user['id'], 'value': -10.0},
+            headers=user['headers'])
+    tracking_id = response.json()['tracking_id']
+
+    response = await client.get(
+        f'{api}/balances/offline/{tracking_id}', headers=other['headers'])
+    assert response.status_code == 404
+
+
+async def test_offline_sync_with_batched_writes(client, api, create_user,
+                                                balance, ledger, db_down,
+                                                monkeypatch):
+    import asyncio
+
+    from client_transactions_api.config import settings
+
+    user = await create_user(funds=100)
+    with db_down():
+        response = await client.post(
+            f'{api}/balances', json={'user_id': user['id'], 'value': -30.0},
+            headers=user['headers'])
+        assert response.status_code == 202
+
+    # Batched and idempotent requests of the user sync it at once
+    monkeypatch.setattr(settings, 'BATCH_WRITES', True)
+    responses = await asyncio.gather(*[
+        client.post(
+            f'{api}/balances', json={'user_id': user['id'], 'value': -1.0},
+            headers={**user['headers'], **headers})
+        for index in range(3)
+        for headers in ({}, {'Idempotency-Key': f'synced-{index}'})])
+
+    assert [response.status_code for response in responses] == [201] * 6
+    assert await balance(user['id']) == (64.0, 0.0)
+    legs = await ledger(user['id'])
+    # Offline transactions are synced once
+    assert [amount for amount, _, _ in legs].count(-30.0) == 1
+    assert sum(amount for amount, _, _ in legs) == 64.0
+
+
+async def test_offline_tracking_capacity(client, api, create_user, balance,
+                                         db_down, monkeypatch):
+    from collections import OrderedDict, deque
+
+    from client_transactions_api.services.offline import OfflineTransactions
+
+    monkeypatch.setattr(OfflineTransactions, 'tracked', OrderedDict())
+    monkeypatch.setattr(OfflineTransactions, 'tracked_pending', {})
+    monkeypatch.setattr(OfflineTransactions, 'reconciled', deque())
+    monkeypatch.setattr(OfflineTransactions, 'max_tracked', 3)
+    user = await create_user(funds=100)
+    other = await create_user(funds=100)
+
+    async def post(user: dict, value: float = -1.0):
+        return await client.post(
+            f'{api}/balances', json={'value': value},
+            headers=user['headers'])
+
+    async def status(tracking_id: str, user: dict) -> int:
+        response = await client.get(
+            f'{api}/balances/offline/{tracking_id}', headers=user['headers'])
+        return response.status_code
+
+    with db_down():
+        pending = (await post(other)).json()['tracking_id']
+        reconciled = [(await post(user)).json()['tracking_id']
+                      for _ in range(2)]
+    assert (await post(user, 0)).status_code == 201
+
+    # Reconciled transactions are forgotten, even behind a pending one
+    with db_down():
+        for index in range(2):
+            response = await post(user)
+            assert response.status_code == 202
+            assert await status(reconciled[index], user) == 404
+        assert await status(pending, other) == 200
+
+        # Then only pending transactions are tracked
+        response = await post(user)
+        assert response.status_code == 503
+        assert len(OfflineTransactions.tracked) == 3
+
+    assert (await post(user, 0)).status_code == 201
+    assert await balance(user['id']) == (96.0, 0.0)
@@ -0,0 +1,28 @@
+import os
+import socket
+
+from benchmarks import startup
+
+# Generous compared to the CI gates in the README, tests share the machine
+MAX_IMPORT = 3
+MAX_FIRST_RESPONSE = 6
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_startup_within_budget(monkeypatch, tmp_path, capsys):
+    # Serving workers skip migrations, and must not wipe the tests' database
+    monkeypatch.setenv('TESTING', 'False')
+    monkeypatch.setenv(
+        'DATABASE_URI',
+        'sqlite+aiosqlite:///' + os.path.join(tmp_path, 'startup.db'))
+
+    code = startup.main([
+        '--runs', '1', '--port', str(free_port()),
+        '--max-import', str(MAX_IMPORT),
+        '--max-first-response', str(MAX_FIRST_RESPONSE)])
+    assert code == 0, capsys.readouterr().out
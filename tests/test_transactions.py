@@ -0,0 +1,161 @@
+import asyncio
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_transaction(client, api, create_user, balance, ledger):
+    user = await create_user(funds=100)
+
+    response = await client.post(
+        f'{api}/balances', json={'user_id': user['id'], 'value': -30.0},
+        headers=user['headers'])
+    assert response.status_code == 201
+    assert response.json()['value'] == 70.0
+
+    response = await client.post(
+        f'{api}/balances', json={'user_id': user['id'], 'value': -80.0},
+        headers=user['headers'])
+    assert response.status_code == 402
+
+    assert await balance(user['id']) == (70.0, 0.0)
+    assert await ledger(user['id']) == [(100.0, 100.0, None),
+                                        (-30.0, 70.0, None)]
+
+
+async def test_concurrent_transactions(client, api, create_user, balance,
+                                       ledger):
+    from client_transactions_api.services.locks import user_locks
+
+    user = await create_user(funds=100)
+
+    responses = await asyncio.gather(*[
+        client.post(
+            f'{api}/balances', json={'user_id': user['id'], 'value': -15.0},
+            headers=user['headers'])
+        for _ in range(10)])
+
+    codes = sorted(response.status_code for response in responses)
+    assert codes == [201] * 6 + [402] * 4
+    assert sorted(response.json()['value'] for response in responses
+                  if response.status_code == 201) == [10, 25, 40, 55, 70, 85]
+    assert await balance(user['id']) == (10.0, 0.0)
+    # One leg per accepted transaction, each with the balance right after it
+    assert await ledger(user['id']) == [(100.0, 100.0, None)] + [
+        (-15.0, value, None) for value in (85, 70, 55, 40, 25, 10)]
+    # Lock entries only live while their locks are held or awaited
+    assert not user_locks.locked(user['id'])
+    assert len(user_locks) == 0
+
+
+async def test_cancelled_transaction_is_not_applied(client, api, create_user,
+                                                    balance, ledger):
+    from client_transactions_api import db
+    from client_transactions_api.services.transactions import coalescer
+
+    user = await create_user(funds=100)
+
+    async with db.Session() as db_session:
+        # Transaction queued behind another holder of the user's lock
+        async with coalescer.locks.lock(user['id']):
+            task = asyncio.create_task(coalescer.transaction(
+                db_session, user['id'], -40.0, 'USD'))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    response = await client.post(
+        f'{api}/balances', json={'user_id': user['id'], 'value': -10.0},
+        headers=user['headers'])
+    assert response.json()['value'] == 90.0
+    assert await balance(user['id']) == (90.0, 0.0)
+    assert await ledger(user['id']) == [(100.0, 100.0, None),
+                                        (-10.0, 90.0, None)]
+
+
+async def test_batched_transactions(client, api, create_user, balance, ledger,
+                                    monkeypatch):
+    from client_transactions_api.config import settings
+
+    monkeypatch.setattr(settings, 'BATCH_WRITES', True)
+    users = [await create_user(funds=50) for _ in range(3)]
+
+    responses = await asyncio.gather(*[
+        client.post(
+            f'{api}/balances', json={'user_id': user['id'], 'value': -20.0},
+            headers=user['headers'])
+        for _ in range(3)
+        for user in users])
+
+    for user in users:
+        assert await balance(user['id']) == (10.0, 0.0)
+        # Each leg carries the balance right after it, in commit order
+        legs = await ledger(user['id'])
+        assert [amount for amount, _, _ in legs] == [50.0, -20.0, -20.0]
+        assert [value for _, value, _ in legs] == [50.0, 30.0, 10.0]
+    codes = sorted(response.status_code for response in responses)
+    assert codes == [201] * 6 + [402] * 3
+
+
+async def test_batched_transaction_creates_balance(client, api, create_user,
+                                                   balance, ledger,
+                                                   monkeypatch):
+    from client_transactions_api.config import settings
+
+    monkeypatch.setattr(settings, 'BATCH_WRITES', True)
+    user = await create_user()
+
+    responses = await asyncio.gather(*[
+        client.post(
+            f'{api}/balances',
+            json={'user_id': user['id'], 'value': 5.0, 'currency': 'EUR'},
+            headers=user['headers'])
+        for _ in range(4)])
+
+    assert [response.status_code for response in responses] == [201] * 4
+    assert sorted(response.json()['value'] for response in responses) == \
+        [5.0, 10.0, 15.0, 20.0]
+    assert await balance(user['id'], 'EUR') == (20.0, 0.0)
+    assert [value for _, value, _ in await ledger(user['id'])] == \
+        [5.0, 10.0, 15.0, 20.0]
+
+
+async def test_transaction_on_another_users_balance(client, api, create_user,
+                                                    balance):
+    user = await create_user(funds=100)
+    other = await create_user(funds=100)
+
+    response = await client.post(
+        f'{api}/balances', json={'user_id': other['id'], 'value': -30.0},
+        headers=user['headers'])
+    assert response.status_code == 403
+
+    response = await client.post(
+        f'{api}/balances', json={'value': -30.0}, headers=user['headers'])
+    assert response.status_code == 201
+    assert response.json()['user_id'] == user['id']
+
+    assert await balance(user['id']) == (70.0, 0.0)
+    assert await balance(other['id']) == (100.0, 0.0)
+
+
+async def test_transaction_of_deactivated_user(client, api, create_user,
+                                               balance):
+    from sqlalchemy import update
+
+    from client_transactions_api import db, models
+
+    user = await create_user(funds=100)
+    async with db.Session() as db_session:
+        await db_session.execute(
+            update(models.User).where(models.User.id == user['id'])
+            .values(is_active=False))
+        await db_session.commit()
+
+    response = await client.post(
+        f'{api}/balances', json={'value': -30.0}, headers=user['headers'])
+    assert response.status_code == 403
+
+    assert await balance(user['id']) == (100.0, 0.0)
@@ -0,0 +1,295 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_transfer(client, api, create_user, balance, ledger):
+    sender = await create_user(funds=100)
+    recipient = await create_user()
+
+    response = await client.post(
+        f'{api}/balances/transfer',
+        json={'recipient_id': recipient['id'], 'value': 40.0},
+        headers=sender['headers'])
+    assert response.status_code == 201
+    transfer = response.json()
+    assert transfer['balance'] == 60.0
+
+    assert await balance(sender['id']) == (60.0, 0.0)
+    assert await balance(recipient['id']) == (40.0, 0.0)
+    transfer_id = transfer['transfer_id']
+    assert (await ledger(sender['id']))[-1] == (-40.0, 60.0, transfer_id)
+    assert await ledger(recipient['id']) == [(40.0, 40.0, transfer_id)]
+
+
+async def test_transfer_declined(client, api, create_user, balance, ledger):
+    sender = await create_user(funds=10)
+    recipient = await create_user()
+
+    response = await client.post(
+        f'{api}/balances/transfer',
+        json={'recipient_id': recipient['id'], 'value': 40.0},
+        headers=sender['headers'])
+    assert response.status_code == 402
+    response = await client.post(
+        f'{api}/balances/transfer',
+        json={'recipient_id': sender['id'], 'value': 1.0},
+        headers=sender['headers'])
+    assert response.status_code == 400
+
+    assert await balance(sender['id']) == (10.0, 0.0)
+    assert await ledger(sender['id']) == [(10.0, 10.0, None)]
+    assert await ledger(recipient['id']) == []
+
+
+async def test_concurrent_opposite_transfers(client, api, create_user,
+                                             balance, ledger):
+    first = await create_user(funds=50)
+    second = await create_user(funds=50)
+
+    responses = await asyncio.gather(*[
+        client.post(
+            f'{api}/balances/transfer',
+            json={'recipient_id': recipient['id'], 'value': 20.0},
+            headers=sender['headers'])
+        for _ in range(10)
+        for sender, recipient in ((first, second), (second, first))])
+
+    assert {response.status_code for response in responses} <= {201, 402}
+    transfers = sum(response.status_code == 201 for response in responses)
+    first_value, _ = await balance(first['id'])
+    second_value, _ = await balance(second['id'])
+    assert first_value + second_value == 100.0
+    assert first_value >= 0 and second_value >= 0
+    legs = await ledger(first['id']) + await ledger(second['id'])
+    assert len(legs) == 2 + 2 * transfers
+    assert sum(amount for amount, _, _ in legs) == 100.0
+
+
+async def test_opposite_transfers_creating_balances(create_user, balance):
+    """Transfers of other workers, each in its own DB transaction
+
+    Opposite transfers in a currency neither user holds both insert the
+    two missing balances, in the same order, so neither waits on the
+    other's insert.
+    """
+    from client_transactions_api import db, models
+
+    first = await create_user(funds=50)
+    second = await create_user(funds=50)
+
+    async def transfer(sender: dict, recipient: dict, currency: str) -> int:
+        async with db.Session() as db_session:
+            try:
+                await models.Balance.transfer(
+                    db_session, sender['id'], recipient['id'], 5.0,
+                    f'{sender["id"]}-{recipient["id"]}', currency)
+            except HTTPException as ex:
+                return ex.status_code
+            return 201
+
+    # Declined transfers roll back, so every round creates the rows anew.
+    # Only Postgres runs the inserts at once, SQLite has one writer
+    rounds = 10 if db.engine.dialect.name == 'postgresql' else 1
+    for round in range(rounds):
+        codes = await asyncio.gather(*[
+            transfer(sender, recipient, f'X{round:02d}')
+            for _ in range(10)
+            for sender, recipient in ((first, second), (second, first))])
+
+        # Neither user has the currency to send, every transfer is declined
+        assert set(codes) == {402}
+    assert await balance(first['id']) == (50.0, 0.0)
+    assert await balance(second['id']) == (50.0, 0.0)
+
+
+@pytest.fixture
+async def shards(monkeypatch):
+    """Route users of odd ids to a second shard of the same database
+
+    Users of one database are found on either shard, but transfers
+    between users of odd and even ids go across shards, in sessions of
+    both.
+    """
+    from client_transactions_api import db
+
+    shard = db.Shard(1, db.shards[0].url)
+    monkeypatch.setattr(db, 'shards', [db.shards[0], shard])
+    yield db.shards
+    await shard.engine.dispose()
+
+
+async def create_pair(create_user, funds: float) -> tuple[dict, dict]:
+    """Sender with funds and a recipient of the other shard"""
+    sender = await create_user(funds=funds)
+    recipient = await create_user()
+    while recipient['id'] % 2 == sender['id'] % 2:
+        recipient = await create_user()
+    return sender, recipient
+
+
+async def transfer_credits(transfer_id: str) -> list:
+    from sqlalchemy import select
+
+    from client_transactions_api import db, models
+
+    async with db.Session() as db_session:
+        result = await db_session.execute(
+            select(models.TransferCredit)
+            .where(models.TransferCredit.transfer_id == transfer_id))
+        return result.scalars().all()
+
+
+async def test_transfer_across_shards(client, api, shards, create_user,
+                                      balance, ledger):
+    sender, recipient = await create_pair(create_user, funds=100)
+
+    response = await client.post(
+        f'{api}/balances/transfer',
+        json={'recipient_id': recipient['id'], 'value': 40.0},
+        headers=sender['headers'])
+    assert response.status_code == 201
+    transfer = response.json()
+    assert transfer['balance'] == 60.0
+
+    # Credited right away
+    assert await balance(sender['id']) == (60.0, 0.0)
+    assert await balance(recipient['id']) == (40.0, 0.0)
+    transfer_id = transfer['transfer_id']
+    assert (await ledger(sender['id']))[-1] == (-40.0, 60.0, transfer_id)
+    assert await ledger(recipient['id']) == [(40.0, 40.0, transfer_id)]
+    assert await transfer_credits(transfer_id) == []
+
+    response = await client.post(
+        f'{api}/balances/transfer',
+        json={'recipient_id': recipient['id'], 'value': 70.0},
+        headers=sender['headers'])
+    assert response.status_code == 402
+    assert await balance(sender['id']) == (60.0, 0.0)
+
+
+async def test_transfer_across_shards_to_unknown_user(client, api, shards,
+                                                      create_user, balance,
+                                                      ledger):
+    sender = await create_user(funds=100)
+
+    response = await client.post(
+        f'{api}/balances/transfer',
+        json={'recipient_id': 10**6 + 1 - sender['id'] % 2, 'value': 40.0},
+        headers=sender['headers'])
+    assert response.status_code == 404
+    assert await balance(sender['id']) == (100.0, 0.0)
+    assert await ledger(sender['id']) == [(100.0, 100.0, None)]
+
+
+async def test_transfer_credit_delivered_later(client, api, shards,
+                                               create_user, balance, ledger,
+                                               monkeypatch):
+    from sqlalchemy import delete, update
+
+    from client_transactions_api import db, models
+    from client_transactions_api.services.offline import OfflineException
+    from client_transactions_api.services.transactions import (
+        TransferCreditDelivery)
+
+    sender, recipient = await create_pair(create_user, funds=100)
+
+    async def credit(self, credit):
+        return OfflineException()
+
+    # The recipient's shard is down when the sender is debited
+    monkeypatch.setattr(TransferCreditDelivery, 'credit', credit)
+    response = await client.post(
+        f'{api}/balances/transfer',
+        json={'recipient_id': recipient['id'], 'value': 40.0},
+        headers=sender['headers'])
+    monkeypatch.undo()
+    assert response.status_code == 201
+    transfer_id = response.json()['transfer_id']
+    assert await balance(sender['id']) == (60.0, 0.0)
+    assert await balance(recipient['id']) == (0.0, 0.0)
+    [pending] = await transfer_credits(transfer_id)
+    assert pending.attempts == 1
+
+    # Pushed back after the failed attempt
+    delivery = TransferCreditDelivery()
+    sender_shard = db.shard_for(sender['id'])
+    assert await delivery.deliver(
+        sender_shard, transfer_ids=[transfer_id]) == 0
+    async with db.Session() as db_session:
+        await db_session.execute(
+            update(models.TransferCredit)
+            .where(models.TransferCredit.transfer_id == transfer_id)
+            .values(available_at=pending.created_at))
+        await db_session.commit()
+    assert await delivery.deliver(
+        sender_shard, transfer_ids=[transfer_id]) == 1
+    assert await transfer_credits(transfer_id) == []
+
+    # Delivered again, i.e. by a worker that failed to delete it
+    assert await delivery.credit(pending) is None
+    assert await balance(recipient['id']) == (40.0, 0.0)
+    assert await ledger(recipient['id']) == [(40.0, 40.0, transfer_id)]
+    assert [amount for amount, _, _ in await ledger(sender['id'])] == \
+        [100.0, -40.0]
+
+    # And after the recipient's leg is archived by ledger retention
+    async with db.Session() as db_session:
+        await db_session.execute(
+            delete(models.LedgerEntry)
+            .where(models.LedgerEntry.user_id == recipient['id']))
+        await db_session.commit()
+    assert await delivery.credit(pending) is None
+    assert await balance(recipient['id']) == (40.0, 0.0)
+
+
+async def test_transfer_credit_delivered_at_once(shards, create_user,
+                                                 balance, ledger):
+    """Deliveries of one credit by several workers"""
+    from client_transactions_api import db, models
+    from client_transactions_api.services.locks import UserLocks
+    from client_transactions_api.services.transactions import (
+        TransferCreditDelivery)
+
+    sender, recipient = await create_pair(create_user, funds=100)
+    async with db.shard_for(sender['id']).Session() as db_session:
+        await models.Balance.send(
+            db_session, sender['id'], recipient['id'], 25.0, 'at-once', 'USD')
+    [pending] = await transfer_credits('at-once')
+
+    workers = 4 if db.engine.dialect.name == 'postgresql' else 1
+    results = await asyncio.gather(*[
+        TransferCreditDelivery(locks=UserLocks()).credit(pending)
+        for _ in range(workers)])
+
+    assert sum(result is not None for result in results) == 1
+    assert await balance(recipient['id']) == (25.0, 0.0)
+    assert await ledger(recipient['id']) == [(25.0, 25.0, 'at-once')]
+
+
+
+async def test_users_of_all_shards_sorted_by_name(client, api, bench, shards):
+    """Shards sort names byte-wise, as they are merged"""
+    from client_transactions_api.config import settings
+
+    for name in ('b-sorted', 'B-sorted', 'a-sorted', '_sorted', 'é-sorted'):
+        response = await client.post(
+            f'{api}/auth/register',
+            json={'username': name, 'password': 'password'})
+        assert response.status_code == 201
+    admin = await bench.login(
+        settings.FIRST_SUPERUSER,
+        settings.FIRST_SUPERUSER_PASSWORD.get_secret_value())
+
+    for desc in (False, True):
+        response = await client.get(
+            f'{api}/users',
+            params={'sort_by': 'username', 'desc': desc, 'limit': 1000},
+            headers=admin)
+        assert response.status_code == 200
+        names = [user['username'] for user in response.json()['items']]
+        assert len(names) == response.json()['total']
+        assert names == sorted(names, reverse=desc)